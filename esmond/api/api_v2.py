@@ -3,14 +3,18 @@ import collections
 import copy
 import datetime
 import inspect
+import itertools
 import json
+import threading
 import time
 import urlparse
+from multiprocessing.pool import ThreadPool
 
 import pprint
 
 pp = pprint.PrettyPrinter(indent=4)
 
+from django.http import StreamingHttpResponse
 from django.utils.translation import ugettext_lazy as _
 from django.utils.timezone import make_aware, utc
 from django.utils.timezone import now as django_now
@@ -20,6 +24,7 @@ from rest_framework import (viewsets, serializers, status,
 from rest_framework.exceptions import (ParseError, NotFound, APIException)
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
+from rest_framework.utils.encoders import JSONEncoder
 from rest_framework.utils.urls import replace_query_param, remove_query_param
 from rest_framework.permissions import (AllowAny, DjangoModelPermissions)
 
@@ -31,16 +36,19 @@ import rest_framework_filters as filters
 from .models import *
 from esmond.api import SNMP_NAMESPACE, ANON_LIMIT, OIDSET_INTERFACE_ENDPOINTS
 from esmond.util import atdecode, atencode
-from esmond.api.dataseries import QueryUtil, Fill, TimerangeException
-from esmond.cassandra import CASSANDRA_DB, AGG_TYPES, ConnectionException, RawRateData, BaseRateBin
+from esmond.api.querycache import QueryCache
+from esmond.api.dataseries import QueryUtil, Fill, Downsample, \
+    TimerangeException, FILL_POLICIES, DOWNSAMPLE_METHODS
+from esmond.cassandra import get_timeseries_db, AGG_TYPES, ConnectionException, RawRateData, BaseRateBin
 from esmond.config import get_config_path, get_config
+from esmond.series import ColumnarSeries
 
 #
 # Cassandra connection
 # 
 
 try:
-    db = CASSANDRA_DB(get_config(get_config_path()))
+    db = get_timeseries_db(get_config(get_config_path()))
 except ConnectionException, e:
     #try to get a cassandra connection but don't sweat if cant get one now
     #corrects race condition with cassandra boot and esmond boot
@@ -50,12 +58,50 @@ def check_connection():
     """Verify we have a cassandra connection"""
     global db
     if not db:
-        db = CASSANDRA_DB(get_config(get_config_path()))
+        db = get_timeseries_db(get_config(get_config_path()))
+
+_query_cache = None
+
+def get_query_cache():
+    """Return the QueryCache of query results, None when it is disabled
+    (api_query_cache_size is 0)."""
+    global _query_cache
+    if _query_cache is None:
+        config = get_config(get_config_path())
+        if config.api_query_cache_size:
+            _query_cache = QueryCache(config.api_query_cache_size,
+                config.api_query_cache_settle, config.api_query_cache_max_age)
+        else:
+            _query_cache = False
+    return _query_cache or None
 
 #
 # Superclasses, mixins, helpers,etc.
 #
 
+# Data payloads expected to hold more points than this are streamed to json
+# clients as they are read from cassandra rather than being built and
+# serialized as a whole.
+STREAM_MIN_POINTS = 50000
+STREAM_CHUNK_SIZE = 1000
+
+# Number of threads the queries of the bulk endpoints are run on.  They
+# share the cassandra connection pool so this is kept below its size.
+BULK_QUERY_THREADS = 8
+# Fewest requests of a bulk query that are read together on one thread.
+BULK_CHUNK_MIN = 20
+
+_bulk_pool = None
+_bulk_pool_lock = threading.Lock()
+
+def bulk_query_pool():
+    """Return the thread pool bulk queries are run on."""
+    global _bulk_pool
+    with _bulk_pool_lock:
+        if _bulk_pool is None:
+            _bulk_pool = ThreadPool(BULK_QUERY_THREADS)
+    return _bulk_pool
+
 class QueryErrorException(Exception):
     def __init__(self, value):
         self.value = value
@@ -181,14 +227,131 @@ class InterfaceHyperlinkField(relations.HyperlinkedIdentityField):
 
         return self._iface_detail_url(lookup_value, obj.device.name, request, format)
 
+class DataListField(serializers.ListField):
+    """
+    ListField for the data payload.  The rows of a ColumnarSeries are
+    already plain dicts so they are returned as is.
+    """
+    def to_representation(self, data):
+        if isinstance(data, ColumnarSeries):
+            return data.tolist()
+        return super(DataListField, self).to_representation(data)
+
 class BaseDataSerializer(BaseMixin, serializers.Serializer):
     url = fields.URLField()
-    data = serializers.ListField(child=serializers.DictField())
+    data = DataListField(child=serializers.DictField())
     
     begin_time = serializers.IntegerField()
     end_time = serializers.IntegerField()
 
+def _fill_policy(obj):
+    """Return the fill policy requested for obj."""
+    if not obj.fill:
+        return 'null'
+    if obj.fill not in FILL_POLICIES:
+        raise QueryErrorException('{0} is not a valid fill policy - must be one of {1}'.format(obj.fill, list(FILL_POLICIES)))
+    return obj.fill
+
+def _downsample_args(obj):
+    """
+    Return the number of points and the downsample method requested 
+    for obj - points is None when no downsampling was requested.
+    """
+    if obj.points is None:
+        return None, None
+    try:
+        points = int(obj.points)
+    except (TypeError, ValueError):
+        points = 0
+    if points < 1:
+        raise QueryErrorException('points must be a positive integer - {0} was requested'.format(obj.points))
+    method = obj.downsample or 'bucket'
+    if method not in DOWNSAMPLE_METHODS:
+        raise QueryErrorException('{0} is not a valid downsample method - must be one of {1}'.format(method, list(DOWNSAMPLE_METHODS)))
+    return points, method
+
+def _json_dumps(o):
+    # Same encoding as the rest_framework JSONRenderer.
+    ret = json.dumps(o, cls=JSONEncoder, ensure_ascii=False,
+        separators=(',', ':'))
+    if isinstance(ret, unicode):
+        ret = ret.encode('utf-8')
+    return ret
+
+def stream_json_payload(payload, data, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Generator of the json encoding of the payload dict with its 'data' 
+    key holding the items of the data iterator.  The items are encoded 
+    chunk_size at a time as they are read.
+    """
+    payload = collections.OrderedDict(payload)
+    payload.pop('data', None)
+    rest = _json_dumps(payload)
+
+    yield '{"data":['
+    chunk = []
+    sep = ''
+    for d in data:
+        chunk.append(_json_dumps(d))
+        if len(chunk) >= chunk_size:
+            yield sep + ','.join(chunk)
+            sep = ','
+            chunk = []
+    if chunk:
+        yield sep + ','.join(chunk)
+    yield ']' + ('}' if rest == '{}' else ',' + rest[1:])
+
 class BaseDataViewset(viewsets.GenericViewSet):
+    def _stream_data(self, request, begin, end, freq):
+        """
+        Return True if the data between begin and end should be streamed:
+        json was requested and there are more than STREAM_MIN_POINTS bins
+        of freq in the range.
+        """
+        renderer = getattr(request, 'accepted_renderer', None)
+        if renderer is None or renderer.format != 'json' or not freq:
+            return False
+        return (end - begin) / freq > STREAM_MIN_POINTS
+
+    def _streaming_response(self, serializer_class, obj, request):
+        """
+        Serialize obj with its data attribute (an iterator) streamed into
+        the response.
+        """
+        data, obj.data = obj.data, []
+        payload = serializer_class(obj.to_dict(), context={'request': request}).data
+        return StreamingHttpResponse(stream_json_payload(payload, data),
+            content_type='application/json')
+
+    def _run_queries(self, query, objs):
+        """
+        Split objs in up to BULK_QUERY_THREADS chunks of consecutive objs,
+        run query(chunk) for each of them on the bulk query pool and return
+        the list of their results in the order of objs.  If it raised 
+        QueryErrorException for any chunk the one of the first is raised.
+
+        query must not make SQL queries - the metadata needs to be read
+        by the calling thread beforehand.
+        """
+        size = max(BULK_CHUNK_MIN, -(-len(objs) // BULK_QUERY_THREADS))
+        chunks = [objs[i:i+size] for i in range(0, len(objs), size)]
+
+        def run(chunk):
+            try:
+                return query(chunk), None
+            except QueryErrorException as e:
+                return None, e
+
+        if len(chunks) > 1:
+            results = bulk_query_pool().map(run, chunks)
+        else:
+            results = map(run, chunks)
+
+        for ret, e in results:
+            if e is not None:
+                raise e
+        return list(itertools.chain.from_iterable([ret for ret, e in results]))
+
     def _endpoint_map(self, device, iface_name):
 
         endpoint_map = {}
@@ -236,6 +399,24 @@ class BaseDataViewset(viewsets.GenericViewSet):
         if time_only: 
             return
 
+        if filters.has_key('fill'):
+            obj.fill = filters['fill']
+        else:
+            obj.fill = 'null'
+
+        # maxDataPoints is what graphite calls points.
+        if filters.has_key('points'):
+            obj.points = filters['points']
+        elif filters.has_key('maxDataPoints'):
+            obj.points = filters['maxDataPoints']
+        else:
+            obj.points = None
+
+        if filters.has_key('downsample'):
+            obj.downsample = filters['downsample']
+        else:
+            obj.downsample = 'bucket'
+
         if filters.has_key('cf'):
             obj.cf = filters['cf']
         elif getattr(obj, 'r_type'):
@@ -490,6 +671,19 @@ class QueryBase(object):
         BulkTimeseriesViewset classes."""
         raise NotImplementedError('override in subclass')
 
+    def _execute_interface_data_queries(self, pairs):
+        """Logic to retrieve the interface data of a list of (oidset, obj)
+        pairs for BulkInterfaceRequestViewset - they are queried in turn
+        unless the backend can do better."""
+        return [self._execute_interface_data_query(oidset, obj)
+            for oidset, obj in pairs]
+
+    def _execute_timeseries_queries(self, objs):
+        """Logic to retrieve the timeseries data of a list of objs for 
+        BulkTimeseriesViewset - they are queried in turn unless the 
+        backend can do better."""
+        return [self._execute_timeseries_query(obj) for obj in objs]
+
     def _execute_timeseries_inserts(self, objs):
         """Logic to insert timeseries data for TimeseriesRequestViewset."""
         raise NotImplementedError('override in subclass')
@@ -499,21 +693,53 @@ class QueryBase(object):
         raise NotImplementedError('override in subclass')
 
 class CassandraQueryLogic(QueryBase):
-    def _execute_interface_data_query(self, oidset, obj):
+    def _query(self, obj, name, **kwargs):
         """
-        Query to get interface data tied to specific oid/set datasets 
-        (as opposed to the free-form timeseries endpoint).
+        Run the db query method for name - the iter_ generator when obj is
+        streamed, otherwise the query_ method with columnar results through
+        the query cache when it is enabled.
+        """
+        if obj.stream:
+            return getattr(db, 'iter_{0}'.format(name))(**kwargs)
+
+        query = getattr(db, 'query_{0}'.format(name))
+        cache = get_query_cache()
+        if cache is None:
+            return query(columnar=True, **kwargs)
 
+        def read(ts_min, ts_max):
+            return query(columnar=True, **dict(kwargs, ts_min=ts_min,
+                ts_max=ts_max))
+        return cache.query(name, kwargs, read)
+
+    def _query_many(self, queries):
+        """
+        Run a list of (name, kwargs) db queries with one db.query_many()
+        call for what isn't in the query cache.
+        """
+        def read_many(queries):
+            return db.query_many(queries, columnar=True)
+
+        cache = get_query_cache()
+        if cache is None:
+            return read_many(queries)
+        return cache.query_many(queries, read_many)
+
+    def _interface_data_query(self, oidset, obj):
+        """
         Executes a couple of reality checks (making sure that a valid 
-        aggregation was requested and checks/limits the time range), and
-        then make calls to cassandra backend.
+        aggregation was requested and checks/limits the time range) and
+        returns the (name, kwargs) of the db query for the interface data
+        of obj.
         """
-        # make sure we have a DB connection, throw exception otherwise
-        check_connection()
-        
-        # If no aggregate level defined in request, set to the frequency, 
-        # otherwise, check if the requested aggregate level is valid.
-        if not obj.agg:
+        # If no aggregate level defined in request, set to the frequency 
+        # (or the coarsest aggregation with enough bins when a number of 
+        # points was requested), otherwise, check if the requested 
+        # aggregate level is valid.
+        if not obj.agg and obj.points:
+            obj.agg = Downsample.choose_agg(obj.begin_time, obj.end_time,
+                obj.points, [oidset.frequency] + oidset.aggregates)
+        elif not obj.agg:
             obj.agg = oidset.frequency
         elif obj.agg and not oidset.aggregates:
             raise QueryErrorException('there are no aggregations for oidset {0} - {1} was requested'.format(oidset.name, obj.agg))
@@ -528,54 +754,93 @@ class CassandraQueryLogic(QueryBase):
 
         if obj.agg == oidset.frequency:
             # Fetch the base rate data.
-            data = db.query_baserate_timerange(path=obj.datapath, freq=obj.agg*1000,
-                    ts_min=obj.begin_time*1000, ts_max=obj.end_time*1000)
+            return 'baserate_timerange', dict(path=obj.datapath,
+                freq=obj.agg*1000, ts_min=obj.begin_time*1000,
+                ts_max=obj.end_time*1000)
         else:
             # Get the aggregation.
             if obj.cf not in AGG_TYPES:
                 raise QueryErrorException('%s is not a valid consolidation function' %
                         (obj.cf))
-            data = db.query_aggregation_timerange(path=obj.datapath, freq=obj.agg*1000,
-                    ts_min=obj.begin_time*1000, ts_max=obj.end_time*1000, cf=obj.cf)
+            return 'aggregation_timerange', dict(path=obj.datapath,
+                freq=obj.agg*1000, ts_min=obj.begin_time*1000,
+                ts_max=obj.end_time*1000, cf=obj.cf)
 
-        obj.data = QueryUtil.format_cassandra_data_payload(data)
+    def _execute_interface_data_query(self, oidset, obj):
+        """
+        Query to get interface data tied to specific oid/set datasets 
+        (as opposed to the free-form timeseries endpoint).
+
+        Checks the request with _interface_data_query() and then make 
+        calls to cassandra backend.
+        """
+        # make sure we have a DB connection, throw exception otherwise
+        check_connection()
+
+        name, kwargs = self._interface_data_query(oidset, obj)
+        data = self._query(obj, name, **kwargs)
+
+        if obj.stream:
+            obj.data = QueryUtil.iter_cassandra_data_payload(data)
+        else:
+            obj.data = QueryUtil.format_cassandra_data_payload(data)
 
         return obj
 
-    def _execute_timeseries_query(self, obj):
+    def _execute_interface_data_queries(self, pairs):
         """
-        Query for "timeseries" retrieval endpoint.
-
-        Sanity check the requested timerange, and then make the appropriate
-        method call to the cassandra backend.
+        Bulk version of _execute_interface_data_query() - all of the
+        requests are checked and then read with one _query_many() call.
         """
-        # make sure we have a DB connection, throw exception otherwise
         check_connection()
-        
+
+        queries = [self._interface_data_query(oidset, obj)
+            for oidset, obj in pairs]
+        results = self._query_many(queries)
+
+        for (oidset, obj), data in zip(pairs, results):
+            obj.data = QueryUtil.format_cassandra_data_payload(data)
+
+        return [obj for oidset, obj in pairs]
+
+    def _timeseries_query(self, obj):
+        """
+        Sanity check the requested timerange and return the (name, kwargs) 
+        of the db query for obj - None if the type has no query.
+        """
         # Make sure we're not exceeding allowable time range.
         if not QueryUtil.valid_timerange(obj, in_ms=True) and \
             not obj.user.username:
             raise QueryErrorException('exceeded valid timerange for agg level: {0}'.format(obj.agg))
-        
-        data = []
+
+        kwargs = dict(path=obj.datapath, freq=obj.agg,
+            ts_min=obj.begin_time, ts_max=obj.end_time)
 
         if obj.r_type == 'BaseRate':
-            data = db.query_baserate_timerange(path=obj.datapath, freq=obj.agg,
-                    ts_min=obj.begin_time, ts_max=obj.end_time)
+            return 'baserate_timerange', kwargs
         elif obj.r_type == 'Aggs':
             if obj.cf not in AGG_TYPES:
                 raise QueryErrorException('{0} is not a valid consolidation function'.format(obj.cf))
-            data = db.query_aggregation_timerange(path=obj.datapath, freq=obj.agg,
-                    ts_min=obj.begin_time, ts_max=obj.end_time, cf=obj.cf)
+            return 'aggregation_timerange', dict(kwargs, cf=obj.cf)
         elif obj.r_type == 'RawData':
-            data = db.query_raw_data(path=obj.datapath, freq=obj.agg,
-                    ts_min=obj.begin_time, ts_max=obj.end_time)
+            return 'raw_data', kwargs
         else:
             # Input has been checked already
-            pass
+            return None
+
+    def _timeseries_payload(self, obj, data):
+        """Format the data read for obj and check that an empty result is
+        not due to a bad path."""
+        if obj.stream:
+            # Read the first row now so an empty result can be checked.
+            data = QueryUtil.iter_cassandra_data_payload(data, in_ms=True)
+            first = next(data, None)
+            obj.data = itertools.chain([first], data) \
+                if first is not None else []
+        else:
+            obj.data = QueryUtil.format_cassandra_data_payload(data, in_ms=True)
 
-        obj.data = QueryUtil.format_cassandra_data_payload(data, in_ms=True)
-        if not len(obj.data):
+        if not obj.data:
             # If no data is returned, sanity check that there is a 
             # corresponding key in the database.
             v = db.check_for_valid_keys(path=obj.datapath, freq=obj.agg, 
@@ -585,6 +850,34 @@ class CassandraQueryLogic(QueryBase):
 
         return obj
 
+    def _execute_timeseries_query(self, obj):
+        """
+        Query for "timeseries" retrieval endpoint.
+
+        Sanity check the requested timerange, and then make the appropriate
+        method call to the cassandra backend.
+        """
+        # make sure we have a DB connection, throw exception otherwise
+        check_connection()
+
+        query = self._timeseries_query(obj)
+        data = self._query(obj, query[0], **query[1]) if query else []
+
+        return self._timeseries_payload(obj, data)
+
+    def _execute_timeseries_queries(self, objs):
+        """
+        Bulk version of _execute_timeseries_query() - all of the requests
+        are checked and then read with one _query_many() call.
+        """
+        check_connection()
+
+        queries = [self._timeseries_query(obj) for obj in objs]
+        results = iter(self._query_many([q for q in queries if q]))
+
+        return [self._timeseries_payload(obj, next(results) if q else [])
+            for obj, q in zip(objs, queries)]
+
     def _execute_timeseries_inserts(self, objs):
         """
         Iterate through a list of TimeseriesDataObject, execute the 
@@ -613,6 +906,14 @@ class CassandraQueryLogic(QueryBase):
         
         db.flush()
 
+        cache = get_query_cache()
+        if cache is not None:
+            for obj in objs:
+                cache.invalidate(obj.datapath)
+        if db.chunk_cache is not None:
+            for obj in objs:
+                db.chunk_cache.invalidate(obj.datapath)
+
         return True
 
     def _execute_outlet_query(self, oidset, obj):
@@ -623,7 +924,8 @@ class CassandraQueryLogic(QueryBase):
         check_connection()
         
         obj.data = db.query_raw_data(obj.datapath, oidset.frequency*1000,
-                                 obj.begin_time*1000, obj.end_time*1000)
+                                 obj.begin_time*1000, obj.end_time*1000,
+                                 columnar=True)
 
         obj.data = QueryUtil.format_cassandra_data_payload(obj.data, coerce_to_bins=oidset.frequency*1000)
         
@@ -650,12 +952,22 @@ REST namespace documentation:
 /v1/device/$DEVICE/interface/$INTERFACE/in
 /v1/device/$DEVICE/interface/$INTERFACE/out
 
-Params for GET: begin, end, agg (and cf where appropriate).
+Params for GET: begin, end, agg, fill (and cf where appropriate).
 
 If none are supplied, sane defaults will be set by the interface and the 
 last hour of base rates will be returned.  The begin/end params are 
 timestamps in seconds, the agg param is the frequency of the aggregation 
-that the client is requesting, and the cf is one of average/min/max.
+that the client is requesting, and the cf is one of average/min/max.  
+The fill param sets how missing or invalid bins are returned: null (the 
+default), previous (the last valid value) or linear (interpolated between 
+the valid values around them).
+
+The points param (or maxDataPoints) asks for at most that many datapoints 
+whatever the time range.  Unless agg is given the coarsest aggregation 
+with at least points bins in the range is used, and the filled series is 
+then reduced to points with the downsample param: bucket (the default - 
+consecutive bins merged with the cf, evenly spaced) or lttb (the valid 
+datapoints that best keep the shape of the series).
 
 This namespace is 'browsable' - /v1/device/ will return a list of devices, 
 /v1/device/$DEVICE/interface/ will return the interfaces on a device, etc. 
@@ -1067,11 +1379,17 @@ class InterfaceDataViewset(BaseDataViewset, QueryBackend):
         self._parse_data_default_args(request, obj)
 
         obj.data = list()
+        # A downsampled payload is small, it is never streamed.
+        obj.stream = self._stream_data(request, obj.begin_time, obj.end_time,
+            obj.agg or oidset.frequency) and obj.points is None
 
         try:
+            obj.points, obj.downsample = _downsample_args(obj)
             # defined in QueryBackend mixin
             obj = self._execute_interface_data_query(oidset, obj)
             obj = self._format_payload(obj)
+            if obj.stream:
+                return self._streaming_response(InterfaceDataSerializer, obj, request)
             serializer = InterfaceDataSerializer(obj.to_dict(), context={'request': request})
             return Response(serializer.data)
         except (QueryErrorException, TimerangeException) as e:
@@ -1083,8 +1401,21 @@ class InterfaceDataViewset(BaseDataViewset, QueryBackend):
         contains dicts with 'ts' and 'val' keys. This contains "generic" 
         formatting logic (fill, etc) that is not tied to the query logic itself.
         """
-        obj.data = Fill.verify_fill(obj.begin_time, obj.end_time,
-                obj.agg, obj.data)
+        policy = _fill_policy(obj)
+        if obj.stream:
+            obj.data = Fill.iter_fill(obj.begin_time, obj.end_time,
+                    obj.agg, obj.data, policy)
+        else:
+            obj.data = Fill.verify_fill(obj.begin_time, obj.end_time,
+                    obj.agg, obj.data, policy)
+
+        if obj.points:
+            # Base rates are averages, cf then picks how they are merged.
+            try:
+                obj.data = Downsample.downsample(obj.data, obj.points,
+                        obj.downsample, obj.cf)
+            except ValueError as e:
+                raise QueryErrorException('can not downsample: {0}'.format(e))
 
         return obj
 
@@ -1162,46 +1493,67 @@ class BulkInterfaceRequestViewset(BaseDataViewset):
 
         self._parse_data_default_args(request, ret_obj)
 
+        device_names = [i['device'].rstrip('/').split('/')[-1]
+            for i in request.data['interfaces']]
+
+        # Read the devices and their oidsets up front so the queries 
+        # don't need the database.
+        devices = dict([(d.name, d) for d in
+            Device.objects.filter(name__in=set(device_names)).prefetch_related('oidsets')])
+
         # process request
-        for i in request.data['interfaces']:
-            device_name = i['device'].rstrip('/').split('/')[-1]
+        objs = []
+        for i, device_name in zip(request.data['interfaces'], device_names):
             iface_name = i['iface']
 
             # XXX(mmg): should we do an "if in" test first to avoid dupes?
             ret_obj.device_names.append(device_name)
 
-            device = Device.objects.get(name=device_name)
+            if device_name not in devices:
+                return Response({'error': 'no such device {0}'.format(device_name)}, status.HTTP_400_BAD_REQUEST)
+
+            device = devices[device_name]
             endpoint_map = self._endpoint_map(device, iface_name)
+            oidsets = dict([(o.name, o) for o in device.oidsets.all()])
 
             for end_point in request.data['endpoint']:
 
                 if end_point not in endpoint_map:
                     return Response({'error': 'no such dataset {0}'.format(end_point)}, status.HTTP_400_BAD_REQUEST)
 
-                oidset = device.oidsets.get(name=endpoint_map[end_point][2])
-
                 obj = BulkInterfaceDataObject()
+                obj.oidset = oidsets[endpoint_map[end_point][2]]
                 obj.datapath = endpoint_map[end_point]
                 obj.iface_dataset = end_point
                 obj.iface = iface_name
+                obj.device_name = device_name
 
                 obj.begin_time = ret_obj.begin_time
                 obj.end_time = ret_obj.end_time
                 obj.cf = ret_obj.cf
                 obj.agg = ret_obj.agg
+                obj.fill = ret_obj.fill
 
-                try:
-                    data = InterfaceDataViewset()._execute_interface_data_query(oidset, obj)
-                    data = InterfaceDataViewset()._format_payload(obj)
-                except QueryErrorException, e:
-                    return Response({'query error': '{0}'.format(str(e))}, status.HTTP_400_BAD_REQUEST)
+                objs.append(obj)
 
-                row = dict(
-                    data=data.data,
-                    path={'dev': device_name,'iface': iface_name,'endpoint': end_point}
-                )
+        def query(objs):
+            view = InterfaceDataViewset()
+            objs = view._execute_interface_data_queries(
+                [(obj.oidset, obj) for obj in objs])
+            return [view._format_payload(obj) for obj in objs]
+
+        try:
+            objs = self._run_queries(query, objs)
+        except QueryErrorException, e:
+            return Response({'query error': '{0}'.format(str(e))}, status.HTTP_400_BAD_REQUEST)
+
+        for obj in objs:
+            row = dict(
+                data=obj.data,
+                path={'dev': obj.device_name,'iface': obj.iface,'endpoint': obj.iface_dataset}
+            )
 
-                ret_obj.data.append(row)
+            ret_obj.data.append(row)
 
         serializer = BulkInterfaceRequestSerializer(ret_obj.to_dict(), context={'request': request})
         return Response(serializer.data, status.HTTP_201_CREATED)
@@ -1308,11 +1660,15 @@ class TimeseriesRequestViewset(BaseDataViewset, QueryBackend):
                 )
 
         self._parse_data_default_args(request, obj, in_ms=True)
+        obj.stream = self._stream_data(request, obj.begin_time, obj.end_time,
+            obj.agg)
 
         try:
             # defined in QueryBackend mixin
             obj = self._execute_timeseries_query(obj)
             obj = self._format_payload(obj)
+            if obj.stream:
+                return self._streaming_response(TimeseriesRequestSerializer, obj, request)
             serializer = TimeseriesRequestSerializer(obj.to_dict(), context={'request': request})
             return Response(serializer.data)
         except (QueryErrorException, TimerangeException) as e:
@@ -1325,8 +1681,9 @@ class TimeseriesRequestViewset(BaseDataViewset, QueryBackend):
         formatting logic (fill, etc) that is not tied to the query logic itself.
         """
         if obj.r_type != 'RawData':
-            obj.data = Fill.verify_fill(obj.begin_time, obj.end_time,
-                    obj.agg, obj.data)
+            fill = Fill.iter_fill if obj.stream else Fill.verify_fill
+            obj.data = fill(obj.begin_time, obj.end_time, obj.agg, obj.data,
+                    _fill_policy(obj))
 
         return obj
 
@@ -1472,21 +1829,29 @@ class BulkTimeseriesViewset(BaseDataViewset):
 
         self._parse_data_default_args(request, ret_obj, in_ms=True)
 
+        objs = []
         for p in request.data['paths']:
             obj = BulkTimeseriesDataObject()
             obj.r_type = request.data['type']
             obj.cf = ret_obj.cf
+            obj.fill = ret_obj.fill
             obj.begin_time = ret_obj.begin_time
             obj.end_time = ret_obj.end_time
             obj.datapath = p
             obj.agg = int(obj.datapath.pop())
+            objs.append(obj)
 
-            try:
-                obj = TimeseriesRequestViewset()._execute_timeseries_query(obj)
-                obj = TimeseriesRequestViewset()._format_payload(obj)
-            except QueryErrorException, e:
-                return Response({'query error': '{0}'.format(str(e))}, status.HTTP_400_BAD_REQUEST)
+        def query(objs):
+            view = TimeseriesRequestViewset()
+            objs = view._execute_timeseries_queries(objs)
+            return [view._format_payload(obj) for obj in objs]
 
+        try:
+            objs = self._run_queries(query, objs)
+        except QueryErrorException, e:
+            return Response({'query error': '{0}'.format(str(e))}, status.HTTP_400_BAD_REQUEST)
+
+        for obj in objs:
             row = {
                 'data': obj.data,
                 'path': obj.datapath + [obj.agg]
@@ -6,8 +6,14 @@ import datetime
 
 from collections import OrderedDict
 
+from esmond.series import ColumnarSeries
 from esmond.util import atdecode, atencode
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class TimerangeException(Exception):
     def __init__(self, value):
         self.value = value
@@ -16,6 +22,11 @@ class TimerangeException(Exception):
 
 class TimerangeWarning(Warning): pass
 
+# How the bins without a value are filled, see Fill.fill_values()
+FILL_POLICIES = ('null', 'previous', 'linear')
+
+DOWNSAMPLE_METHODS = ('bucket', 'lttb')
+
 class QueryUtil(object):
     """Class holding common query methods used by multiple resources 
     and data structures to validate incoming request elements."""
@@ -76,11 +87,54 @@ class QueryUtil(object):
 
         If coerce_to_bins is not None, truncate the timestamp to the
         the bins spaced coerce_to_bins ms apart. This is useful for 
-        fitting raw data to bin boundaries."""
+        fitting raw data to bin boundaries.
+
+        A ColumnarSeries is formatted with array operations and returned
+        as a ColumnarSeries."""
+
+        if isinstance(data, ColumnarSeries):
+            return QueryUtil._format_columnar_payload(data, in_ms=in_ms,
+                coerce_to_bins=coerce_to_bins)
+
+        return list(QueryUtil.iter_cassandra_data_payload(data, in_ms=in_ms,
+            coerce_to_bins=coerce_to_bins))
+
+    @staticmethod
+    def _format_columnar_payload(data, in_ms=False, coerce_to_bins=None):
+        """Columnar version of format_cassandra_data_payload()."""
 
         divs = { False: 1000, True: 1 }
 
-        results = []
+        ts = data.ts
+        if coerce_to_bins:
+            ts = ts - ts % coerce_to_bins
+
+        val, mask = data.column('val')
+        columns = [('val', (val, mask))]
+
+        # Further options for different data sets.
+        if 'is_valid' in data: # Base rates
+            is_valid, is_valid_mask = data.column('is_valid')
+            columns = [('val', (val, mask & ~(is_valid_mask & (is_valid == 0))))]
+        elif 'cf' in data: # Aggregations
+            cf = data.constants.get('cf')
+            if (cf == 'min' or cf == 'max') and 'm_ts' in data:
+                m_ts, m_ts_mask = data.column('m_ts')
+                if m_ts.dtype.kind in 'iu':
+                    m_ts = m_ts//divs[in_ms]
+                else:
+                    m_ts = numpy.array([v/divs[in_ms] if v else v for v in m_ts],
+                        dtype=object)
+                columns.append(('m_ts', (m_ts, m_ts_mask)))
+
+        return ColumnarSeries(ts//divs[in_ms], OrderedDict(columns))
+
+    @staticmethod
+    def iter_cassandra_data_payload(data, in_ms=False, coerce_to_bins=None):
+        """Generator version of format_cassandra_data_payload() that 
+        formats the rows of data as they are read."""
+
+        divs = { False: 1000, True: 1 }
 
         for row in data:
             ts = row['ts']
@@ -101,9 +155,7 @@ class QueryUtil(object):
             else: # Raw Data
                 pass
             
-            results.append(d)
-
-        return results
+            yield d
 
 class Fill(object):
     """Set of methods to verify that a series of binned data contains
@@ -165,45 +217,394 @@ class Fill(object):
         return start_bin, end_bin, expected_bins
 
     @staticmethod
-    def generate_filled_series(start_bin, end_bin, freq, data):
+    def grid_index(start_bin, freq, ts):
+        """Return the bin index and offset into the bin of ts.  Works on 
+        numbers and numpy arrays."""
+        return (ts - start_bin) // freq, (ts - start_bin) % freq
+
+    @staticmethod
+    def generate_filled_series(start_bin, end_bin, freq, data, policy='null'):
         """Genrate a new 'filled' series if the returned series has unexpected
-        gaps.  Initialize a new range based in the requested time range as
-        an OrderedDict, then iterate through original series to retain original
-        values.
+        gaps.  The values of data are placed in a list of the expected bins
+        by index and the bins without a value are filled according to 
+        policy (see fill_values()).
+
+        A datapoint that is not on a bin boundary is placed in the bin it
+        falls in unless that bin has a datapoint on its boundary.  
+        Datapoints outside of the time range are dropped.
         """
-        # Generate the empty "proper" timerange
-        filled_range = []
-        s = start_bin + 0 # copy it
-        while s <= end_bin:
-            filled_range.append((s,dict(ts=s, val=None)))
-            s += freq
-        
-        # Make it a ordered dict
-        fill = OrderedDict(filled_range)
-        
-        # Go through the original data and plug in 
-        # good values
+        n_bins = Fill.expected_bin_count(start_bin, end_bin, freq)
+        vals = [None] * n_bins
+        exact = [False] * n_bins
+
         for dp in data:
-            fill[dp['ts']]['val'] = dp['val']
+            i, off = Fill.grid_index(start_bin, freq, dp['ts'])
+            if 0 <= i < n_bins and (off == 0 or not exact[i]):
+                vals[i] = dp['val']
+                exact[i] = off == 0
 
-        for i in fill.values():
-            yield i
+        Fill.fill_values(vals, policy)
+
+        s = start_bin
+        for v in vals:
+            yield dict(ts=s, val=v)
+            s += freq
 
     @staticmethod
-    def verify_fill(begin, end, freq, data):
+    def generate_filled_columns(start_bin, end_bin, freq, data, policy='null'):
+        """Columnar version of generate_filled_series() - the values of
+        data are placed in an array of the expected bins."""
+        ts = numpy.arange(start_bin, end_bin + 1, freq, dtype=numpy.int64)
+
+        val, mask = data.column('val')
+        filled = numpy.zeros(len(ts), dtype=val.dtype)
+        filled_mask = numpy.zeros(len(ts), dtype=bool)
+
+        idx, off = Fill.grid_index(start_bin, freq, data.ts)
+        in_range = (idx >= 0) & (idx < len(ts))
+        # Datapoints on a bin boundary are placed last so they win over
+        # ones that fall inside the same bin.
+        sel = numpy.concatenate((numpy.flatnonzero(in_range & (off != 0)),
+            numpy.flatnonzero(in_range & (off == 0))))
+        filled[idx[sel]] = val[sel]
+        filled_mask[idx[sel]] = mask[sel]
+
+        filled, filled_mask = Fill.fill_array(filled, filled_mask, policy)
+
+        return ColumnarSeries(ts, OrderedDict([('val', (filled, filled_mask))]))
+
+    @staticmethod
+    def fill_values(vals, policy='null'):
+        """Fill the None values of the list vals in place.  The policy is
+        one of FILL_POLICIES:
+
+        null - leave them as None.
+
+        previous - use the last value before them.
+
+        linear - interpolate between the values before and after them.
+
+        Values before the first or after the last value stay None with 
+        all of the policies.
+
+        >>> Fill.fill_values([None, 1, None, None, 4, None], 'linear')
+        [None, 1, 2.0, 3.0, 4, None]
+        """
+        if policy == 'previous':
+            prev = None
+            for i, v in enumerate(vals):
+                if v is None:
+                    vals[i] = prev
+                else:
+                    prev = v
+        elif policy == 'linear':
+            last = None
+            for i, v in enumerate(vals):
+                if v is None:
+                    continue
+                if last is not None and i - last > 1:
+                    step = (v - vals[last]) / float(i - last)
+                    for j in range(last + 1, i):
+                        vals[j] = step * (j - last) + vals[last]
+                last = i
+        elif policy != 'null':
+            raise ValueError('invalid fill policy: %s' % policy)
+        return vals
+
+    @staticmethod
+    def fill_array(vals, mask, policy='null'):
+        """numpy version of fill_values() - returns the filled values and
+        the mask of the values that are set."""
+        if policy == 'null':
+            return vals, mask
+        if policy not in FILL_POLICIES:
+            raise ValueError('invalid fill policy: %s' % policy)
+        if mask.all() or not mask.any():
+            return vals, mask
+
+        pos = numpy.arange(len(vals))
+        if policy == 'previous':
+            prev = numpy.maximum.accumulate(numpy.where(mask, pos, 0))
+            return vals[prev], mask[prev]
+
+        # linear
+        valid = numpy.flatnonzero(mask)
+        inside = (pos >= valid[0]) & (pos <= valid[-1])
+        filled = numpy.interp(pos, valid, vals[valid].astype(numpy.float64))
+        if vals.dtype.kind != 'f':
+            # Keep the original (integer) values as they are.
+            filled = filled.astype(object)
+            filled[mask] = vals[mask]
+        return filled, inside
+
+    @staticmethod
+    def verify_fill(begin, end, freq, data, policy='null'):
         """Top-level function to inspect a returned series for gaps.
         Returns the original series of the count is correct, else will
-        return a new filled series."""
+        return a new filled series.  With a policy other than null the
+        None values are always filled (see fill_values())."""
         begin, end, freq = int(begin), int(end), int(freq)
         start_bin,end_bin,expected_bins = Fill.get_bin_alignment(begin, end, freq)
-        #print 'got :', len(data)
-        #print 'need:', Fill.expected_bin_count(start_bin,end_bin,freq)
-        if len(data) == Fill.expected_bin_count(start_bin,end_bin,freq):
-            #print 'verify: not filling'
+        if policy not in FILL_POLICIES:
+            raise ValueError('invalid fill policy: %s' % policy)
+        if len(data) == expected_bins and policy == 'null':
             return data
+        if isinstance(data, ColumnarSeries):
+            return Fill.generate_filled_columns(start_bin, end_bin, freq,
+                data, policy)
+        return list(Fill.generate_filled_series(start_bin,end_bin,freq,data,
+            policy))
+
+    @staticmethod
+    def iter_fill(begin, end, freq, data, policy='null'):
+        """Streaming version of verify_fill() for an iterator of data
+        sorted on ts.  Missing bins are filled as the series is read so 
+        the series never has to be held in memory, a linear fill only 
+        holds the bins of the current gap.  Datapoints are placed like
+        generate_filled_series() does; ones on a bin boundary are returned
+        unchanged, so a complete series is returned as with verify_fill()
+        and datapoints in a series with gaps keep all of their keys."""
+        begin, end, freq = int(begin), int(end), int(freq)
+        start_bin,end_bin,expected_bins = Fill.get_bin_alignment(begin, end, freq)
+        if policy not in FILL_POLICIES:
+            raise ValueError('invalid fill policy: %s' % policy)
+
+        rows = Fill._iter_grid(start_bin, freq, expected_bins, data)
+        if policy == 'null':
+            return rows
+        return Fill._iter_policy(rows, policy)
+
+    @staticmethod
+    def _iter_grid(start_bin, freq, n_bins, data):
+        """Generator of one row per bin for iter_fill()."""
+        s = 0 # index of the next bin to return
+        held = None # row for bin s while later datapoints could replace it
+        held_exact = False
+
+        for dp in data:
+            i, off = Fill.grid_index(start_bin, freq, dp['ts'])
+            if i < s or i >= n_bins:
+                continue
+            if held is not None and i > s:
+                yield held
+                held, held_exact = None, False
+                s += 1
+            while s < i:
+                yield dict(ts=start_bin + s*freq, val=None)
+                s += 1
+            if off == 0:
+                held, held_exact = dp, True
+            elif not held_exact:
+                held, held_exact = dict(ts=start_bin + s*freq, val=dp['val']), False
+
+        if held is not None:
+            yield held
+            s += 1
+        while s < n_bins:
+            yield dict(ts=start_bin + s*freq, val=None)
+            s += 1
+
+    @staticmethod
+    def _iter_policy(rows, policy):
+        """Apply a fill policy to the rows from _iter_grid()."""
+        gap = []
+        last = None
+        for row in rows:
+            if row['val'] is None:
+                if policy == 'previous' and last is not None:
+                    yield dict(row, val=last['val'])
+                elif policy == 'linear' and last is not None:
+                    gap.append(row)
+                else:
+                    yield row
+                continue
+
+            if gap:
+                vals = [last['val']] + [None] * len(gap) + [row['val']]
+                Fill.fill_values(vals, policy)
+                for r, v in zip(gap, vals[1:-1]):
+                    yield dict(r, val=v)
+                gap = []
+            last = row
+            yield row
+
+        for r in gap:
+            yield r
+
+class Downsample(object):
+    """Set of methods to reduce a filled series to a fixed number of 
+    points so clients such as dashboards get about the same payload 
+    whatever the time range they ask for.
+
+    The query is first made against the coarsest aggregation that still
+    has enough bins (see choose_agg()) and the series is then reduced
+    with one of DOWNSAMPLE_METHODS:
+
+    bucket - consecutive bins are merged into buckets of the same size 
+    with the consolidation function of the query (the average, min or 
+    max of the valid values in the bucket).  The bucket is returned at 
+    the timestamp of its first bin so the series stays evenly spaced.
+
+    lttb - Largest-Triangle-Three-Buckets picks the valid datapoint of 
+    each bucket that best keeps the shape of the series (peaks and dips
+    are not averaged away).  The datapoints keep their timestamps so the 
+    series is not evenly spaced.
+    """
+    @staticmethod
+    def choose_agg(begin, end, points, freqs):
+        """Return the coarsest of the frequencies freqs that still has 
+        points bins between begin and end, or the finest one if none
+        of them has."""
+        adequate = [f for f in freqs if (end - begin) / f >= points]
+        return max(adequate) if adequate else min(freqs)
+
+    @staticmethod
+    def bucket_size(n, points):
+        """Number of consecutive bins merged to reduce n bins to at most
+        points buckets."""
+        return -(-n // points)
+
+    @staticmethod
+    def downsample(data, points, method='bucket', cf='average'):
+        """Top-level function to reduce the series data to at most points
+        datapoints with method.  Returns the original series if it isn't
+        longer than that.  lttb needs at least 3 points, bucket is used 
+        for less."""
+        if method not in DOWNSAMPLE_METHODS:
+            raise ValueError('invalid downsample method: %s' % method)
+        if len(data) <= points:
+            return data
+        columnar = isinstance(data, ColumnarSeries)
+        if method == 'lttb' and points >= 3:
+            if columnar:
+                return Downsample.lttb_columns(data, points)
+            return Downsample.lttb(data, points)
+        if columnar:
+            return Downsample.bucket_columns(data, points, cf)
+        return Downsample.buckets(data, points, cf)
+
+    @staticmethod
+    def buckets(data, points, cf='average'):
+        """Reduce the list of rows data to buckets.
+
+        >>> Downsample.buckets([dict(ts=0, val=1), dict(ts=30, val=None),
+        ...     dict(ts=60, val=5), dict(ts=90, val=2)], 2, 'max')
+        [{'ts': 0, 'val': 1}, {'ts': 60, 'val': 5}]
+        """
+        if cf == 'average':
+            reduce_vals = lambda v: sum(v) / float(len(v))
+        elif cf in ('min', 'max'):
+            reduce_vals = min if cf == 'min' else max
+        else:
+            raise ValueError('invalid consolidation function: %s' % cf)
+
+        size = Downsample.bucket_size(len(data), points)
+        ret = []
+        for i in xrange(0, len(data), size):
+            vals = [d['val'] for d in data[i:i+size] if d['val'] is not None]
+            ret.append(dict(ts=data[i]['ts'],
+                val=reduce_vals(vals) if vals else None))
+        return ret
+
+    @staticmethod
+    def bucket_columns(data, points, cf='average'):
+        """Columnar version of buckets()."""
+        if cf not in ('average', 'min', 'max'):
+            raise ValueError('invalid consolidation function: %s' % cf)
+
+        val, mask = data.column('val')
+        if val.dtype.kind not in 'iuf':
+            val = val.astype(numpy.float64)
+        starts = numpy.arange(0, len(data),
+            Downsample.bucket_size(len(data), points))
+        counts = numpy.add.reduceat(mask.astype(numpy.int64), starts)
+
+        if cf == 'average':
+            sums = numpy.add.reduceat(
+                numpy.where(mask, val, 0).astype(numpy.float64), starts)
+            vals = sums / numpy.maximum(counts, 1)
         else:
-            #print 'verify: filling'
-            return list(Fill.generate_filled_series(start_bin,end_bin,freq,data))
+            if val.dtype.kind == 'f':
+                pad = numpy.inf if cf == 'min' else -numpy.inf
+            else:
+                info = numpy.iinfo(val.dtype)
+                pad = info.max if cf == 'min' else info.min
+            ufunc = numpy.minimum if cf == 'min' else numpy.maximum
+            vals = ufunc.reduceat(
+                numpy.where(mask, val, pad).astype(val.dtype), starts)
+
+        return ColumnarSeries(data.ts[starts],
+            OrderedDict([('val', (vals, counts > 0))]))
+
+    @staticmethod
+    def lttb(data, points):
+        """Reduce the list of rows data to points of its valid rows with
+        Largest-Triangle-Three-Buckets."""
+        data = [d for d in data if d['val'] is not None]
+        if len(data) <= points:
+            return data
+        x = [float(d['ts']) for d in data]
+        y = [float(d['val']) for d in data]
+        return [data[i] for i in Downsample._lttb_index(x, y, points)]
+
+    @staticmethod
+    def lttb_columns(data, points):
+        """Columnar version of lttb()."""
+        val, mask = data.column('val')
+        valid = numpy.flatnonzero(mask)
+        if len(valid) <= points:
+            return data.take(valid)
+        x = data.ts[valid].astype(numpy.float64)
+        y = val[valid].astype(numpy.float64)
+        return data.take(valid[Downsample._lttb_index_array(x, y, points)])
+
+    @staticmethod
+    def _lttb_bounds(n, points):
+        """Generator of the (start, end) of the bucket to pick a point in
+        and of the next bucket for each of the points - 2 buckets the rows 
+        between the first and the last one are split in."""
+        every = (n - 2) / float(points - 2)
+        for i in xrange(points - 2):
+            start = int(i * every) + 1
+            end = int((i + 1) * every) + 1
+            yield start, end, end, min(int((i + 2) * every) + 1, n)
+
+    @staticmethod
+    def _lttb_index(x, y, points):
+        """Return the indexes of the points picked by lttb()."""
+        a = 0
+        picked = [0]
+        for start, end, next_start, next_end in \
+                Downsample._lttb_bounds(len(x), points):
+            n_next = float(next_end - next_start)
+            avg_x = sum(x[next_start:next_end]) / n_next
+            avg_y = sum(y[next_start:next_end]) / n_next
+            best, best_area = start, -1
+            for i in xrange(start, end):
+                area = abs((x[a] - avg_x) * (y[i] - y[a]) -
+                    (x[a] - x[i]) * (avg_y - y[a]))
+                if area > best_area:
+                    best, best_area = i, area
+            a = best
+            picked.append(a)
+        picked.append(len(x) - 1)
+        return picked
+
+    @staticmethod
+    def _lttb_index_array(x, y, points):
+        """numpy version of _lttb_index()."""
+        a = 0
+        picked = numpy.zeros(points, dtype=numpy.int64)
+        for n, (start, end, next_start, next_end) in enumerate(
+                Downsample._lttb_bounds(len(x), points)):
+            avg_x = x[next_start:next_end].mean()
+            avg_y = y[next_start:next_end].mean()
+            area = numpy.abs((x[a] - avg_x) * (y[start:end] - y[a]) -
+                (x[a] - x[start:end]) * (avg_y - y[a]))
+            a = start + int(area.argmax())
+            picked[n + 1] = a
+        picked[-1] = len(x) - 1
+        return picked
 
 
 def fit_to_bins(freq, ts_prev, val_prev, ts_curr, val_curr):
@@ -337,3 +738,117 @@ def fit_to_bins(freq, ts_prev, val_prev, ts_curr, val_curr):
 
     return updates
 
+def _round_half_away(x):
+    """Vectorized version of python 2's round() to zero digits: halfway
+    cases are rounded away from zero based on the exact float value."""
+    a = numpy.abs(x)
+    r = numpy.floor(a)
+    r += (a - r) >= 0.5
+    return numpy.where(x < 0, -r, r)
+
+def fit_to_bins_batch(freq, ts_prev, val_prev, ts_curr, val_curr):
+    """Batch version of fit_to_bins for many measurements at once.
+
+    ts_prev, val_prev, ts_curr and val_curr are equal length sequences
+    describing one measurement each.  The return value is a tuple of three
+    equal length sequences (index, bins, vals): each bin update is the
+    integer amount vals[i] to increment bin bins[i] by for measurement
+    number index[i].  For every measurement the updates are exactly the
+    ones fit_to_bins would return.
+
+    >>> index, bins, vals = fit_to_bins_batch(30, [0, 31], [0, 100], [30, 62], [100, 213])
+    >>> sorted(zip(list(index), list(bins), list(vals)))
+    [(0, 0, 100), (0, 30, 0), (1, 30, 106), (1, 60, 7)]
+
+    The work is done with numpy when it is available and the inputs are
+    integers that fit in 64 bits, otherwise this falls back to calling
+    fit_to_bins for each measurement.
+    """
+    if numpy is not None:
+        ts_prev = numpy.asarray(ts_prev)
+        val_prev = numpy.asarray(val_prev)
+        ts_curr = numpy.asarray(ts_curr)
+        val_curr = numpy.asarray(val_curr)
+
+        if all([a.dtype.kind == 'i' for a in
+                (ts_prev, val_prev, ts_curr, val_curr)]) \
+                and isinstance(freq, (int, long, numpy.integer)):
+            return _fit_to_bins_numpy(int(freq),
+                ts_prev.astype(numpy.int64), val_prev.astype(numpy.int64),
+                ts_curr.astype(numpy.int64), val_curr.astype(numpy.int64))
+
+    index, bins, vals = [], [], []
+    for i, args in enumerate(zip(ts_prev, val_prev, ts_curr, val_curr)):
+        for b, v in fit_to_bins(freq, *args).iteritems():
+            index.append(i)
+            bins.append(b)
+            vals.append(v)
+    return index, bins, vals
+
+def _fit_to_bins_numpy(freq, ts_prev, val_prev, ts_curr, val_curr):
+    """numpy implementation of fit_to_bins_batch.
+
+    Each measurement produces its bins in the order fit_to_bins builds its
+    list of fractions: bin_prev, bin_curr then the bin_mid bins.  The
+    remainder is handed out by the rank each bin would have after the
+    (stable) sort of that list, which is computed directly since all the
+    bin_mid bins share the same fraction.
+    """
+    assert (ts_curr > ts_prev).all()
+
+    bin_prev = ts_prev - (ts_prev % freq)
+    bin_mid = (ts_prev + freq) - (ts_prev % freq)
+    bin_curr = ts_curr - (ts_curr % freq)
+
+    delta_t = ts_curr - ts_prev
+    delta_v = val_curr - val_prev
+
+    same = bin_curr == bin_prev
+    n_mid = numpy.where(same, 0, (bin_curr - bin_mid) // freq)
+
+    dt = delta_t.astype(numpy.float64)
+    frac_prev = (bin_mid - ts_prev) / dt
+    frac_curr = (ts_curr - bin_curr) / dt
+    frac_mid = (bin_curr - bin_mid) / dt
+    n_div = numpy.maximum(n_mid, 1)
+    frac_per_mid = frac_mid / n_div
+
+    p = _round_half_away(frac_prev * delta_v).astype(numpy.int64)
+    c = _round_half_away(frac_curr * delta_v).astype(numpy.int64)
+    m = _round_half_away((frac_mid * delta_v) / n_div).astype(numpy.int64)
+    m = numpy.where(n_mid > 0, m, 0)
+
+    nbins = numpy.where(same, 1, 2 + n_mid)
+    remainder = numpy.where(same, 0, delta_v - (p + c + n_mid * m))
+
+    # Rank of bin_prev, bin_curr and the first bin_mid in the sorted
+    # fractions.  Positive remainders sort descending, negative ascending.
+    desc = remainder > 0
+    def before(a, b):
+        return numpy.where(desc, a > b, a < b).astype(numpy.int64)
+    rank_prev = before(frac_curr, frac_prev) + \
+        n_mid * before(frac_per_mid, frac_prev)
+    rank_curr = before(frac_prev, frac_curr) + \
+        n_mid * before(frac_per_mid, frac_curr) + (frac_prev == frac_curr)
+    rank_mid = before(frac_prev, frac_per_mid) + \
+        before(frac_curr, frac_per_mid) + (frac_prev == frac_per_mid) + \
+        (frac_curr == frac_per_mid)
+
+    per_bin, extra = numpy.divmod(numpy.abs(remainder), nbins)
+    incr = numpy.sign(remainder)
+
+    # Flatten to one entry per bin update.
+    index = numpy.repeat(numpy.arange(len(nbins)), nbins)
+    pos = numpy.arange(nbins.sum()) - numpy.repeat(numpy.cumsum(nbins) - nbins, nbins)
+
+    is_prev = pos == 0
+    is_curr = pos == 1
+    bins = numpy.where(is_prev, bin_prev[index],
+        numpy.where(is_curr, bin_curr[index], bin_mid[index] + (pos - 2) * freq))
+    vals = numpy.where(same[index], delta_v[index],
+        numpy.where(is_prev, p[index], numpy.where(is_curr, c[index], m[index])))
+    rank = numpy.where(is_prev, rank_prev[index],
+        numpy.where(is_curr, rank_curr[index], rank_mid[index] + pos - 2))
+    vals = vals + incr[index] * (per_bin[index] + (rank < extra[index]))
+
+    return index, bins, vals
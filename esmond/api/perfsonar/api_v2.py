@@ -42,7 +42,7 @@ from esmond.api.api_v2 import (DataObject, _get_ersatz_esmond_api_queryset,
 
 from esmond.api.perfsonar.types import *
 
-from esmond.cassandra import KEY_DELIMITER, CASSANDRA_DB, AGG_TYPES, ConnectionException, RawRateData, BaseRateBin, RawData, AggregationBin
+from esmond.cassandra import KEY_DELIMITER, get_timeseries_db, AGG_TYPES, ConnectionException, RawRateData, BaseRateBin, RawData, AggregationBin
 
 from esmond.config import get_config_path, get_config
 
@@ -57,7 +57,7 @@ log = get_logger(__name__)
 # Cassandra db connection
 #
 try:
-    db = CASSANDRA_DB(get_config(get_config_path()))
+    db = get_timeseries_db(get_config(get_config_path()))
     EVENT_TYPE_CF_MAP = {
             'histogram': db.raw_cf,
             'integer': db.rate_cf,
@@ -75,7 +75,7 @@ def check_connection():
     global db
     global EVENT_TYPE_CF_MAP;
     if not db:
-        db = CASSANDRA_DB(get_config(get_config_path()))
+        db = get_timeseries_db(get_config(get_config_path()))
         #
         # Column families
         #
@@ -846,7 +846,10 @@ class ArchiveViewset(mixins.CreateModelMixin,
         for subject_q in subject_qs:
             ret = ret.filter(subject_q)
         
-        return ret.distinct()
+        # ArchiveSerializer reads the subjects, event types and parameters
+        # of every row, fetch them up front rather than row by row.
+        return ret.distinct().select_related(*SUBJECT_MODEL_MAP.values()) \
+            .prefetch_related('pseventtypes', 'psmetadataparameters')
 
     def list(self, request):
         """Stub for list GET ie:
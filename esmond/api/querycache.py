@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Cache of time series query results for the REST api.
+
+Dashboards and the graphite finder keep asking for the same series over
+ranges that mostly end at the current time.  The bins of a series stop
+changing once they are some time in the past, so a QueryCache keeps the
+closed bins it has read for each series and only reads the bins it doesn't
+have from the db - normally just the most recent, still open, ones:
+
+* a series is keyed on its query: the name of the db query method, the
+  path, the frequency and the consolidation function,
+* a bin is closed when it ended settle seconds ago (see closed_until()),
+  and each series holds one contiguous range of closed bins,
+* a query within that range is a hit, a query starting inside it is a
+  partial hit (the bins after the range are read and the closed ones are
+  added to it) and anything else is a miss,
+* the cache holds at most max_points datapoints, evicting the least
+  recently used series first,
+* a series is read again once its oldest bins were read max_age seconds
+  ago,
+* query_many() answers a batch of queries with a single read of what
+  isn't cached, for the bulk endpoints,
+* stats() returns the hit, partial hit, miss and eviction counters.
+
+Data written through the REST api can land in closed bins so the series
+of the paths written to are dropped with invalidate().  That only reaches
+the cache of the process handling the write, the other processes serve
+the old bins for up to max_age seconds.
+"""
+# Standard
+import threading
+import time
+from collections import OrderedDict
+
+from esmond.series import ColumnarSeries
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _slice(data, ts_min, ts_max):
+    """Return the rows of data with a ts between ts_min and ts_max."""
+    if isinstance(data, ColumnarSeries):
+        start, stop = numpy.searchsorted(data.ts, [ts_min, ts_max + 1])
+        return data.take(slice(start, stop))
+    return [d for d in data if ts_min <= d['ts'] <= ts_max]
+
+def _concat(first, second):
+    if isinstance(first, ColumnarSeries):
+        return ColumnarSeries.concat([first, second])
+    return list(first) + list(second)
+
+class QueryCache(object):
+    """
+    Size bounded cache of the closed bins of query results.  See the
+    module docstring.
+    """
+    def __init__(self, max_points=1000000, settle=300, max_age=600):
+        self.max_points = max_points
+        self.settle = settle
+        self.max_age = max_age
+        self._series = OrderedDict()
+        self._points = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def closed_until(self, freq, now=None):
+        """
+        Return the last timestamp (in ms) of the closed bins of freq (in
+        ms): a bin is closed once it ended settle seconds ago.
+        """
+        if now is None:
+            now = time.time()
+        return int((now - self.settle) * 1000) - freq
+
+    def query(self, name, kwargs, read, now=None):
+        """
+        Return the result of the db query name with kwargs, which have
+        path, freq, ts_min and ts_max (all in ms) and optionally cf.
+        read(ts_min, ts_max) runs the query for another time range.
+        """
+        def read_many(queries):
+            return [read(kw['ts_min'], kw['ts_max']) for n, kw in queries]
+        return self.query_many([(name, kwargs)], read_many, now)[0]
+
+    def query_many(self, queries, read_many, now=None):
+        """
+        Return the results of a list of (name, kwargs) queries like query()
+        does.  What isn't cached is read with a single read_many() call,
+        which returns the results of a list of (name, kwargs) queries.
+        """
+        if now is None:
+            now = time.time()
+
+        # (key, entry, closed, kwargs, cached, index of the read)
+        plans = []
+        reads = []
+        for name, kwargs in queries:
+            key = (name, tuple(kwargs['path']), kwargs['freq'],
+                kwargs.get('cf'))
+            ts_min, ts_max = kwargs['ts_min'], kwargs['ts_max']
+            closed = self.closed_until(kwargs['freq'], now)
+
+            with self._lock:
+                entry = self._series.get(key)
+                if entry is not None:
+                    self._series[key] = self._series.pop(key)
+
+            cached = None
+            read_from = ts_min
+            if entry is not None and now < entry['time'] + self.max_age and \
+                    entry['lo'] <= ts_min <= entry['hi']:
+                cached = _slice(entry['data'], ts_min,
+                    min(ts_max, entry['hi']))
+                if ts_max <= entry['hi']:
+                    plans.append((key, entry, closed, kwargs, cached, None))
+                    continue
+                read_from = entry['hi'] + 1
+
+            plans.append((key, entry, closed, kwargs, cached, len(reads)))
+            reads.append((name, dict(kwargs, ts_min=read_from)))
+
+        results = read_many(reads) if reads else []
+
+        ret = []
+        for key, entry, closed, kwargs, cached, index in plans:
+            ts_min, ts_max = kwargs['ts_min'], kwargs['ts_max']
+            if index is None:
+                with self._lock:
+                    self.hits += 1
+                ret.append(cached)
+            elif cached is not None:
+                fresh = results[index]
+                with self._lock:
+                    self.partial_hits += 1
+                if closed > entry['hi']:
+                    hi = min(ts_max, closed)
+                    self._store(key, dict(lo=entry['lo'], hi=hi,
+                        time=entry['time'], data=_concat(entry['data'],
+                            _slice(fresh, entry['hi'] + 1, hi))), entry)
+                ret.append(_concat(cached, fresh))
+            else:
+                data = results[index]
+                with self._lock:
+                    self.misses += 1
+                if ts_min <= closed:
+                    hi = min(ts_max, closed)
+                    self._store(key, dict(lo=ts_min, hi=hi, time=now,
+                        data=_slice(data, ts_min, hi)), entry)
+                ret.append(data)
+        return ret
+
+    def _store(self, key, entry, replaces=None):
+        """
+        Set the series of key to entry unless another query changed it
+        since replaces was read.  The least recently used series are
+        evicted to make room.
+        """
+        if len(entry['data']) > self.max_points:
+            return
+
+        with self._lock:
+            current = self._series.get(key)
+            if current is not replaces:
+                return
+            if current is not None:
+                self._points -= len(current['data'])
+            self._series.pop(key, None)
+            self._series[key] = entry
+            self._points += len(entry['data'])
+
+            while self._points > self.max_points:
+                old_key, old = self._series.popitem(last=False)
+                self._points -= len(old['data'])
+                self.evictions += 1
+
+    def invalidate(self, path):
+        """Drop the cached series of path."""
+        path = tuple(path)
+        with self._lock:
+            for key in [k for k in self._series if k[1] == path]:
+                self._points -= len(self._series.pop(key)['data'])
+
+    def clear(self):
+        with self._lock:
+            self._series = OrderedDict()
+            self._points = 0
+
+    def stats(self):
+        """
+        Return a dict of the hit, partial hit, miss and eviction counters
+        and the number of series and datapoints held.
+        """
+        with self._lock:
+            return dict(hits=self.hits, partial_hits=self.partial_hits,
+                misses=self.misses, evictions=self.evictions,
+                series=len(self._series), points=self._points)
@@ -10,7 +10,9 @@ os.environ['ESMOND_UNIT_TESTS'] = 'True'
 from django.contrib.auth.models import User, Permission
 from django.contrib.contenttypes.models import ContentType
 from django.utils.timezone import now
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from esmond.api.models import PSEventTypes, UserIpAddress
 from esmond.api.perfsonar.types import *
@@ -412,6 +414,17 @@ class PSArchiveResourceTest(PSAPIBaseTest):
         self.assertMetadataCount(5, url, {OFFSET_FILTER: 5, LIMIT_FILTER: 5})
         self.assertMetadataCount(6, url, {OFFSET_FILTER: 10, LIMIT_FILTER: 10})
         
+    def test_get_metadata_list_query_count(self):
+        """The number of SQL queries does not grow with the page size."""
+        url = '/{0}/archive/'.format(PS_ROOT)
+
+        counts = []
+        for limit in (1, 5, 16):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertMetadataCount(limit, url, {LIMIT_FILTER: limit})
+            counts.append(len(queries))
+        self.assertEquals(counts, [counts[0]] * len(counts))
+
     def test_get_metadata_detail(self):
         url = '/{0}/archive/e99bbc44b7b041c7ad9e51dc6a053b8c/'.format(PS_ROOT)
         response = self.client.get(url)
@@ -24,7 +24,9 @@ from esmond.api.tests.example_data import (build_default_metadata,
     build_pdu_metadata, build_sample_inventory_from_metadata)
 from esmond.cassandra import AGG_TYPES
 from esmond.api import SNMP_NAMESPACE, OIDSET_INTERFACE_ENDPOINTS
-from esmond.api.dataseries import QueryUtil
+from esmond.api.dataseries import QueryUtil, Fill, Downsample
+from esmond.api.querycache import QueryCache
+from esmond.series import ColumnarSeries
 
 def datetime_to_timestamp(dt):
     return calendar.timegm(dt.timetuple())
@@ -324,9 +326,10 @@ class DeviceAPITests(DeviceAPITestsBase):
 
 class MockCASSANDRA_DB(object):
     def __init__(self, config):
-        pass
+        self.chunk_cache = None
 
-    def query_baserate_timerange(self, path=None, freq=None, ts_min=None, ts_max=None):
+    def query_baserate_timerange(self, path=None, freq=None, ts_min=None, ts_max=None,
+            columnar=False):
         # Mimic returned data, format elsehwere
         self._test_incoming_args(path, freq, ts_min, ts_max)
         if path[0] not in [SNMP_NAMESPACE] : return []
@@ -334,23 +337,34 @@ class MockCASSANDRA_DB(object):
         s_bin = (ts_min/freq)*freq
         if s_bin < ts_min:
             s_bin += freq
-        return [
+        return self._result([
             {'is_valid': 2, 'ts': s_bin, 'val': 10},
             {'is_valid': 2, 'ts': s_bin+freq, 'val': 20},
             {'is_valid': 2, 'ts': s_bin+(freq*2), 'val': 40},
             {'is_valid': 0, 'ts': s_bin+(freq*3), 'val': 80}
-        ]
+        ], columnar)
 
-    def query_raw_data(self, path=None, freq=None, ts_min=None, ts_max=None):
+    def query_raw_data(self, path=None, freq=None, ts_min=None, ts_max=None,
+            columnar=False):
         if 'SentryPoll' in path:
             s_bin = (ts_min/freq)*freq
             e_bin = (ts_max/freq)*freq
             n_bins = (e_bin - s_bin) / freq
-            return [ {'ts': s_bin+(i*freq), 'val': 1200} for i in range(n_bins) ]
+            return self._result([ {'ts': s_bin+(i*freq), 'val': 1200} for i in range(n_bins) ],
+                columnar)
         else:
-            return self.query_baserate_timerange(path, freq, ts_min, ts_max)
+            return self.query_baserate_timerange(path, freq, ts_min, ts_max, columnar)
+
+    def query_aggregation_timerange(self, path=None, freq=None, ts_min=None, ts_max=None, cf=None,
+            columnar=False):
+        return self._result(self._aggregations(path, freq, ts_min, ts_max, cf), columnar)
 
-    def query_aggregation_timerange(self, path=None, freq=None, ts_min=None, ts_max=None, cf=None):
+    def _result(self, rows, columnar):
+        if columnar and rows is not None:
+            return ColumnarSeries.from_rows(rows)
+        return rows
+
+    def _aggregations(self, path=None, freq=None, ts_min=None, ts_max=None, cf=None):
         self._test_incoming_args(path, freq, ts_min, ts_max, cf)
         s_bin = (ts_min/freq)*freq
         if s_bin < ts_min:
@@ -376,6 +390,19 @@ class MockCASSANDRA_DB(object):
         else:
             pass
 
+    def query_many(self, queries, columnar=False):
+        return [getattr(self, 'query_{0}'.format(name))(columnar=columnar, **kwargs)
+            for name, kwargs in queries]
+
+    def iter_baserate_timerange(self, **kwargs):
+        return iter(self.query_baserate_timerange(**kwargs))
+
+    def iter_raw_data(self, **kwargs):
+        return iter(self.query_raw_data(**kwargs))
+
+    def iter_aggregation_timerange(self, **kwargs):
+        return iter(self.query_aggregation_timerange(**kwargs))
+
     def _test_incoming_args(self, path, freq, ts_min, ts_max, cf=None):
         assert isinstance(path, list)
         assert isinstance(freq, int)
@@ -583,6 +610,49 @@ class DeviceAPIDataTests(DeviceAPITestsBase):
         self.assertEquals(data['data'][2]['ts'], data['data'][0]['ts']+int(params['agg'])*2)
         self.assertEquals(data['data'][2]['val'], 300)
 
+    def test_get_device_interface_data_points(self):
+        url = '/v2/device/rtr_a/interface/xe-0@2F0@2F0/in'
+
+        # the interface is active from the start of the test on
+        end = int(time.time()) + 60
+        params = {'begin': end - 3600*3, 'end': end, 'points': 2}
+
+        # 3600 is the coarsest aggregation with 2 bins in 3 hours.
+        response = self.client.get(url, params)
+        self.assertEquals(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEquals(data['agg'], '3600')
+        self.assertEquals(len(data['data']), 2)
+        self.assertEquals(data['data'][1]['ts'] - data['data'][0]['ts'], 7200)
+        self.assertEquals([d['val'] for d in data['data']], [90.0, 240.0])
+
+        params['cf'] = 'max'
+        response = self.client.get(url, params)
+        data = json.loads(response.content)
+        self.assertEquals([d['val'] for d in data['data']], [150, 300])
+
+        # lttb only returns valid datapoints.
+        params = {'begin': end - 3600, 'end': end, 'points': 3,
+            'downsample': 'lttb'}
+        response = self.client.get(url, params)
+        data = json.loads(response.content)
+        self.assertEquals(data['agg'], '30')
+        self.assertEquals(len(data['data']), 3)
+        self.assertTrue(None not in [d['val'] for d in data['data']])
+
+        # graphite's name for it
+        params = {'begin': end - 3600, 'end': end, 'maxDataPoints': 10}
+        response = self.client.get(url, params)
+        self.assertEquals(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEquals(data['agg'], '30')
+        self.assertEquals(len(data['data']), 10)
+
+        for params in ({'points': 0}, {'points': 'many'},
+                {'points': 10, 'downsample': 'bogus'}):
+            response = self.client.get(url, params)
+            self.assertEquals(response.status_code, 400)
+
     def test_get_device_errors(self):
         url = '/v2/device/rtr_a/interface/xe-0@2F0@2F0/error/in'
 
@@ -748,6 +818,88 @@ class DeviceAPIDataTests(DeviceAPITestsBase):
         self.assertEquals(data['data'][1]['ts'], params['begin']+agg)
         self.assertEquals(data['data'][1]['val'], 20)
 
+    @mock.patch('esmond.api.api_v2.STREAM_MIN_POINTS', 100)
+    def test_timeseries_streaming(self):
+        agg = 30000
+        end = 1386090000000
+        params = {'begin': end - agg*110, 'end': end}
+
+        url = '/v2/timeseries/BaseRate/snmp/rtr_a/FastPollHC/ifHCInOctets/fxp0.0/{0}'.format(agg)
+
+        response = self.client.get(url, params)
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        data = json.loads(''.join(response.streaming_content))
+
+        self.assertEquals(data['cf'], 'average')
+        self.assertEquals(int(data['agg']), agg)
+        self.assertEquals(data['resource_uri'], url)
+        self.assertEquals(len(data['data']), 111)
+        self.assertEquals(data['data'][0]['ts'], params['begin'])
+        self.assertEquals(data['data'][1]['val'], 20)
+        self.assertEquals(data['data'][3]['val'], None)
+        self.assertEquals(data['data'][-1], {'ts': end, 'val': None})
+
+        # Smaller ranges and other formats are returned as a whole.
+        params['begin'] = end - agg*10
+        response = self.client.get(url, params)
+        self.assertFalse(response.streaming)
+
+        params['begin'] = end - agg*110
+        params['format'] = 'api'
+        response = self.client.get(url, params)
+        self.assertFalse(response.streaming)
+
+        # Streamed interface data.
+        url = '/v2/device/rtr_a/interface/xe-0@2F0@2F0/in'
+        end = (int(time.time())/30 + 1)*30 + 15
+        response = self.client.get(url, {'begin': end - 3600, 'end': end})
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        data = json.loads(''.join(response.streaming_content))
+        self.assertEquals(data['resource_uri'], url)
+        self.assertEquals(len(data['data']), 120)
+        self.assertEquals(data['data'][1]['val'], 20)
+
+    def test_timeseries_query_cache(self):
+        agg = 30000
+        params = APIDataTestResults.get_agg_range(agg, in_ms=True)
+
+        url = '/v2/timeseries/BaseRate/snmp/rtr_a/FastPollHC/ifHCInOctets/fxp0.0/{0}'.format(agg)
+
+        cache = QueryCache()
+        with mock.patch('esmond.api.api_v2._query_cache', cache):
+            response = self.client.get(url, params)
+            self.assertEquals(response.status_code, 200)
+            cached = self.client.get(url, params)
+            self.assertEquals(json.loads(cached.content), json.loads(response.content))
+        self.assertEquals(cache.stats()['misses'], 1)
+        self.assertEquals(cache.stats()['hits'], 1)
+
+    def test_timeseries_fill(self):
+        agg = 30000
+        params = APIDataTestResults.get_agg_range(agg, in_ms=True)
+        params['begin'] -= agg*2
+
+        url = '/v2/timeseries/BaseRate/snmp/rtr_a/FastPollHC/ifHCInOctets/fxp0.0/{0}'.format(agg)
+
+        params['fill'] = 'previous'
+        response = self.client.get(url, params)
+        self.assertEquals(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEquals([d['val'] for d in data['data']],
+            [10, 20, 40, 40, 40, 40])
+
+        params['fill'] = 'linear'
+        response = self.client.get(url, params)
+        data = json.loads(response.content)
+        self.assertEquals([d['val'] for d in data['data']],
+            [10, 20, 40, None, None, None])
+
+        params['fill'] = 'bogus'
+        response = self.client.get(url, params)
+        self.assertEquals(response.status_code, 400)
+
     def test_timeseries_data_aggs(self):
 
         agg = 3600000
@@ -929,8 +1081,12 @@ class DeviceAPIDataTests(DeviceAPITestsBase):
 
         url = '/v2/timeseries/RawData/snmp/rtr_a/FastPollHC/ifHCInOctets/fxp0.0/30000'
 
-        response = self.get_api_client(admin_auth=True).post(url, data=payload, format='json')
-        self.assertEquals(response.status_code, 201) # not 200!
+        # the cached chunks of the path written to are dropped
+        with mock.patch('esmond.api.api_v2.db.chunk_cache') as chunk_cache:
+            response = self.get_api_client(admin_auth=True).post(url, data=payload, format='json')
+            self.assertEquals(response.status_code, 201) # not 200!
+        chunk_cache.invalidate.assert_called_once_with(['snmp', 'rtr_a',
+            'FastPollHC', 'ifHCInOctets', 'fxp0.0'])
 
 
 class PDUAPITests(DeviceAPITestsBase):
@@ -1052,7 +1208,242 @@ class PDUAPIDataTests(DeviceAPITestsBase):
         response = self.client.get(url)
         self.assertEquals(response.status_code, 400)
 
+class QueryCacheTests(TestCase):
+    def setUp(self):
+        self.rows = [{'ts': ts, 'val': ts / 1000} for ts in range(0, 600000, 30000)]
+        self.reads = []
+
+    def _read(self, ts_min, ts_max):
+        self.reads.append((ts_min, ts_max))
+        return [r for r in self.rows if ts_min <= r['ts'] <= ts_max]
+
+    def _query(self, cache, ts_min, ts_max, now, path='rtr_a', read=None):
+        kwargs = dict(path=[SNMP_NAMESPACE, path], freq=30000, ts_min=ts_min,
+            ts_max=ts_max)
+        return cache.query('baserate_timerange', kwargs, read or self._read,
+            now=now)
+
+    def _expected(self, ts_min, ts_max):
+        return [r for r in self.rows if ts_min <= r['ts'] <= ts_max]
+
+    def test_query_cache(self):
+        cache = QueryCache(max_points=100, settle=60)
+
+        # Bins up to 510000 are closed 600s in.
+        self.assertEquals(self._query(cache, 0, 570000, 600), self.rows)
+        self.assertEquals(self._query(cache, 60000, 300000, 600),
+            self._expected(60000, 300000))
+        self.assertEquals(self.reads, [(0, 570000)])
+
+        # only the bins after the cached ones are read
+        self.assertEquals(self._query(cache, 120000, 570000, 660),
+            self._expected(120000, 570000))
+        self.assertEquals(self.reads[-1], (510001, 570000))
+        self.assertEquals(self._query(cache, 120000, 570000, 660),
+            self._expected(120000, 570000))
+        self.assertEquals(len(self.reads), 2)
+
+        # nothing closed to cache
+        self._query(cache, 600000, 700000, 600, path='rtr_b')
+        self.assertEquals(cache.stats(), dict(hits=2, partial_hits=1, misses=2,
+            evictions=0, series=1, points=20))
+
+        cache.invalidate([SNMP_NAMESPACE, 'rtr_a'])
+        self._query(cache, 0, 570000, 660)
+        self.assertEquals(self.reads[-1], (0, 570000))
+
+        # series are read again after max_age
+        self._query(cache, 0, 300000, 660 + cache.max_age - 1)
+        self.assertEquals(len(self.reads), 4)
+        self._query(cache, 0, 300000, 660 + cache.max_age)
+        self.assertEquals(self.reads[-1], (0, 300000))
+        self.assertEquals(self._query(cache, 0, 300000, 660 + cache.max_age),
+            self._expected(0, 300000))
+        self.assertEquals(len(self.reads), 5)
+
+    def test_query_cache_many(self):
+        cache = QueryCache(max_points=100, settle=60)
+        batches = []
+        def read_many(queries):
+            batches.append([(kw['path'][1], kw['ts_min'], kw['ts_max'])
+                for name, kw in queries])
+            return [self._read(kw['ts_min'], kw['ts_max'])
+                for name, kw in queries]
+        def query_many(queries, now):
+            return cache.query_many([('baserate_timerange',
+                dict(path=[SNMP_NAMESPACE, path], freq=30000, ts_min=ts_min,
+                    ts_max=ts_max)) for path, ts_min, ts_max in queries],
+                read_many, now=now)
+
+        self._query(cache, 0, 570000, 600)
+        ret = query_many([('rtr_a', 0, 300000), ('rtr_a', 120000, 570000),
+            ('rtr_b', 0, 570000)], 660)
+        self.assertEquals(ret, [self._expected(0, 300000),
+            self._expected(120000, 570000), self.rows])
+        # one read for all of the bins that weren't cached
+        self.assertEquals(batches, [[('rtr_a', 510001, 570000),
+            ('rtr_b', 0, 570000)]])
+        self.assertEquals(query_many([('rtr_b', 0, 300000)], 660),
+            [self._expected(0, 300000)])
+        self.assertEquals(len(batches), 1)
+
+    def test_query_cache_eviction(self):
+        cache = QueryCache(max_points=30, settle=60)
+        self._query(cache, 0, 570000, 660)
+        self._query(cache, 0, 570000, 660, path='rtr_b')
+        self.assertEquals(cache.stats()['evictions'], 1)
+        self.assertEquals(cache.stats()['points'], 20)
+        self._query(cache, 0, 570000, 660, path='rtr_b')
+        self.assertEquals(cache.stats()['hits'], 1)
+
+        # series longer than the cache are not kept
+        cache = QueryCache(max_points=10, settle=60)
+        self._query(cache, 0, 570000, 660)
+        self.assertEquals(cache.stats()['series'], 0)
+
+    def test_query_cache_columnar(self):
+        def read(ts_min, ts_max):
+            return ColumnarSeries.from_rows(self._read(ts_min, ts_max))
+
+        cache = QueryCache(settle=60)
+        self._query(cache, 0, 570000, 600, read=read)
+        ret = self._query(cache, 120000, 570000, 660, read=read)
+        self.assertTrue(isinstance(ret, ColumnarSeries))
+        self.assertEquals(ret, self._expected(120000, 570000))
+        self.assertEquals(self._query(cache, 90000, 560000, 660, read=read),
+            self._expected(90000, 560000))
+
+class ColumnarSeriesTests(TestCase):
+    def test_rows(self):
+        rows = [
+            {'ts': 30, 'val': 1.5, 'cf': 'min', 'm_ts': 31},
+            {'ts': 60, 'val': None, 'cf': 'min', 'm_ts': None},
+            {'ts': 90, 'val': 3.0, 'cf': 'min', 'm_ts': 95},
+        ]
+        series = ColumnarSeries.from_rows(rows)
+
+        self.assertEquals(series.constants, {'cf': 'min'})
+        self.assertEquals(series.column('val')[1].tolist(), [True, False, True])
+        self.assertEquals(len(series), 3)
+        self.assertEquals(series, rows)
+        self.assertEquals(list(series), rows)
+        self.assertEquals(series[-1], rows[-1])
+        self.assertEquals(series[1:], rows[1:])
+        self.assertEquals(json.loads(json.dumps(series.tolist())), rows)
+        self.assertRaises(IndexError, series.__getitem__, 3)
+
+        raw = ColumnarSeries.from_lists([1, 2], val=[{'a': 1}, [1, 2]])
+        self.assertEquals(raw, [{'ts': 1, 'val': {'a': 1}}, {'ts': 2, 'val': [1, 2]}])
+
+        # a column missing from a part is None in its rows
+        both = ColumnarSeries.concat([series, ColumnarSeries.from_rows(
+            [{'ts': 120, 'val': 4.0, 'cf': 'min'}]), ColumnarSeries([])])
+        self.assertEquals(both, rows + [{'ts': 120, 'val': 4.0, 'cf': 'min', 'm_ts': None}])
+        self.assertRaises(ValueError, ColumnarSeries.concat, [series,
+            ColumnarSeries.from_rows([{'ts': 120, 'val': 4.0, 'cf': 'max'}])])
+
+    def test_payload_and_fill(self):
+        rates = [
+            {'is_valid': 2, 'ts': 30000, 'val': 10.0},
+            {'is_valid': 0, 'ts': 60000, 'val': 20.0},
+            {'is_valid': 1, 'ts': 120000, 'val': 40.0},
+        ]
+        aggs = [
+            {'ts': 3600000, 'val': 0, 'cf': 'max', 'm_ts': 3602000},
+            {'ts': 7200000, 'val': 10, 'cf': 'max', 'm_ts': None},
+        ]
+        raw = [{'ts': 30500, 'val': 5}, {'ts': 61000, 'val': 6}]
+
+        for rows, kw in ((rates, {}), (rates, {'in_ms': True}), (aggs, {}),
+                (raw, {'coerce_to_bins': 30000})):
+            columns = QueryUtil.format_cassandra_data_payload(
+                ColumnarSeries.from_rows(rows), **kw)
+            self.assertTrue(isinstance(columns, ColumnarSeries))
+            self.assertEquals(columns, QueryUtil.format_cassandra_data_payload(rows, **kw))
+
+        data = QueryUtil.format_cassandra_data_payload(rates)
+        columns = ColumnarSeries.from_rows(data)
+        for begin, end in ((30, 120), (15, 150), (0, 300)):
+            self.assertEquals(Fill.verify_fill(begin, end, 30, columns),
+                Fill.verify_fill(begin, end, 30, data))
+
 class QueryUtilTests(TestCase):
+    def test_fill_policies(self):
+        data = [{'ts': 30, 'val': 1.0}, {'ts': 75, 'val': 7.0},
+            {'ts': 90, 'val': None}, {'ts': 150, 'val': 4.0}, {'ts': 400, 'val': 9.0}]
+        expected = {
+            'null': [None, 1.0, 7.0, None, None, 4.0, None],
+            'previous': [None, 1.0, 7.0, 7.0, 7.0, 4.0, 4.0],
+            'linear': [None, 1.0, 7.0, 6.0, 5.0, 4.0, None],
+        }
+        columns = ColumnarSeries.from_rows(data)
+        for policy, vals in expected.items():
+            ret = Fill.verify_fill(0, 180, 30, data, policy)
+            self.assertEquals(ret, [{'ts': ts, 'val': v}
+                for ts, v in zip(range(0, 181, 30), vals)])
+            self.assertEquals(Fill.verify_fill(0, 180, 30, columns, policy), ret)
+            self.assertEquals(list(Fill.iter_fill(0, 180, 30, iter(data), policy)), ret)
+
+        # off grid datapoints fill the bin they are in
+        data = [{'ts': 45, 'val': 1}, {'ts': 95, 'val': 2}, {'ts': 90, 'val': 3}]
+        self.assertEquals(Fill.verify_fill(0, 120, 30, data),
+            [{'ts': 0, 'val': None}, {'ts': 30, 'val': 1}, {'ts': 60, 'val': None},
+             {'ts': 90, 'val': 3}, {'ts': 120, 'val': None}])
+
+        # complete series are returned as is
+        data = [{'ts': 30, 'val': 1, 'm_ts': 31}, {'ts': 60, 'val': 2, 'm_ts': 62}]
+        self.assertTrue(Fill.verify_fill(30, 60, 30, data) is data)
+        self.assertRaises(ValueError, Fill.verify_fill, 30, 60, 30, data, 'bogus')
+
+    def test_iter_fill(self):
+        data = [{'ts': 60, 'val': 1}, {'ts': 90, 'val': 2}, {'ts': 150, 'val': 3}]
+
+        self.assertEquals(list(Fill.iter_fill(45, 150, 30, iter(data))),
+            Fill.verify_fill(45, 150, 30, data))
+        self.assertEquals(list(Fill.iter_fill(30, 180, 30, iter(data))),
+            Fill.verify_fill(30, 180, 30, data))
+        self.assertEquals(list(Fill.iter_fill(30, 180, 30, iter([]))),
+            Fill.verify_fill(30, 180, 30, []))
+
+    def test_downsample(self):
+        self.assertEquals(Downsample.choose_agg(0, 86400, 10, [30, 3600, 86400]), 3600)
+        self.assertEquals(Downsample.choose_agg(0, 3600, 10, [30, 3600, 86400]), 30)
+        self.assertEquals(Downsample.choose_agg(0, 60, 10, [30, 3600, 86400]), 30)
+
+        data = [{'ts': ts, 'val': v} for ts, v in
+            zip(range(0, 300, 30), [1, None, 3, 8, None, None, 2, 4, 6, 5])]
+        columns = ColumnarSeries.from_rows(data)
+        expected = {
+            'average': [1.0, 5.5, None, 3.0, 5.5],
+            'min': [1, 3, None, 2, 5],
+            'max': [1, 8, None, 4, 6],
+        }
+        for cf, vals in expected.items():
+            ret = Downsample.downsample(data, 5, 'bucket', cf)
+            self.assertEquals(ret, [{'ts': ts, 'val': v}
+                for ts, v in zip(range(0, 300, 60), vals)])
+            self.assertEquals(Downsample.downsample(columns, 5, 'bucket', cf), ret)
+        # buckets of 3 bins
+        self.assertEquals([d['ts'] for d in Downsample.downsample(data, 4)],
+            [0, 90, 180, 270])
+        self.assertTrue(Downsample.downsample(data, 10) is data)
+        self.assertRaises(ValueError, Downsample.downsample, data, 5, 'bogus')
+        self.assertRaises(ValueError, Downsample.downsample, data, 5, 'bucket', 'raw')
+
+        # lttb keeps the first, last and the peaks
+        data = [{'ts': ts*30, 'val': v} for ts, v in
+            enumerate([0, 1, 0, 9, 0, 1, None, -7, 1, 0, 1, 2])]
+        columns = ColumnarSeries.from_rows(data)
+        ret = Downsample.downsample(data, 4, 'lttb')
+        self.assertEquals([d['val'] for d in ret], [0, 9, -7, 2])
+        self.assertEquals(Downsample.downsample(columns, 4, 'lttb'), ret)
+        self.assertEquals(Downsample.downsample(data, 2, 'lttb'),
+            Downsample.downsample(data, 2, 'bucket'))
+
+        rows = [{'ts': ts*30, 'val': (ts*7) % 13} for ts in range(1000)]
+        self.assertEquals(Downsample.downsample(ColumnarSeries.from_rows(rows), 50, 'lttb'),
+            Downsample.downsample(rows, 50, 'lttb'))
+
     def test_coerce_to_bins(self):
         data_in = [
             {
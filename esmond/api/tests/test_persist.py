@@ -6,13 +6,17 @@ Replace this with more appropriate tests for your application.
 """
 
 import copy
+import errno
 import os
 import os.path
 import json
 import datetime
 import calendar
 import shutil
+import tempfile
+import threading
 import time
+import mock
 
 import pprint
 
@@ -23,7 +27,9 @@ os.environ['ESMOND_UNIT_TESTS'] = 'True'
 
 from collections import namedtuple
 
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.conf import settings
 
 from rest_framework.test import APIClient
@@ -31,13 +37,24 @@ from rest_framework.test import APIClient
 from esmond.api.models import Device, IfRef, ALUSAPRef, OIDSet, DeviceOIDSetMap
 
 from esmond.persist import IfRefPollPersister, ALUSAPRefPersister, \
-     PersistQueueEmpty, CassandraPollPersister
-from esmond.api.dataseries import fit_to_bins
+     PersistQueueEmpty, CassandraPollPersister, PersistQueue, MultiWorkerQueue, \
+     FilePersistQueue, MemcachedPersistQueue, PollResult, loads_result, \
+     FORMAT_MAGIC, HashRing, PollPersister, PersistAutoscaler, \
+     HANDOFF_TIMEOUT, msgpack, worker, get_persist_queue
+from esmond.api.dataseries import fit_to_bins, fit_to_bins_batch
 from esmond.config import get_config, get_config_path
-from esmond.cassandra import CASSANDRA_DB, SEEK_BACK_THRESHOLD
+from esmond.error import ConfigError
+from esmond.cassandra import CASSANDRA_DB, SEEK_BACK_THRESHOLD, get_timeseries_db, \
+     get_rowkey, RawRateData, RowKeyCache, _split_rowkey, \
+     MaximumRetryException, BaseRateBin
+from esmond.memdb import MemoryColumnFamily
+from esmond.chunkcache import ChunkCache
+from esmond.snapshot import CacheSnapshot
+from esmond.pipeline import WritePipeline, PipelinedMutator
+from esmond.series import ColumnarSeries
 from esmond.util import max_datetime
 
-from pycassa.columnfamily import ColumnFamily
+from pycassa.columnfamily import ColumnFamily, NotFoundException
 
 from esmond.api.tests.example_data import build_rtr_d_metadata, \
      build_metadata_from_test_data, load_test_data, build_rtr_alu_metadata
@@ -134,6 +151,30 @@ class TestPersistQueue(object):
         except IndexError:
             raise PersistQueueEmpty()
 
+class TestAssignedPersistQueue(PersistQueue):
+    """A PersistQueue that keeps the published worker assignments."""
+    def __init__(self, qname, assignments=None):
+        self.data = []
+        self.state = {}
+        if assignments is not None:
+            self.state['assignments'] = assignments
+        self.read = 0
+
+    def put(self, val):
+        self.data.append(val)
+
+    def write_position(self):
+        return len(self.data)
+
+    def read_position(self):
+        return self.read
+
+    def set_state(self, name, value):
+        self.state[name] = value
+
+    def get_state(self, name):
+        return self.state.get(name)
+
 class MockConfig(object):
     def __init__(self):
         self.profile_persister = False
@@ -878,6 +919,1124 @@ class TestCassandraPollPersister(TestCase):
         p.db.close()
 
 
+class TestDataContainers(TestCase):
+    def test_raw_rate_data(self):
+        path = ['snmp', 'rtr_d', 'FastPollHC', 'ifHCInOctets', 'xe-0:0']
+        d = RawRateData(path=path, ts=1343956814123, val=10, freq=30000)
+        self.assertEqual(d.ts_to_jstime(), 1343956814000)
+        self.assertEqual(d.ts_to_unixtime(), 1343956814)
+        self.assertEqual(d.ts, datetime.datetime(2012, 8, 3, 1, 20, 14, 123000))
+        self.assertEqual(d.get_key(), get_rowkey(path, freq=30000, year=2012))
+        self.assertEqual(d.get_meta_key(), get_rowkey(path, freq=30000))
+        self.assertEqual(d.get_document(), dict(path=path, ts=d.ts, val=10,
+            freq=30000))
+
+        # The cached keys follow changes to the key fields.
+        d.ts = datetime.datetime(2013, 1, 1)
+        self.assertEqual(d.ts_to_jstime(), 1356998400000)
+        self.assertEqual(d.get_key(), get_rowkey(path, freq=30000, year=2013))
+        d.freq = 60000
+        self.assertEqual(d.get_meta_key(), get_rowkey(path, freq=60000))
+
+class TestRowKeys(TestCase):
+    def test_rowkey_cache(self):
+        cache = RowKeyCache(maxsize=4)
+        path = ['snmp', 'rtr_d', 'FastPollHC', 'ifHCInOctets', 'xe-0:0']
+        key = cache.get(path, 30000, 2012)
+        self.assertEqual(key, 'snmp:rtr_d:FastPollHC:ifHCInOctets:xe-0\\:0:30000:2012')
+        self.assertTrue(cache.get(list(path), 30000, 2012) is key)
+        self.assertEqual(cache.get(path), 'snmp:rtr_d:FastPollHC:ifHCInOctets:xe-0\\:0')
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        for year in range(2000, 2010):
+            cache.get(path, 30000, year)
+        self.assertTrue(len(cache) <= 4)
+        self.assertEqual(get_rowkey(path, 30000, 2012), key)
+
+    def test_split_rowkey(self):
+        def split_slow(s, escape='\\'):
+            # The original character by character parser.
+            indices = []
+            for i in range(len(s)):
+                if s[i] == ':':
+                    if i > 0 and s[i-1] != escape:
+                        indices.append(i)
+                    elif i == 0:
+                        indices.append(i)
+            out = []
+            last = 0
+            for i in indices:
+                out.append(s[last:i].replace(escape, ""))
+                last = i+1
+            out.append(s[last:])
+            return out
+
+        for s in ('snmp:rtr_d:FastPollHC:ifHCInOctets:xe-0_0_0:30000:2012',
+                'snmp:rtr_d:FastPollHC:ifHCInOctets:xe-0\\:0:30000:2012',
+                ':a::b\\::c\\\\:', 'no_delimiter', '', 'a\\b:c\\d'):
+            self.assertEqual(_split_rowkey(s), split_slow(s))
+
+class TestMemoryColumnFamily(TestCase):
+    def test_standard_cf(self):
+        cf = MemoryColumnFamily('raw_data')
+        cf.insert('k', {3000: 'c', 1000: 'a'})
+        cf.insert('k', {2000: 'b'})
+
+        self.assertEqual(cf.get('k').items(),
+            [(1000, 'a'), (2000, 'b'), (3000, 'c')])
+        self.assertEqual(cf.get('k', column_start=1500, column_finish=3000).keys(),
+            [2000, 3000])
+        self.assertEqual(cf.get('k', column_start=2500, column_finish=1000,
+            column_reversed=True, column_count=1).keys(), [2000])
+        self.assertEqual(cf.get('k', column_finish='', column_reversed=True,
+            column_count=1).keys(), [3000])
+        self.assertRaises(NotFoundException, cf.get, 'k', column_start=4000)
+        self.assertRaises(NotFoundException, cf.get, 'missing')
+
+        ret = cf.multiget(['missing', 'k'], column_start=1000, column_finish=2000)
+        self.assertEqual(ret.keys(), ['k'])
+        self.assertEqual(cf.multiget_count(['missing', 'k'], column_start=2000),
+            {'missing': 0, 'k': 2})
+
+        cf.remove('k', columns=[2000])
+        self.assertEqual(cf.get('k').keys(), [1000, 3000])
+        cf.remove('k')
+        self.assertEqual(list(cf.get_range()), [])
+
+    def test_super_counter_cf(self):
+        cf = MemoryColumnFamily('base_rates', super=True, counter=True)
+        b = cf.batch(queue_size=2)
+        b.insert('k', {1000: {'val': 10, 'is_valid': 1}})
+        self.assertRaises(NotFoundException, cf.get, 'k')
+        b.insert('k', {1000: {'val': 5, 'is_valid': 1}})
+        # queue_size reached so the batch was sent.
+        self.assertEqual(cf.get('k')[1000], {'val': 15, 'is_valid': 2})
+        b.insert('k', {2000: {'val': 1, 'is_valid': 1}})
+        b.send()
+        self.assertEqual(cf.get('k', super_column=2000), {'val': 1, 'is_valid': 1})
+        self.assertEqual(cf.get('k').keys(), [1000, 2000])
+
+    def test_xget(self):
+        cf = MemoryColumnFamily('raw_data')
+        cf.insert('k', dict([(ts, str(ts)) for ts in range(0, 10000, 1000)]))
+
+        self.assertEqual([ts for ts, v in cf.xget('k', buffer_size=3)],
+            range(0, 10000, 1000))
+        self.assertEqual([ts for ts, v in cf.xget('k', column_start=2500,
+            column_finish=7000, buffer_size=2)], [3000, 4000, 5000, 6000, 7000])
+        self.assertEqual([ts for ts, v in cf.xget('k', column_count=4,
+            buffer_size=3)], [0, 1000, 2000, 3000])
+        self.assertEqual(list(cf.xget('missing')), [])
+
+        # Columns removed between pages are skipped.
+        cols = cf.xget('k', buffer_size=2)
+        self.assertEqual([cols.next()[0], cols.next()[0]], [0, 1000])
+        cf.remove('k', columns=[1000, 2000])
+        self.assertEqual([ts for ts, v in cols],
+            [3000, 4000, 5000, 6000, 7000, 8000, 9000])
+
+class TestMemoryPollPersister(TestCase):
+    fixtures = ['oidsets.json']
+
+    def setUp(self):
+        self.td = build_rtr_d_metadata()
+        self.ctr = CassandraTestResults()
+        self.config = get_config(get_config_path())
+        self.config.timeseries_backend = 'memory'
+        self.config.db_clear_on_testing = True
+        self.path = [SNMP_NAMESPACE,'rtr_d','FastPollHC','ifHCInOctets','fxp0.0']
+
+    def _persist(self, test_data, batch=None):
+        q = TestPersistQueue(test_data)
+        p = CassandraPollPersister(self.config, "test", persistq=q)
+        if batch:
+            results = [TestPollResult(d) for d in test_data]
+            for i in range(0, len(results), batch):
+                p.store_batch(results[i:i+batch])
+        else:
+            p.run()
+        p.db.flush()
+        p.db.close()
+        self.config.db_clear_on_testing = False
+        return p
+
+    def test_update_stat_aggregation(self):
+        """update_stat_aggregation() only updates the cache."""
+        db = get_timeseries_db(self.config)
+        # 2012-01-01 00:00 UTC
+        agg_ts = 1325376000 * 1000
+        def update(ts, val):
+            return db.update_stat_aggregation(RawRateData(path=self.path,
+                ts=agg_ts + ts, val=val, freq=30 * 1000), agg_ts,
+                3600 * 1000)
+
+        with mock.patch.object(db.stat_agg, 'insert') as insert:
+            self.assertTrue(update(0, 10))
+            self.assertTrue(not update(30000, 10))
+            self.assertTrue(update(60000, 20))
+            self.assertTrue(update(90000, 5))
+            self.assertTrue(not insert.called)
+
+        self.assertEqual(db.checkpoint_stat_aggregations(), 1)
+        db.flush()
+        ret = db.query_aggregation_timerange(path=self.path, freq=3600 * 1000,
+            ts_min=agg_ts, ts_max=agg_ts, cf='max')
+        self.assertEqual([r['val'] for r in ret], [20])
+        db.close()
+
+    def test_stop(self):
+        """The signal handler only stops the loop, run() flushes."""
+        test_data = load_test_data("rtr_d_ifhcin_long.json")
+        q = TestPersistQueue(test_data)
+        p = CassandraPollPersister(self.config, "test", persistq=q)
+        get = q.get
+        def stopping_get():
+            p.stop(None, None)
+            return get()
+        q.get = stopping_get
+        with mock.patch.object(p.db, 'flush', wraps=p.db.flush) as flush:
+            p.run()
+        self.assertEqual(flush.call_count, 1)
+        self.assertTrue(len(test_data) > 0)
+        p.db.close()
+
+    def _agg(self, db, cf):
+        return db.query_aggregation_timerange(path=self.path,
+            ts_min=(self.ctr.begin - 3600)*1000, ts_max=self.ctr.end*1000,
+            freq=self.ctr.agg_freq*1000, cf=cf)[0]
+
+    def test_persister_long(self):
+        """Memory backend produces the same results as cassandra."""
+        self._persist(load_test_data("rtr_d_ifhcin_long.json"))
+
+        db = get_timeseries_db(self.config)
+        start_time = self.ctr.begin*1000
+        end_time = self.ctr.end*1000
+
+        ret = db.query_baserate_timerange(path=self.path, freq=30*1000,
+            ts_min=start_time, ts_max=end_time)
+        self.assertEqual(len(ret), self.ctr.expected_results)
+        self.assertEqual(ret[0]['ts'], start_time)
+        self.assertEqual(ret[0]['val'], self.ctr.base_rate_val_first)
+        self.assertEqual(ret[-1]['ts'], end_time)
+        self.assertEqual(ret[-1]['val'], self.ctr.base_rate_val_last)
+
+        ret = db.query_raw_data(path=self.path, freq=30*1000,
+            ts_min=start_time, ts_max=end_time)
+        self.assertEqual(len(ret), self.ctr.expected_results - 1)
+        self.assertEqual(ret[0]['ts'], self.ctr.raw_ts_first*1000)
+        self.assertEqual(ret[0]['val'], self.ctr.raw_val_first)
+        self.assertEqual(ret[-1]['ts'], self.ctr.raw_ts_last*1000)
+        self.assertEqual(ret[-1]['val'], self.ctr.raw_val_last)
+
+        self.assertEqual(self._agg(db, 'average')['val'], self.ctr.agg_avg)
+        self.assertEqual(self._agg(db, 'raw')['val'], self.ctr.agg_raw)
+        ret = self._agg(db, 'min')
+        self.assertEqual(ret['val'], self.ctr.agg_min)
+        self.assertEqual(ret['m_ts'], self.ctr.agg_min_ts*1000)
+        ret = self._agg(db, 'max')
+        self.assertEqual(ret['val'], self.ctr.agg_max)
+        self.assertEqual(ret['m_ts'], self.ctr.agg_max_ts*1000)
+        self.assertEqual(ret['ts'], self.ctr.agg_ts*1000)
+
+    def test_columnar_query(self):
+        """Columnar query results match the lists of dicts."""
+        self._persist(load_test_data("rtr_d_ifhcin_long.json"))
+
+        db = get_timeseries_db(self.config)
+        kw = dict(path=self.path, freq=30*1000,
+            ts_min=self.ctr.begin*1000, ts_max=self.ctr.end*1000)
+        for cf in ('average', 'delta'):
+            ret = db.query_baserate_timerange(columnar=True, cf=cf, **kw)
+            self.assertTrue(isinstance(ret, ColumnarSeries))
+            self.assertEqual(ret, db.query_baserate_timerange(cf=cf, **kw))
+        self.assertEqual(db.query_raw_data(columnar=True, **kw),
+            db.query_raw_data(**kw))
+
+        kw.update(ts_min=(self.ctr.begin - 3600)*1000,
+            freq=self.ctr.agg_freq*1000)
+        for cf in ('average', 'raw', 'min', 'max'):
+            self.assertEqual(db.query_aggregation_timerange(columnar=True, cf=cf, **kw),
+                db.query_aggregation_timerange(cf=cf, **kw))
+
+    def test_paged_range_query(self):
+        """Range queries page through the rows of every year in the range."""
+        db = get_timeseries_db(self.config)
+        path = [SNMP_NAMESPACE, 'rtr_d', 'FastPollHC', 'ifHCInOctets', 'xe-0']
+        # 2011-12-31 23:00 to 2012-01-01 01:00 UTC.
+        begin = 1325372400 * 1000
+        ts_list = range(begin, begin + 7200 * 1000, 30 * 1000)
+        for ts in ts_list:
+            db.set_raw_data(RawRateData(path=path, ts=ts, val=ts / 1000,
+                freq=30 * 1000))
+        db.flush()
+
+        with mock.patch('esmond.cassandra.QUERY_PAGE_SIZE', 7):
+            ret = db.query_raw_data(path=path, freq=30 * 1000,
+                ts_min=begin, ts_max=ts_list[-1])
+            self.assertEqual([r['ts'] for r in ret], ts_list)
+            self.assertEqual(ret[-1]['val'], ts_list[-1] / 1000)
+
+            rows = db.iter_raw_data(path=path, freq=30 * 1000,
+                ts_min=begin + 60 * 1000, ts_max=ts_list[-1])
+            self.assertEqual(rows.next()['ts'], begin + 60 * 1000)
+
+            # column_count limits each yearly row
+            ret = db.query_raw_data(path=path, freq=30 * 1000,
+                ts_min=begin, ts_max=ts_list[-1], column_count=10)
+            self.assertEqual([r['ts'] for r in ret],
+                ts_list[:10] + ts_list[120:130])
+        db.close()
+
+    def test_query_many(self):
+        """Batched queries match single queries with fewer round trips."""
+        db = get_timeseries_db(self.config)
+        paths = [[SNMP_NAMESPACE, 'rtr_d', 'FastPollHC', 'ifHCInOctets', i]
+            for i in ('xe-0', 'xe-1', 'xe-2')]
+        # 2011-12-31 23:00 to 2012-01-01 01:00 UTC.
+        begin = 1325372400 * 1000
+        ts_list = range(begin, begin + 7200 * 1000, 30 * 1000)
+        for n, path in enumerate(paths[:2]):
+            for ts in ts_list:
+                db.set_raw_data(RawRateData(path=path, ts=ts, val=ts / 1000 + n,
+                    freq=30 * 1000))
+                db.update_rate_bin(BaseRateBin(path=path, ts=ts, val=30 * n,
+                    freq=30 * 1000))
+        db.flush()
+
+        queries = [(name, dict(path=path, freq=30 * 1000, ts_min=begin,
+                ts_max=ts_list[-1]))
+            for path in paths for name in ('raw_data', 'baserate_timerange')]
+        queries.append(('raw_data', dict(path=paths[0], freq=30 * 1000,
+            ts_min=begin, ts_max=ts_list[-1], column_count=10)))
+        queries.append(('aggregation_timerange', dict(path=paths[0],
+            freq=3600 * 1000, ts_min=begin, ts_max=ts_list[-1], cf='max')))
+
+        cf = db.raw_data._column_family
+        with mock.patch.object(cf, 'multiget', wraps=cf.multiget) as multiget:
+            ret = db.query_many(queries)
+            # one read for the raw data rows of every path
+            self.assertEqual(multiget.call_count, 2)
+
+        for (name, kwargs), r in zip(queries, ret):
+            self.assertEqual(r, getattr(db, 'query_' + name)(**kwargs))
+        self.assertEqual(len(ret[0]), len(ts_list))
+        self.assertEqual(ret[2][-1]['val'], ts_list[-1] / 1000 + 1)
+        self.assertEqual(ret[4], [])
+        self.assertEqual(len(ret[6]), 20)
+
+        # rows with more columns than expected are read to the end
+        with mock.patch('esmond.cassandra.MULTIGET_COLUMNS', 7):
+            ret = db.query_many(queries[:1])
+            self.assertEqual([r['ts'] for r in ret[0]], ts_list)
+
+        ret = db.query_many(queries, columnar=True)
+        self.assertTrue(isinstance(ret[0], ColumnarSeries))
+        self.assertEqual(ret[2], db.query_raw_data(**queries[2][1]))
+        db.close()
+
+    def test_chunk_cache(self):
+        """Closed chunks of a read are served from the chunk cache."""
+        db = get_timeseries_db(self.config)
+        path = [SNMP_NAMESPACE, 'rtr_d', 'FastPollHC', 'ifHCInOctets', 'xe-0']
+        # 2011-12-31 12:00 to 2012-01-01 12:00 UTC.
+        begin = 1325332800 * 1000
+        ts_list = range(begin, begin + 86400 * 1000, 300 * 1000)
+        for ts in ts_list:
+            db.update_rate_bin(BaseRateBin(path=path, ts=ts, val=ts / 100000,
+                freq=30 * 1000))
+        db.flush()
+
+        kwargs = dict(path=path, freq=30 * 1000, ts_min=begin + 1000,
+            ts_max=ts_list[-1] - 1000)
+        expected = db.query_baserate_timerange(**kwargs)
+        self.assertEqual(len(expected), len(ts_list) - 2)
+
+        db.chunk_cache = ChunkCache(tempfile.mkdtemp(), settle=300)
+        try:
+            cf = db.rates._column_family
+            with mock.patch.object(cf, 'xget', wraps=cf.xget) as xget:
+                self.assertEqual(db.query_baserate_timerange(**kwargs),
+                    expected)
+                # both daily chunks were read and saved
+                self.assertEqual(db.chunk_cache.stats(),
+                    dict(hits=0, misses=2))
+                xget.reset_mock()
+
+                self.assertEqual(db.query_baserate_timerange(**kwargs),
+                    expected)
+                self.assertEqual(list(db.iter_baserate_timerange(**kwargs)),
+                    expected)
+                self.assertEqual(db.query_many([('baserate_timerange',
+                    kwargs)]), [expected])
+                self.assertEqual(xget.call_count, 0)
+                self.assertEqual(db.chunk_cache.stats(),
+                    dict(hits=6, misses=2))
+
+            # the chunk of the current day is still open
+            now = int(time.time()) * 1000
+            rows = db.chunk_cache.rows('rate_aggregations', path, 30 * 1000,
+                now - 60000, now, lambda lo, hi: [(lo, 1), (hi, 2)])
+            self.assertEqual(list(rows), [(now - 60000, 1), (now, 2)])
+            self.assertEqual(db.chunk_cache.stats()['misses'], 2)
+
+            # empty chunks are saved, unless the path doesn't exist
+            files = lambda: [f for d, _, fs in os.walk(db.chunk_cache.directory)
+                for f in fs]
+            self.assertEqual(len(files()), 2)
+            self.assertEqual(db.query_baserate_timerange(path=path[:-1] +
+                ['bogus'], freq=30 * 1000, ts_min=begin - 5 * 86400 * 1000,
+                ts_max=ts_list[-1]), [])
+            self.assertEqual(len(files()), 2)
+            gap = dict(path=path, freq=30 * 1000,
+                ts_min=begin - 3 * 86400 * 1000, ts_max=begin - 1)
+            self.assertEqual(db.query_baserate_timerange(**gap), [])
+            self.assertEqual(len(files()), 5)
+            with mock.patch.object(cf, 'xget', wraps=cf.xget) as xget:
+                self.assertEqual(db.query_baserate_timerange(**gap), [])
+                self.assertEqual(xget.call_count, 0)
+
+                # chunks are read again after max_age
+                db.chunk_cache.max_age = -1
+                self.assertEqual(db.query_baserate_timerange(**kwargs),
+                    expected)
+                self.assertTrue(xget.call_count > 0)
+                db.chunk_cache.max_age = 86400
+
+            # the chunks of a path are dropped after writes to it
+            db.chunk_cache.invalidate(path)
+            self.assertEqual(files(), [])
+            with mock.patch.object(cf, 'xget', wraps=cf.xget) as xget:
+                self.assertEqual(db.query_baserate_timerange(**kwargs),
+                    expected)
+                self.assertTrue(xget.call_count > 0)
+        finally:
+            shutil.rmtree(db.chunk_cache.directory)
+        db.close()
+
+    def test_store_batch(self):
+        """Storing several results per batch gives the same results."""
+        self._persist(load_test_data("rtr_d_ifhcin_long.json"), batch=16)
+
+        db = get_timeseries_db(self.config)
+        ret = db.query_baserate_timerange(path=self.path, freq=30*1000,
+            ts_min=self.ctr.begin*1000, ts_max=self.ctr.end*1000)
+        self.assertEqual(len(ret), self.ctr.expected_results)
+        self.assertEqual(ret[0]['val'], self.ctr.base_rate_val_first)
+        self.assertEqual(ret[-1]['val'], self.ctr.base_rate_val_last)
+
+        self.assertEqual(self._agg(db, 'average')['val'], self.ctr.agg_avg)
+        self.assertEqual(self._agg(db, 'min')['val'], self.ctr.agg_min)
+        self.assertEqual(self._agg(db, 'max')['val'], self.ctr.agg_max)
+
+    def test_agg_cache_restart(self):
+        """A new persister seeds its aggregation cache from stored data."""
+        self._persist(load_test_data("rtr_d_ifhcin_long.json"))
+
+        test_data = load_test_data("rtr_d_ifhcin_long.json")
+        for i in test_data:
+            for ii in i.get('data'):
+                ii[1] = ii[1]*2
+        p = self._persist(test_data)
+
+        self.assertEqual(self._agg(p.db, 'max')['val'], self.ctr.agg_max*2)
+
+    def test_stat_coalescing(self):
+        """Each stat aggregation bin is written once."""
+        test_data = load_test_data("rtr_d_ifhcin_long.json")
+        p = CassandraPollPersister(self.config, "test",
+            persistq=TestPersistQueue(test_data))
+        writes = []
+        insert = p.db.stat_agg.insert
+        def counting_insert(key, cols, ttl=None):
+            writes.extend([(key, ts) for ts in cols])
+            insert(key, cols, ttl=ttl)
+        p.db.stat_agg.insert = counting_insert
+
+        p.run()
+        p.db.flush()
+        self.assertTrue(writes)
+        self.assertEqual(len(writes), len(set(writes)))
+        self.assertEqual(p.db._stat_pending, {})
+
+        self.assertEqual(self._agg(p.db, 'min')['val'], self.ctr.agg_min)
+        self.assertEqual(self._agg(p.db, 'max')['val'], self.ctr.agg_max)
+
+    def test_rate_accumulation(self):
+        """Rate aggregation increments are summed per bin before writing."""
+        p = CassandraPollPersister(self.config, "test",
+            persistq=TestPersistQueue(load_test_data("rtr_d_ifhcin_long.json")))
+        writes = []
+        insert = p.db.aggs.insert
+        def counting_insert(key, cols, ttl=None):
+            writes.extend([(key, ts) for ts in cols])
+            insert(key, cols, ttl=ttl)
+        p.db.aggs.insert = counting_insert
+
+        p.run()
+        p.db.flush()
+        self.assertEqual(len(writes), len(set(writes)))
+        self.assertEqual(p.db._rate_pending, {})
+        self.assertEqual(self._agg(p.db, 'average')['val'], self.ctr.agg_avg)
+
+        # closed bins are written as soon as the next bin starts
+        key = 'snmp:rtr_d:FastPollHC:ifHCInOctets:xe-0_2_0:3600000:2012'
+        writes[:] = []
+        p.db.accumulate_rate_aggregations({key: {0: {'val': 1, '30000': 1}}})
+        p.db.accumulate_rate_aggregations({key: {0: {'val': 2, '30000': 1}}})
+        self.assertEqual(writes, [])
+        p.db.accumulate_rate_aggregations({key: {3600000: {'val': 4, '30000': 1}}})
+        self.assertEqual(writes, [(key, 0)])
+        p.db.flush()
+        self.assertEqual(writes, [(key, 0), (key, 3600000)])
+        self.assertEqual(p.db.aggs._column_family.get(key, super_column=0),
+            {'val': 3, '30000': 2})
+
+    def test_warm_up(self):
+        """warm_up() seeds the metadata cache from the SQL inventory."""
+        test_data = load_test_data("rtr_d_ifhcin_long.json")
+        build_metadata_from_test_data(test_data)
+        ifnames = set([x[0][-1] for x in test_data[0]['data']])
+        self._persist(test_data)
+
+        oidset = OIDSet.objects.get(name='FastPollHC')
+        oidset.poller_args = 'correlator=IfNameCorrelator aggregates=3600,86400'
+        oidset.save()
+
+        q = TestAssignedPersistQueue('test', ['FastPollHC:rtr_d'])
+        p = CassandraPollPersister(self.config, "test", persistq=q)
+        self.assertEqual(len(p.db.metadata_cache), 0)
+        p.warm_up(ts=self.ctr.raw_ts_last + 30)
+
+        # Only the measurements with stored data are seeded.
+        self.assertEqual(len(p.db.metadata_cache), len(ifnames))
+        meta = p.db.metadata_cache[get_rowkey(self.path, 30*1000)]
+        self.assertEqual(meta['last_val'], self.ctr.raw_val_last)
+        self.assertEqual(meta['last_update'],
+            datetime.datetime.utcfromtimestamp(self.ctr.raw_ts_last))
+
+        # Without published assignments a worker of a multi worker queue
+        # can't tell which devices it owns.
+        p = CassandraPollPersister(self.config, "test",
+            persistq=TestPersistQueue([]))
+        p.warm_up(ts=self.ctr.raw_ts_last + 30)
+        self.assertEqual(len(p.db.metadata_cache), 0)
+
+    def test_drop_unassigned(self):
+        """Cached state of devices moved to another worker is dropped."""
+        q = TestAssignedPersistQueue('test', ['FastPollHC:rtr_d'])
+        p = self._persist(load_test_data("rtr_d_ifhcin_long.json"))
+        p.persistq = q
+        p.drop_unassigned()
+        n_meta = len(p.db.metadata_cache)
+        self.assertTrue(n_meta > 0 and len(p.db.aggregation_cache) > 0)
+
+        q.set_assignments(['FastPollHC:rtr_d', 'FastPollHC:rtr_x'])
+        p.drop_unassigned()
+        self.assertEqual(len(p.db.metadata_cache), n_meta)
+
+        q.set_assignments(['FastPollHC:rtr_x'])
+        p.drop_unassigned()
+        self.assertEqual(len(p.db.metadata_cache), 0)
+        self.assertEqual(len(p.db.aggregation_cache), 0)
+
+    def test_cache_snapshot(self):
+        """A restarted persister reloads its caches from persist_cache_dir."""
+        self.config.persist_cache_dir = tempfile.mkdtemp()
+        try:
+            # store_batch() only appends to the journal, like a worker 
+            # that was killed before writing a snapshot.
+            p = self._persist(load_test_data("rtr_d_ifhcin_long.json"), batch=16)
+            self.assertTrue(len(p.db.metadata_cache) > 0)
+
+            p2 = CassandraPollPersister(self.config, "test",
+                persistq=TestPersistQueue([]))
+            self.assertEqual(p2.db.metadata_cache, p.db.metadata_cache)
+            self.assertEqual(p2.db.aggregation_cache, p.db.aggregation_cache)
+
+            # The journal was compacted into a snapshot on start up.
+            p3 = CassandraPollPersister(self.config, "test",
+                persistq=TestPersistQueue([]))
+            self.assertEqual(p3.db.metadata_cache, p.db.metadata_cache)
+            self.assertEqual(p3.db.aggregation_cache, p.db.aggregation_cache)
+        finally:
+            shutil.rmtree(self.config.persist_cache_dir)
+
+class TestFilePersistQueue(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _results(self, n, start=0):
+        return [PollResult('FastPollHC', 'rtr_d', 'ifHCInOctets', 
+            1343956800 + i, [[['ifHCInOctets', 'xe-0_0_0'], i]], {})
+            for i in range(start, start + n)]
+
+    def test_put_get(self):
+        q = FilePersistQueue('test', self.dir)
+        self.assertEqual(q.get(), None)
+        self.assertEqual(q.get_many(10, timeout=0), [])
+
+        q.put_many(self._results(5))
+        q.put(self._results(1, start=5)[0])
+
+        r = q.get_many(4, timeout=0)
+        self.assertEqual([x.timestamp for x in r], 
+            [1343956800, 1343956801, 1343956802, 1343956803])
+        self.assertEqual(r[0].data, [[['ifHCInOctets', 'xe-0_0_0'], 0]])
+
+        # A new reader continues where the last one stopped.
+        q = FilePersistQueue('test', self.dir)
+        self.assertEqual(q.get().timestamp, 1343956804)
+        self.assertEqual(q.get(block=True, timeout=0.1).timestamp, 1343956805)
+        self.assertEqual(q.get(block=True, timeout=0.1), None)
+
+    def test_short_writes(self):
+        """Short and failed writes don't leave partial records."""
+        q = FilePersistQueue('test', self.dir)
+        write = os.write
+        def short_write(fd, data):
+            return write(fd, data[:10])
+        with mock.patch('os.write', side_effect=short_write):
+            q.put_many(self._results(3))
+
+        calls = []
+        def failing_write(fd, data):
+            calls.append(fd)
+            if len(calls) > 1:
+                raise OSError(errno.ENOSPC, 'No space left on device')
+            return write(fd, data[:10])
+        with mock.patch('os.write', side_effect=failing_write):
+            self.assertRaises(OSError, q.put_many, self._results(2, start=3))
+
+        q.put_many(self._results(1, start=5))
+        self.assertEqual([x.timestamp - 1343956800
+            for x in q.get_many(10, timeout=0)], [0, 1, 2, 5])
+
+    def test_segments(self):
+        FilePersistQueue.SEGMENT_SIZE = 512
+        try:
+            w = FilePersistQueue('test', self.dir)
+            for i in range(20):
+                w.put_many(self._results(5, start=i*5))
+            self.assertTrue(len(w._segments()) > 1)
+
+            # A restarted writer starts a new segment.
+            FilePersistQueue('test', self.dir).put_many(
+                self._results(5, start=100))
+
+            r = FilePersistQueue('test', self.dir)
+            ts = [x.timestamp - 1343956800 for x in r.get_many(1000, timeout=0)]
+            self.assertEqual(ts, range(105))
+            self.assertEqual(len(r._segments()), 1)
+        finally:
+            FilePersistQueue.SEGMENT_SIZE = 64 * 1024 * 1024
+
+    def test_formats(self):
+        """Writers using different formats can share a queue."""
+        formats = ['json', 'marshal']
+        if msgpack is not None:
+            formats.append('msgpack')
+        for i, fmt in enumerate(formats):
+            FilePersistQueue('test', self.dir, result_format=fmt).put_many(
+                self._results(2, start=i*2))
+
+        r = FilePersistQueue('test', self.dir).get_many(100, timeout=0)
+        self.assertEqual(len(r), len(formats) * 2)
+        for i, result in enumerate(r):
+            self.assertEqual(result.timestamp, 1343956800 + i)
+            self.assertEqual(result.oid_name, 'ifHCInOctets')
+            self.assertEqual(list(result.data[0][0]), ['ifHCInOctets', 'xe-0_0_0'])
+            self.assertEqual(result.data[0][1], i)
+
+        self.assertRaises(ConfigError, FilePersistQueue, 'test', self.dir,
+            result_format='bogus')
+        self.assertRaises(ValueError, loads_result, FORMAT_MAGIC + '\x7f\x01')
+
+    def test_state(self):
+        q = FilePersistQueue('test', self.dir)
+        self.assertEqual(q.get_assignments(), None)
+        q.set_assignments(['FastPollHC:rtr_d'])
+        q.set_state('weight', 0.5)
+        q = FilePersistQueue('test', self.dir)
+        self.assertEqual(q.get_assignments(), ['FastPollHC:rtr_d'])
+        self.assertEqual(q.get_state('weight'), 0.5)
+
+    def test_positions(self):
+        w = FilePersistQueue('test', self.dir)
+        r = FilePersistQueue('test', self.dir)
+        self.assertEqual(w.write_position(), None)
+        w.put_many(self._results(3))
+        fence = w.write_position()
+        self.assertTrue(r.read_position() is None)
+        r.get_many(2, timeout=0)
+        self.assertTrue(r.read_position() < fence)
+        w.put_many(self._results(3, start=3))
+        r.get_many(1, timeout=0)
+        self.assertTrue(r.read_position() >= fence)
+        self.assertTrue(r.read_position() < w.write_position())
+
+    def test_blocking_get(self):
+        r = FilePersistQueue('test', self.dir)
+        self.assertEqual(r.get_many(10, timeout=0), [])
+
+        w = FilePersistQueue('test', self.dir)
+        t = threading.Timer(0.2, w.put_many, args=[self._results(3)])
+        t.start()
+        t0 = time.time()
+        self.assertEqual(len(r.get_many(10, timeout=10)), 3)
+        self.assertTrue(time.time() - t0 < 5)
+        t.join()
+
+class DictMemcache(object):
+    """Stands in for memcache.Client with a dict."""
+    def __init__(self):
+        self.d = {}
+
+    def get(self, k):
+        return self.d.get(k)
+
+    def set(self, k, v):
+        self.d[k] = v
+        return True
+
+    def incr(self, k, delta=1):
+        self.d[k] += delta
+        return self.d[k]
+
+    def delete(self, k):
+        self.d.pop(k, None)
+
+    def get_multi(self, keys):
+        return dict([(k, self.d[k]) for k in keys if k in self.d])
+
+    def set_multi(self, mapping):
+        self.d.update(mapping)
+        return []
+
+    def delete_multi(self, keys):
+        for k in keys:
+            self.d.pop(k, None)
+        return True
+
+class TestMemcachedPersistQueue(TestCase):
+    def setUp(self):
+        self.q = MemcachedPersistQueue('test', '127.0.0.1:0')
+        self.q.mc = DictMemcache()
+        self.q.reset()
+
+    def _results(self, n, start=0):
+        return [PollResult('FastPollHC', 'rtr_d', 'ifHCInOctets', 
+            1343956800 + i, [[['ifHCInOctets', 'xe-0_0_0'], i]], {})
+            for i in range(start, start + n)]
+
+    def test_put_get_many(self):
+        self.q.put_many(self._results(5))
+        self.q.put(self._results(1, start=5)[0])
+        self.assertEqual(len(self.q), 6)
+
+        r = self.q.get_many(4)
+        self.assertEqual([x.timestamp - 1343956800 for x in r], [0, 1, 2, 3])
+        self.assertEqual(self.q.get().timestamp - 1343956800, 4)
+        self.assertEqual([x.timestamp - 1343956800 for x in self.q.get_many(4)],
+            [5])
+        self.assertEqual(self.q.get_many(4), [])
+        self.assertEqual(len(self.q), 0)
+        # Everything that was read has been deleted.
+        self.assertEqual(sorted(self.q.mc.d.keys()), 
+            sorted([self.q.last_added, self.q.last_read]))
+
+    def test_missing(self):
+        self.q.put_many(self._results(4))
+        # 2 was lost, 4 and 5 are allocated but not written yet.
+        self.q.mc.delete(self.q._key(2))
+        self.q.mc.incr(self.q.last_added, 2)
+
+        # Reading stops at the first missing item until it times out.
+        r = self.q.get_many(10)
+        self.assertEqual([x.timestamp - 1343956800 for x in r], [0])
+        self.assertEqual(self.q.get_many(10), [])
+
+        self.q.mc.set(self.q._key(5), self._results(1, start=4)[0].json())
+        self.assertEqual(self.q.get_many(10), [])
+
+        # Items that never show up are skipped after MISSING_TIMEOUT.
+        self.q.MISSING_TIMEOUT = -1
+        self.assertEqual([x.timestamp - 1343956800 for x in 
+            self.q.get_many(10)], [2, 3, 4])
+        self.assertEqual(len(self.q), 0)
+
+        # Items allocated after a gap was noticed get a timeout of their own.
+        self.q.put_many(self._results(1, start=5))
+        self.q.mc.delete(self.q._key(7))
+        self.assertEqual(self.q.get_many(10), [])
+        self.assertEqual(self.q.get_many(10), [])
+        self.assertEqual(len(self.q), 0)
+
+    def test_bad_item(self):
+        """An item that can't be deserialized doesn't lose the others."""
+        self.q.put_many(self._results(3))
+        self.q.mc.set(self.q._key(2), dict(bogus=1))
+        r = self.q.get_many(10)
+        self.assertEqual([x.timestamp - 1343956800 for x in r], [0, 2])
+        self.assertEqual(len(self.q), 0)
+        self.assertEqual(sorted(self.q.mc.d.keys()), 
+            sorted([self.q.last_added, self.q.last_read]))
+
+class TestWritePipeline(TestCase):
+    def _cf(self, name='test', **kw):
+        return MemoryColumnFamily(name, **kw)
+
+    def test_ordered_sends(self):
+        cf = self._cf()
+        pipeline = WritePipeline(threads=4, window=2)
+        m = PipelinedMutator(cf.batch(), pipeline, 3)
+        for i in range(100):
+            m.insert('row', {0: i})
+        m.send()
+        pipeline.flush()
+        self.assertEqual(cf.get('row'), {0: 99})
+        self.assertEqual(pipeline.stats()['sent'], 34)
+
+    def test_counters(self):
+        cf = self._cf(super=True, counter=True)
+        pipeline = WritePipeline(threads=4, window=4)
+        m = PipelinedMutator(cf.batch(), pipeline, 2, ordered=False)
+        for i in range(100):
+            m.insert('row', {0: {'val': 1}})
+        m.send()
+        pipeline.flush()
+        self.assertEqual(cf.get('row', super_column=0), {'val': 100})
+
+    def test_back_pressure(self):
+        release = threading.Event()
+        pipeline = WritePipeline(threads=1, window=1)
+        pipeline.submit('a', release.wait)
+
+        t = threading.Thread(target=pipeline.submit, args=('a', lambda: None))
+        t.start()
+        t.join(0.2)
+        self.assertTrue(t.is_alive())
+
+        release.set()
+        t.join(5)
+        self.assertTrue(not t.is_alive())
+        pipeline.flush()
+        stats = pipeline.stats()
+        self.assertEqual(stats['stalls'], 1)
+        self.assertTrue(stats['max'] >= stats['p99'] >= stats['p50'] > 0)
+
+    def test_errors(self):
+        def fail():
+            raise MaximumRetryException('test')
+        log = mock.Mock()
+        pipeline = WritePipeline(log=log)
+        pipeline.submit('a', fail)
+        pipeline.submit('a', lambda: None)
+        # logged with the failed send, not raised in later callers
+        pipeline.flush()
+        self.assertEqual(pipeline.stats()['errors'], 1)
+        self.assertEqual(pipeline.stats()['sent'], 2)
+        self.assertEqual(log.error.call_count, 1)
+        self.assertTrue('MaximumRetryException' in log.error.call_args[0][0])
+
+class TestCacheSnapshot(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_journal(self):
+        snap = CacheSnapshot(self.path)
+        self.assertEqual(snap.load(), ({}, {}))
+        snap.write({'a': {'last_val': 1}}, {})
+        snap.append({'a': {'last_val': 2}}, {'x': {1000: {'min': 1}}})
+        snap.append({'b': {'last_val': 3}}, {})
+        snap.close()
+
+        self.assertEqual(CacheSnapshot(self.path).load(),
+            ({'a': {'last_val': 2}, 'b': {'last_val': 3}},
+             {'x': {1000: {'min': 1}}}))
+
+        # A torn record at the end of the journal is ignored.
+        with open(self.path + '.journal', 'ab') as fp:
+            fp.write('\x00\x00\x01\x00partial')
+        self.assertEqual(CacheSnapshot(self.path).load()[0]['a'],
+            {'last_val': 2})
+
+    def test_stale_journal(self):
+        """A journal older than the snapshot isn't replayed."""
+        snap = CacheSnapshot(self.path)
+        snap.write({}, {})
+        snap.append({'a': {'last_val': 1}}, {})
+        snap.close()
+        journal = open(self.path + '.journal', 'rb').read()
+
+        snap = CacheSnapshot(self.path)
+        snap.load()
+        snap.write({'a': {'last_val': 2}}, {})
+        snap.close()
+        open(self.path + '.journal', 'wb').write(journal)
+
+        self.assertEqual(CacheSnapshot(self.path).load()[0],
+            {'a': {'last_val': 2}})
+
+class TestMultiWorkerQueue(TestCase):
+    def test_publish_assignments(self):
+        mwq = MultiWorkerQueue('test', TestAssignedPersistQueue, None, 2)
+        mwq.ASSIGNMENT_INTERVAL = -1
+        for device in ('rtr_a', 'rtr_b', 'rtr_c'):
+            mwq.put(TestPollResult(dict(oidset_name='FastPollHC',
+                device_name=device, oid_name='ifHCInOctets',
+                timestamp=0, data=[[['ifHCInOctets', 'xe-0_0_0'], 1]])))
+
+        assigned = []
+        for name, q in mwq.queues.items():
+            keys = q.get_assignments() or []
+            self.assertEqual(len(q.data), len(keys))
+            assigned.extend(keys)
+        self.assertEqual(sorted(assigned), ['FastPollHC:rtr_a',
+            'FastPollHC:rtr_b', 'FastPollHC:rtr_c'])
+
+    def _put_devices(self, mwq, n):
+        for i in range(n):
+            mwq.put(TestPollResult(dict(oidset_name='FastPollHC',
+                device_name='rtr_%d' % i, oid_name='ifHCInOctets',
+                timestamp=0, data=[[['ifHCInOctets', 'xe-0_0_0'], 1]])))
+
+    def test_deterministic(self):
+        """Assignments don't depend on the order keys are seen in."""
+        a = MultiWorkerQueue('test', TestAssignedPersistQueue, None, 4)
+        b = MultiWorkerQueue('test', TestAssignedPersistQueue, None, 4)
+        self._put_devices(a, 200)
+        keys = a.worker_map.keys()
+        keys.reverse()
+        for k in keys:
+            oidset_name, device_name = k.split(':', 1)
+            b.put(TestPollResult(dict(oidset_name=oidset_name,
+                device_name=device_name, oid_name='ifHCInOctets',
+                timestamp=0, data=[])))
+        self.assertEqual(a.worker_map, b.worker_map)
+        # every worker gets a share
+        self.assertEqual(len(set(a.worker_map.values())), 4)
+
+    def test_ring_movement(self):
+        keys = ['FastPollHC:rtr_%d' % i for i in range(1000)]
+        ring = HashRing(dict([(i, 1.0) for i in range(1, 5)]))
+        before = dict([(k, ring.get(k)) for k in keys])
+
+        # adding a worker only moves keys to the new worker
+        ring.set_weight(5, 1.0)
+        after = dict([(k, ring.get(k)) for k in keys])
+        moved = [k for k in keys if before[k] != after[k]]
+        self.assertTrue(all([after[k] == 5 for k in moved]))
+        self.assertTrue(100 < len(moved) < 300)
+
+        # and removing it puts them back
+        ring.remove(5)
+        self.assertEqual(before, dict([(k, ring.get(k)) for k in keys]))
+
+        # lowering a weight only moves keys away from that worker
+        ring.set_weight(1, 0.5)
+        after = dict([(k, ring.get(k)) for k in keys])
+        for k in keys:
+            if before[k] != after[k]:
+                self.assertEqual(before[k], 1)
+        counts = [after.values().count(i) for i in range(1, 5)]
+        self.assertTrue(counts[0] < min(counts[1:]))
+
+    def test_rebalance(self):
+        mwq = MultiWorkerQueue('test', TestAssignedPersistQueue, None, 2)
+        self._put_devices(mwq, 200)
+        before = dict(mwq.worker_map)
+
+        now = time.time()
+        mwq.queues['test_1'].set_state('load', dict(time=now, latency=0.004))
+        mwq.queues['test_2'].set_state('load', dict(time=now, latency=0.001))
+        mwq.rebalance()
+
+        self.assertTrue(mwq.ring.weights[1] < 1.0 < mwq.ring.weights[2])
+        self.assertEqual(mwq.queues['test_1'].get_state('weight'),
+            mwq.ring.weights[1])
+        moved = [k for k in before if before[k] != mwq.worker_map[k]]
+        self.assertTrue(moved)
+        self.assertTrue(all([before[k] == 1 for k in moved]))
+
+        # the published assignments follow the moved keys
+        for w in (1, 2):
+            self.assertEqual(
+                sorted(mwq.queues['test_%d' % w].get_assignments()),
+                sorted([k for k, v in mwq.worker_map.items() if v == w]))
+
+        # a restarted espolld picks up the saved weights
+        queues = mwq.queues
+        qtype = lambda qname, uri: queues[qname]
+        restarted = MultiWorkerQueue('test', qtype, None, 2)
+        self.assertEqual(restarted.ring.weights, mwq.ring.weights)
+
+    def test_membership(self):
+        """Workers added or removed by the autoscaler take over keys
+        through handoffs."""
+        queues = {}
+        def qtype(qname, uri):
+            return queues.setdefault(qname, TestAssignedPersistQueue(qname))
+
+        queues['test'] = TestAssignedPersistQueue('test')
+        queues['test'].set_state('workers', [1, 2])
+        mwq = MultiWorkerQueue('test', qtype, None, 2, max_workers=3)
+        self.assertEqual(sorted(mwq.ring.weights), [1, 2])
+        self._put_devices(mwq, 200)
+        before = dict(mwq.worker_map)
+
+        queues['test'].set_state('workers', [1, 2, 3])
+        mwq.check_membership()
+        moved = [k for k in before if before[k] != mwq.worker_map[k]]
+        self.assertTrue(moved)
+        self.assertTrue(all([mwq.worker_map[k] == 3 for k in moved]))
+
+        handoffs = queues['test_3'].get_state('handoff')
+        self.assertEqual(sorted([k for h in handoffs for k in h['keys']]),
+            sorted(moved))
+        for h in handoffs:
+            self.assertEqual(h['position'],
+                len(queues[h['queue']].data))
+        self.assertEqual(queues['test_3'].get_state('retired'), None)
+
+        # removing the worker moves the keys back and retires it
+        mwq.put(TestPollResult(dict(oidset_name='FastPollHC',
+            device_name=moved[0].split(':')[1], oid_name='ifHCInOctets',
+            timestamp=0, data=[])))
+        queues['test'].set_state('workers', [1, 2])
+        mwq.check_membership()
+        self.assertEqual(mwq.worker_map, before)
+        self.assertEqual(queues['test_3'].get_state('retired'),
+            dict(position=len(queues['test_3'].data)))
+
+class TestHandoff(TestCase):
+    def _result(self, device):
+        return TestPollResult(dict(oidset_name='FastPollHC',
+            device_name=device, oid_name='ifHCInOctets', timestamp=0,
+            data=[]))
+
+    def test_check_handoffs(self):
+        old = TestAssignedPersistQueue('test_1')
+        q = TestAssignedPersistQueue('test_2')
+        q.set_state('handoff', [dict(id='a', queue='test_1', position=5,
+            keys=['FastPollHC:rtr_a'], time=time.time())])
+        p = PollPersister(MockConfig(), 'test_2', q)
+        p.handoff_sources['test_1'] = old
+        p.HANDOFF_CHECK_INTERVAL = -1
+
+        a1, b1, a2 = [self._result(d) for d in ('rtr_a', 'rtr_b', 'rtr_a')]
+        self.assertEqual(p.check_handoffs([a1, b1]), [b1])
+        old.read = 4
+        self.assertEqual(p.check_handoffs([a2]), [])
+        old.read = 5
+        self.assertEqual(p.check_handoffs([]), [a1, a2])
+        self.assertEqual(p.handoffs_done, set(['a']))
+
+        # a retired worker stops once it has caught up
+        q.set_state('retired', dict(position=2))
+        self.assertEqual(p.check_handoffs([]), [])
+        self.assertTrue(not p.drained)
+        q.read = 2
+        p.check_handoffs([])
+        self.assertTrue(p.drained)
+
+        # so does one whose queue was empty when it was retired
+        q = TestAssignedPersistQueue('test_3')
+        q.read = None
+        q.set_state('retired', dict(position=None))
+        p = PollPersister(MockConfig(), 'test_3', q)
+        p.HANDOFF_CHECK_INTERVAL = -1
+        p.check_handoffs([])
+        self.assertTrue(p.drained)
+
+    def test_timeout(self):
+        q = TestAssignedPersistQueue('test_2')
+        q.set_state('handoff', [dict(id='a', queue='test_1', position=5,
+            keys=['FastPollHC:rtr_a'], time=time.time() - HANDOFF_TIMEOUT - 1)])
+        p = PollPersister(MockConfig(), 'test_2', q)
+        p.handoff_sources['test_1'] = TestAssignedPersistQueue('test_1')
+        a = self._result('rtr_a')
+        self.assertEqual(p.check_handoffs([a]), [a])
+
+class TestPersistAutoscaler(TestCase):
+    def test_decide(self):
+        a = PersistAutoscaler.__new__(PersistAutoscaler)
+        a.min_workers, a.max_workers = 2, 4
+        a.workers = set([1, 2])
+        self.assertEqual(a.decide({}, {}), 2)
+        self.assertEqual(a.decide({}, {1: 0.9, 2: 0.85}), 3)
+        self.assertEqual(a.decide({1: 20000, 2: 0}, {}), 3)
+        self.assertEqual(a.decide({}, {1: 0.1, 2: 0.1}), 2)
+        a.workers = set([1, 2, 3, 4])
+        self.assertEqual(a.decide({}, {1: 0.9, 2: 0.9, 3: 0.9, 4: 0.9}), 4)
+        self.assertEqual(a.decide({}, {1: 0.2, 2: 0.3, 3: 0.1, 4: 0.2}), 3)
+        self.assertEqual(a.decide({1: 5000}, {1: 0.2, 2: 0.3, 3: 0.1, 4: 0.2}), 4)
+
+    def test_restart(self):
+        """Restarting with fewer workers hands their keys off."""
+        config = MockConfig()
+        config.espersistd_uri = 'FilePersistQueue:' + tempfile.mkdtemp()
+        config.persist_queues = {'test': ('CassandraPollPersister', 2)}
+        try:
+            a = PersistAutoscaler(config, 'test', 1, 4)
+            self.assertEqual(a.workers, set([1, 2]))
+            self.assertEqual(a.retiring, set())
+
+            # espolld spreads the devices over the workers
+            mwq = MultiWorkerQueue('test', get_persist_queue,
+                config.espersistd_uri, 2, max_workers=4)
+            mwq.put_many([PollResult('FastPollHC', 'rtr_%d' % i,
+                'ifHCInOctets', 0, [], {}) for i in range(50)])
+            on_2 = sorted([k for k, w in mwq.worker_map.items() if w == 2])
+            self.assertTrue(on_2)
+
+            config.persist_queues = {'test': ('CassandraPollPersister', 1)}
+            a = PersistAutoscaler(config, 'test', 1, 4)
+            self.assertEqual(a.workers, set([1]))
+            self.assertEqual(a.retiring, set([2]))
+            self.assertEqual(a.control.get_state('workers'), [1])
+
+            queues = a.members.queues
+            handoffs = queues['test_1'].get_state('handoff')
+            self.assertEqual(sorted([k for h in handoffs for k in h['keys']]),
+                on_2)
+            self.assertEqual(queues['test_2'].get_state('retired'),
+                dict(position=queues['test_2'].write_position()))
+        finally:
+            shutil.rmtree(config.espersistd_uri.split(':', 1)[1])
+
+class TestWorker(TestCase):
+    def _run(self, persist_queues, persist_autoscale, qname, number):
+        config = MockConfig()
+        config.persist_queues = persist_queues
+        config.persist_autoscale = persist_autoscale
+        config.syslog_facility = None
+        config.syslog_priority = None
+        opts = mock.Mock(debug=True, qname=qname, number=number)
+        with mock.patch('esmond.persist.init_logging'), \
+                mock.patch('esmond.persist.setproctitle') as setproctitle, \
+                mock.patch('esmond.persist.CassandraPollPersister') as klass:
+            worker('espersistd.worker', config, opts)
+        klass.return_value.run.assert_called_once_with()
+        return setproctitle.call_args[0][0], klass.call_args[0][1]
+
+    def test_worker(self):
+        """worker() runs the persister class of its queue."""
+        self.assertEqual(self._run(
+            {'cassandra': ('CassandraPollPersister', 1)}, {}, 'cassandra', ''),
+            ('espersistd.worker', 'cassandra'))
+        self.assertEqual(self._run(
+            {'cassandra': ('CassandraPollPersister', 1)},
+            {'cassandra': (1, 4)}, 'cassandra', '3'),
+            ('espersistd.worker_3', 'cassandra_3'))
+
 class BaseTestCase(TestCase):
     def setUp(self):
         """
@@ -1247,6 +2406,42 @@ class TestCassandraApiQueries(BaseTestCase):
         self.assertEquals(data['end_time'], self.ctr.end)
         self.assertEquals(data['begin_time'], self.ctr.begin)
 
+    def test_interface_bulk_get_fan_out(self):
+        """Test bulk interface results order and SQL query count."""
+
+        ifaces = ['xe-7/0/0.0', 'ge-9/1/0']
+        endpoints = ['in', 'out']
+
+        def post(devs):
+            payload = {
+                'interfaces': devs,
+                'endpoint': endpoints,
+                'begin': self.ctr.begin,
+                'end': self.ctr.end
+            }
+            with CaptureQueriesContext(connection) as queries:
+                response = self.get_api_client().post('/v2/bulk/interface/',
+                    data=payload, format='json')
+            return response, len(queries)
+
+        response, n_single = post([{'device': 'rtr_d', 'iface': ifaces[0]}])
+        self.assertEquals(response.status_code, 201)
+
+        response, n_bulk = post([{'device': 'rtr_d', 'iface': i} for i in ifaces])
+        self.assertEquals(response.status_code, 201)
+        # the metadata is read with the same queries for any number of
+        # interfaces.
+        self.assertEquals(n_single, n_bulk)
+
+        data = json.loads(response.content)
+        self.assertEquals([(d['path']['iface'], d['path']['endpoint']) for d in data['data']],
+            [(i, e) for i in ifaces for e in endpoints])
+        for d in data['data']:
+            self.assertEquals(len(d['data']), 21)
+
+        response, n = post([{'device': 'rtr_nonexistent', 'iface': ifaces[0]}])
+        self.assertEquals(response.status_code, 400)
+
     def test_timeseries_bulk_get(self):
         """Test bulk interface: /bulk/timeseries/"""
         # Last/frequency element not quoted since json is going to return
@@ -1615,6 +2810,31 @@ class TestFitToBins(TestCase):
         self.assertEqual({1386369690000: 249747233}, r)
         self.assertLess(time.time()-t0, 0.5)
 
+    def test_fit_to_bins_batch(self):
+        """Batch results match fit_to_bins for every measurement."""
+        cases = [
+            (0, 0, 30, 100),
+            (31, 100, 62, 213),
+            (90, 100, 121, 200),
+            (89, 100, 181, 200),
+            (15, 0, 45, 1),      # exact .5 fractions
+            (15, 0, 45, 3),
+            (10, 0, 20, 5),      # same bin
+            (29, 500, 151, 400), # negative delta
+            (1, 0, 301, 7),      # remainder over many mid bins
+        ]
+        ts_prev, val_prev, ts_curr, val_curr = zip(*cases)
+
+        index, bins, vals = fit_to_bins_batch(30, ts_prev, val_prev,
+            ts_curr, val_curr)
+
+        r = {}
+        for i, b, v in zip(index, bins, vals):
+            r.setdefault(int(i), {})[int(b)] = int(v)
+
+        for i, case in enumerate(cases):
+            self.assertEqual(fit_to_bins(30, *case), r[i])
+
 class TestCassandraApiQueriesALU(BaseTestCase):
     fixtures = ['oidsets.json']
 
@@ -47,15 +47,22 @@ esmond schema in json-like notation:
 import ast
 import calendar
 import datetime
+import itertools
 import json
 import logging
 import os
 import pprint
+import re
 import sys
 import time
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from esmond.util import get_logger
+from esmond.snapshot import CacheSnapshot
+from esmond.chunkcache import ChunkCache
+from esmond.pipeline import WritePipeline, PipelinedMutator
+from esmond.series import ColumnarSeries
 
 # Third party
 from pycassa import PycassaLogger
@@ -65,9 +72,18 @@ from pycassa.system_manager import *
 
 from thrift.transport.TTransport import TTransportException
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 SEEK_BACK_THRESHOLD = 2592000000 # 30 days in ms
 KEY_DELIMITER = ":"
+ROWKEY_CACHE_SIZE = 200000
 AGG_TYPES = ['average', 'min', 'max', 'raw']
+QUERY_PAGE_SIZE = 1000
+# Most columns read by one multiget() round trip of query_many().
+MULTIGET_COLUMNS = 100000
 
 class CassandraException(Exception):
     """Common base"""
@@ -79,7 +95,20 @@ class ConnectionException(CassandraException):
     def __str__(self):
         return repr(self.value)
         
-class CASSANDRA_DB(object):
+class TimeSeriesStore(object):
+    """
+    Backend agnostic time series store.
+
+    All of the persister and query logic lives here and talks to four
+    column family batch objects - self.raw_data, self.rates, self.aggs and
+    self.stat_agg.  These follow the pycassa batch (CfMutator) interface:
+    insert(), remove() and send() for writes and a ._column_family attribute
+    exposing get(), multiget(), multiget_count(), xget() and get_range() for
+    reads.
+
+    Subclasses implement _setup_column_families() to connect to the actual
+    storage engine and set those four attributes.
+    """
     
     raw_cf = 'raw_data'
     rate_cf = 'base_rates'
@@ -88,12 +117,10 @@ class CASSANDRA_DB(object):
     
     _queue_size = 200
     
-    def __init__(self, config, qname=None, timeout=30):
+    def __init__(self, config, qname=None):
         """
-        Class contains all the relevent cassandra logic.  This includes:
+        Class contains all the relevent storage logic.  This includes:
         
-        * schema creation,
-        * connection information/pooling, 
         * generating the metadata cache of last val/ts information,
         * store data/update the rate/aggregaion bins,
         * and execute queries to return data to the REST interface.
@@ -111,128 +138,14 @@ class CASSANDRA_DB(object):
             handle = logging.StreamHandler()
             handle.setFormatter(format)
             self.log.addHandler(handle)
-        
-        # Add pycassa driver logging to existing logger.
-        plog = PycassaLogger()
-        plog.set_logger_name('%s.pycassa' % self.log.name)
-        # Debug level is far too noisy, so just hardcode the pycassa 
-        # logger to info level.
-        plog.set_logger_level('info')
 
-        # Connect to cassandra with SystemManager, do a schema check 
-        # and set up schema components if need be.
         if ast.literal_eval(os.environ.get('ESMOND_UNIT_TESTS', 'False')):
             print '*** Using test keyspace'
             self.keyspace = 'test_{0}'.format(config.cassandra_keyspace)
         else:
             self.keyspace = config.cassandra_keyspace
 
-        try:
-            sysman = SystemManager(config.cassandra_servers[0])                              
-        except TTransportException, e:
-            raise ConnectionException("System Manager can't connect to Cassandra "
-                "at %s - %s" % (config.cassandra_servers[0], e))
-        
-        # Blow everything away if we're testing - be aware of this and use
-        # with care.  Currently just being explictly set in test harness
-        # code but no longer set as a config file option since there could
-        # be unfortunate side effects.
-        if config.db_clear_on_testing:
-            self.log.info('Dropping keyspace %s' % self.keyspace)
-            if self.keyspace in sysman.list_keyspaces():
-                sysman.drop_keyspace(self.keyspace)
-                time.sleep(3)
-        # Create keyspace
-        
-        _schema_modified = False # Track if schema components are created.
-        
-        if not self.keyspace in sysman.list_keyspaces():
-            _schema_modified = True
-            self.log.info('Creating keyspace %s' % self.keyspace)
-            sysman.create_keyspace(self.keyspace, SIMPLE_STRATEGY, 
-                {'replication_factor': str(config.cassandra_replicas)})
-            time.sleep(3)
-        # Create column families if they don't already exist.
-        # If a new column family is added, make sure to set 
-        # _schema_modified = True so it will be propigated.
-        self.log.info('Checking/creating column families')
-        # Raw Data CF
-        if not sysman.get_keyspace_column_families(self.keyspace).has_key(self.raw_cf):
-            _schema_modified = True
-            sysman.create_column_family(self.keyspace, self.raw_cf, super=False, 
-                    comparator_type=LONG_TYPE, 
-                    default_validation_class=UTF8_TYPE,
-                    key_validation_class=UTF8_TYPE,
-                    compaction_strategy='LeveledCompactionStrategy')
-            self.log.info('Created CF: %s' % self.raw_cf)
-        # Base Rate CF
-        if not sysman.get_keyspace_column_families(self.keyspace).has_key(self.rate_cf):
-            _schema_modified = True
-            sysman.create_column_family(self.keyspace, self.rate_cf, super=True, 
-                    comparator_type=LONG_TYPE, 
-                    default_validation_class=COUNTER_COLUMN_TYPE,
-                    key_validation_class=UTF8_TYPE,
-                    compaction_strategy='LeveledCompactionStrategy')
-            self.log.info('Created CF: %s' % self.rate_cf)
-        # Rate aggregation CF
-        if not sysman.get_keyspace_column_families(self.keyspace).has_key(self.agg_cf):
-            _schema_modified = True
-            sysman.create_column_family(self.keyspace, self.agg_cf, super=True, 
-                    comparator_type=LONG_TYPE, 
-                    default_validation_class=COUNTER_COLUMN_TYPE,
-                    key_validation_class=UTF8_TYPE,
-                    compaction_strategy='LeveledCompactionStrategy')
-            self.log.info('Created CF: %s' % self.agg_cf)
-        # Stat aggregation CF
-        if not sysman.get_keyspace_column_families(self.keyspace).has_key(self.stat_cf):
-            _schema_modified = True
-            sysman.create_column_family(self.keyspace, self.stat_cf, super=True, 
-                    comparator_type=LONG_TYPE, 
-                    default_validation_class=LONG_TYPE,
-                    key_validation_class=UTF8_TYPE,
-                    compaction_strategy='LeveledCompactionStrategy')
-            self.log.info('Created CF: %s' % self.stat_cf)
-                    
-        sysman.close()
-        
-        self.log.info('Schema check done')
-        
-        # If we just cleared the keyspace/data and there is more than
-        # one server, pause to let schema propigate to the cluster machines.
-        if _schema_modified == True:
-            self.log.info("Waiting for schema to propagate...")
-            time.sleep(10)
-            self.log.info("Done")
-                
-        # Now, set up the ConnectionPool
-        
-        # Read auth information from config file and set up if need be.
-        _creds = {}
-        if config.cassandra_user and config.cassandra_pass:
-            _creds['username'] = config.cassandra_user
-            _creds['password'] = config.cassandra_pass
-            self.log.debug('Connecting with username: %s' % (config.cassandra_user,))
-        
-        try:
-            self.log.debug('Opening ConnectionPool')
-            self.pool = ConnectionPool(self.keyspace, 
-                server_list=config.cassandra_servers, 
-                pool_size=10,
-                max_overflow=5,
-                max_retries=10,
-                timeout=timeout,
-                credentials=_creds)
-        except AllServersUnavailable, e:
-            raise ConnectionException("Couldn't connect to any Cassandra "
-                    "at %s - %s" % (config.cassandra_servers, e))
-                    
-        self.log.info('Connected to %s' % config.cassandra_servers)
-        
-        # Define column family connections for the code to use.
-        self.raw_data = ColumnFamily(self.pool, self.raw_cf).batch(self._queue_size)
-        self.rates    = ColumnFamily(self.pool, self.rate_cf).batch(self._queue_size)
-        self.aggs     = ColumnFamily(self.pool, self.agg_cf).batch(self._queue_size)
-        self.stat_agg = ColumnFamily(self.pool, self.stat_cf).batch(self._queue_size)
+        self._setup_column_families(config)
 
         # Used when a cf needs to be selected on the fly.
         self.cf_map = {
@@ -255,7 +168,39 @@ class CASSANDRA_DB(object):
         # Just the dict for the metadata cache.
         self.metadata_cache = {}
         self.aggregation_cache = {}
-        
+
+        # Optional background sending of the batches, see
+        # start_write_pipeline().
+        self.write_pipeline = None
+
+        # Rate aggregation increments not written yet, see
+        # accumulate_rate_aggregations().
+        self._rate_pending = {}
+
+        # Row key -> timestamp of the open stat aggregation bin that has
+        # changes not written yet, see checkpoint_stat_aggregations().
+        self._stat_pending = {}
+
+        # Optional on-disk copy of the caches, see open_cache_snapshot().
+        self.cache_snapshot = None
+        self._dirty_metadata = set()
+        self._dirty_aggregations = set()
+
+        # Optional cache of the closed chunks of base rate and aggregation
+        # reads, see _chunked_rows().
+        self.chunk_cache = None
+        if getattr(config, 'chunk_cache_dir', None):
+            self.chunk_cache = ChunkCache(config.chunk_cache_dir,
+                config.chunk_cache_settle, config.chunk_cache_max_age,
+                log=self.log)
+
+    def _setup_column_families(self, config):
+        """
+        Connect to the storage engine and set the self.raw_data, self.rates,
+        self.aggs and self.stat_agg batch objects.
+        """
+        raise NotImplementedError
+
     def flush(self):
         """
         Calling this will explicity flush all the batches to the 
@@ -263,18 +208,134 @@ class CASSANDRA_DB(object):
         in production when the batches will be self-flushing.
         """
         self.log.debug('Flush called')
+        self.flush_rate_aggregations()
+        self.checkpoint_stat_aggregations()
         self.raw_data.send()
         self.rates.send()
         self.aggs.send()
         self.stat_agg.send()
+        if self.write_pipeline is not None:
+            self.write_pipeline.flush()
         
     def close(self):
         """
-        Explicitly close the connection pool.
+        Release any resources held by the storage engine.
         """
-        self.log.debug('Close/dispose called')
-        self.pool.dispose()
-        
+        self.log.debug('Close called')
+        if self.write_pipeline is not None:
+            self.write_pipeline.close()
+
+    def start_write_pipeline(self, threads=4, window=16):
+        """
+        Send the batches on background threads with at most window
+        sends pending (see esmond.pipeline) instead of in the caller.
+        Used by the persister.  The base rate and rate aggregation counter
+        updates are sent in parallel, the raw data and stat aggregation
+        sends are kept in order.  flush() waits for everything to be sent.
+        """
+        self.write_pipeline = WritePipeline(threads, window, log=self.log)
+        for attr, ordered in (('raw_data', True), ('rates', False),
+                ('aggs', False), ('stat_agg', True)):
+            setattr(self, attr, PipelinedMutator(getattr(self, attr),
+                self.write_pipeline, self._queue_size, ordered=ordered))
+
+        self.cf_map = {
+            'raw': self.raw_data,
+            'rate': self.rates,
+            'aggs': self.aggs,
+            'stat': self.stat_agg
+        }
+
+    def write_stats(self):
+        """
+        Return the write pipeline statistics (see WritePipeline.stats())
+        or None if it isn't used.
+        """
+        if self.write_pipeline is None:
+            return None
+        return self.write_pipeline.stats()
+
+    def open_cache_snapshot(self, path):
+        """
+        Load the metadata and aggregation caches from the snapshot and
+        journal at path (see esmond.snapshot) and record all further
+        changes there.  Used by the persister so a restarted worker 
+        doesn't have to rebuild its caches with database reads.
+        """
+        snapshot = CacheSnapshot(path, log=self.log)
+        metadata, aggregations = snapshot.load()
+        self.metadata_cache.update(metadata)
+        self.aggregation_cache.update(aggregations)
+        # The journal may hold min/max changes that were never written.
+        for key, bins in aggregations.iteritems():
+            for ts in bins:
+                self._stat_pending[key] = ts
+        self.log.info('Loaded %d metadata and %d aggregation cache entries from %s' %
+            (len(metadata), len(aggregations), path))
+
+        # Compact the journal into a fresh snapshot.
+        self.cache_snapshot = snapshot
+        self.snapshot_caches()
+
+    def journal_caches(self):
+        """
+        Append the cache entries changed since the last call to the
+        snapshot journal.
+        """
+        if self.cache_snapshot is None:
+            return
+        if not self._dirty_metadata and not self._dirty_aggregations:
+            return
+
+        metadata = {}
+        for k in self._dirty_metadata:
+            metadata[k] = self.metadata_cache[k]
+        aggregations = {}
+        for k in self._dirty_aggregations:
+            aggregations[k] = self.aggregation_cache[k]
+
+        self.cache_snapshot.append(metadata, aggregations)
+        self._dirty_metadata = set()
+        self._dirty_aggregations = set()
+
+    def snapshot_caches(self):
+        """
+        Write the complete caches to the snapshot and start a new journal.
+        """
+        if self.cache_snapshot is None:
+            return
+
+        t = time.time()
+        self.cache_snapshot.write(self.metadata_cache, self.aggregation_cache)
+        self._dirty_metadata = set()
+        self._dirty_aggregations = set()
+        self.log.debug('Wrote cache snapshot in %f seconds' % (time.time() - t))
+
+    def evict_caches(self, paths):
+        """
+        Drop the metadata and aggregation cache entries of every row
+        whose path starts with one of the tuples in paths.  Returns the 
+        number of entries dropped.
+        """
+        n = 0
+        for cache, dirty in ((self.metadata_cache, self._dirty_metadata),
+                (self.aggregation_cache, self._dirty_aggregations)):
+            for k in cache.keys():
+                elements = _split_rowkey(k)
+                for p in paths:
+                    if tuple(elements[:len(p)]) == p:
+                        self._close_stat_bin(k)
+                        del cache[k]
+                        dirty.discard(k)
+                        n += 1
+                        break
+
+        if n:
+            # The journal only records additions, start over so the
+            # entries don't come back on the next load.
+            self.snapshot_caches()
+        return n
+
     def set_raw_data(self, raw_data, ttl=None):
         """
         Called by the persister.  Writes the raw incoming data to the appropriate
@@ -295,11 +356,31 @@ class CASSANDRA_DB(object):
         
         if self.profiling: self.stats.raw_insert(time.time() - t)
         
+    def set_raw_data_rows(self, rows, ttl=None):
+        """
+        Grouped version of set_raw_data() used by the batched persister
+        path.  The rows arg maps a row key to a dict of 
+        {jstime: json encoded value} and each row key is written with a 
+        single insert.
+        """
+        _kw = {}
+        if ttl: 
+            _kw['ttl'] = ttl
+
+        t = time.time()
+
+        for key, cols in rows.iteritems():
+            self.raw_data.insert(key, cols, **_kw)
+
+        if self.profiling: self.stats.raw_insert(time.time() - t)
+
     def set_metadata(self, k, meta_d):
         """
         Just does a simple write to the dict being used as metadata.
         """
         self.metadata_cache[k] = meta_d.get_document()
+        if self.cache_snapshot is not None:
+            self._dirty_metadata.add(k)
         
     def get_metadata(self, raw_data):
         """
@@ -358,6 +439,91 @@ class CASSANDRA_DB(object):
         
         return meta_d
         
+    def prefetch_metadata(self, raw_datas, seed_missing=True, threads=1):
+        """
+        Bulk version of the get_metadata() cache miss handling.  Seeds the
+        metadata cache for every RawRateData in raw_datas that isn't
+        already cached, looking back through the raw data with one multiget
+        per seek back range (in chunks of _queue_size row keys) rather than
+        one query per measurement.
+
+        The cache is seeded exactly as get_metadata() would have when
+        called on each raw_data in order.  If seed_missing is False keys
+        that have no stored raw data are left out of the cache so they
+        are handled normally when their first value arrives - this is used
+        to warm the cache before any new data has been seen.  If threads
+        is greater than one the multigets are issued in parallel.
+        """
+        t = time.time()
+
+        missing = OrderedDict()
+        for raw_data in raw_datas:
+            k = raw_data.get_meta_key()
+            if not self.metadata_cache.has_key(k) and not missing.has_key(k):
+                missing[k] = raw_data
+
+        if not missing:
+            return
+
+        # Group the lookups by their seek back time range.
+        ranges = OrderedDict()
+        for k, raw_data in missing.items():
+            ts_max = raw_data.ts_to_jstime() - 1 # -1ms to look at older vals
+            ts_min = ts_max - SEEK_BACK_THRESHOLD
+            ranges.setdefault((ts_min, ts_max), []).append((k, raw_data,
+                self._get_row_keys(raw_data.path, raw_data.freq, ts_min, ts_max)))
+
+        chunks = []
+        for (ts_min, ts_max), entries in ranges.items():
+            row_keys = []
+            for k, raw_data, keys in entries:
+                row_keys.extend(keys)
+            for i in range(0, len(row_keys), self._queue_size):
+                chunks.append((row_keys[i:i+self._queue_size], ts_min, ts_max))
+
+        def _fetch(chunk):
+            row_keys, ts_min, ts_max = chunk
+            return self.raw_data._column_family.multiget(row_keys,
+                column_start=ts_max, column_finish=ts_min,
+                column_count=1, column_reversed=True)
+
+        found = {}
+        if threads > 1 and len(chunks) > 1:
+            pool = ThreadPool(min(threads, len(chunks)))
+            try:
+                for ret in pool.map(_fetch, chunks):
+                    found.update(ret)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for chunk in chunks:
+                found.update(_fetch(chunk))
+
+        n_found = 0
+        for entries in ranges.values():
+            for k, raw_data, keys in entries:
+                # Same as get_metadata() - use the most recent row key
+                # that had a value.
+                hits = [key for key in keys if found.has_key(key)]
+                if hits:
+                    n_found += 1
+                    ts, val = found[hits[-1]].items()[0]
+                    meta_d = Metadata(last_update=ts, last_val=json.loads(val),
+                        min_ts=ts, freq=raw_data.freq, path=raw_data.path)
+                elif seed_missing:
+                    meta_d = Metadata(last_update=raw_data.ts,
+                        last_val=raw_data.val, min_ts=raw_data.ts,
+                        freq=raw_data.freq, path=raw_data.path)
+                else:
+                    continue
+                self.set_metadata(k, meta_d)
+
+        if self.profiling: self.stats.meta_fetch((time.time() - t))
+
+        self.log.debug('Prefetched metadata for %d keys, %d found in raw_data' %
+            (len(missing), n_found))
+
     def update_metadata(self, k, metadata):
         """
         Update the metadata cache with a recently updated value.  Called by the
@@ -368,6 +534,8 @@ class CASSANDRA_DB(object):
         t = time.time()
         for i in ['last_val', 'min_ts', 'last_update']:
             self.metadata_cache[k][i] = getattr(metadata, i)
+        if self.cache_snapshot is not None:
+            self._dirty_metadata.add(k)
         #self.stats.meta_update((time.time() - t))
     
     def update_rate_bin(self, ratebin):
@@ -388,6 +556,19 @@ class CASSANDRA_DB(object):
 
         if self.profiling: self.stats.baserate_update((time.time() - t))
         
+    def update_rate_bins(self, rows):
+        """
+        Grouped version of update_rate_bin() used by the batched persister
+        path.  The rows arg maps a row key to a dict of 
+        {bin_ts: {'val': val, 'is_valid': is_valid}} and each row key
+        is written with a single insert.
+        """
+        for key, cols in rows.iteritems():
+            try:
+                self.rates.insert(key, cols)
+            except MaximumRetryException:
+                self.log.warn("update_rate_bins failed. MaximumRetryException")
+
     def update_rate_aggregation(self, raw_data, agg_ts, freq):
         """
         Called by the persister to update the rate aggregation rollups.
@@ -414,6 +595,58 @@ class CASSANDRA_DB(object):
 
         if self.profiling: self.stats.aggregation_update((time.time() - t))
 
+    def update_rate_aggregations(self, rows):
+        """
+        Grouped version of update_rate_aggregation().  The rows arg maps a
+        row key to a dict of {agg_ts: {'val': val, str(base_freq): count}}.
+        """
+        for key, cols in rows.iteritems():
+            try:
+                self.aggs.insert(key, cols)
+            except MaximumRetryException:
+                self.log.warn("update_rate_aggregations failed. MaximumRetryException")
+
+    def accumulate_rate_aggregations(self, rows):
+        """
+        Add rate aggregation updates (in the format of 
+        update_rate_aggregations()) to in-memory sums instead of writing
+        them.  Since the columns are counters the sums can be written as
+        a single increment: a bin is written once the next bin for its row
+        starts and all bins are written by flush_rate_aggregations(), 
+        which the persister calls periodically.
+        """
+        pending = self._rate_pending
+        for key, cols in rows.iteritems():
+            row = pending.get(key)
+            if row is None:
+                pending[key] = dict([(ts, dict(c)) for ts, c in cols.iteritems()])
+                continue
+
+            latest = max(row)
+            for ts, c in cols.iteritems():
+                acc = row.get(ts)
+                if acc is None:
+                    row[ts] = dict(c)
+                else:
+                    for k, v in c.iteritems():
+                        acc[k] = acc.get(k, 0) + v
+
+            if max(cols) > latest:
+                # The bins before the newest one are closed.
+                newest = max(row)
+                closed = dict([(ts, row.pop(ts)) for ts in row.keys()
+                    if ts < newest])
+                self.update_rate_aggregations({key: closed})
+
+    def flush_rate_aggregations(self):
+        """
+        Write the rate aggregation sums collected by 
+        accumulate_rate_aggregations().  Returns the number of bins written.
+        """
+        pending, self._rate_pending = self._rate_pending, {}
+        self.update_rate_aggregations(pending)
+        return sum(map(len, pending.values()))
+
     def get_agg_from_cache(self, agg, raw_data):
         """
         Manage aggregations using in-memory state similar to tracking
@@ -442,61 +675,98 @@ class CASSANDRA_DB(object):
         """
 
         ret = None
+        key = agg.get_key()
+        ts = agg.ts_to_jstime()
 
-        if not self.aggregation_cache.get(agg.get_key(), None):
-            self.aggregation_cache[agg.get_key()] = dict()
+        if self.cache_snapshot is not None:
+            self._dirty_aggregations.add(key)
+
+        if not self.aggregation_cache.get(key, None):
+            self.aggregation_cache[key] = dict()
             # there is no row key for this aggregation so to 
             # an initial lookup to see if this is a restart and seed 
             # the cache from the currently requested aggregation.
             # this read will only happen once per aggregation row
             # after startup or when seeing a new interface, etc.
             try:
-                lookup = self.stat_agg._column_family.get(agg.get_key(), 
-                            super_column=agg.ts_to_jstime())
-                self.aggregation_cache[agg.get_key()][agg.ts_to_jstime()] = dict(lookup)
+                lookup = self.stat_agg._column_family.get(key, super_column=ts)
+                self.aggregation_cache[key][ts] = dict(lookup)
             except NotFoundException:
                 pass
 
 
-        if not self.aggregation_cache[agg.get_key()].get(agg.ts_to_jstime(), None):
-            # a new bin is being started, so blow away previous 
-            # timestamped key for this row and start again so as to 
-            # not be leaking memory.
-            self.aggregation_cache[agg.get_key()] = dict()
+        if not self.aggregation_cache[key].get(ts, None):
+            # a new bin is being started, so write out the previous bin
+            # and blow away its timestamped key for this row and start
+            # again so as to not be leaking memory.
+            self._close_stat_bin(key)
+            self.aggregation_cache[key] = dict()
             # and update with the new aggregation bin values.  do not
-            # return a value so update_stat_aggregations will do the 
-            # initial insert().
-            self.aggregation_cache[agg.get_key()][agg.ts_to_jstime()] = \
-                {'min': agg.val, 'max': agg.val, 'min_ts': raw_data.ts_to_jstime(), 'max_ts': raw_data.ts_to_jstime()}
+            # return a value so stat_aggregation_changes() marks the
+            # new bin as changed.
+            raw_ts = raw_data.ts_to_jstime()
+            self.aggregation_cache[key][ts] = \
+                {'min': agg.val, 'max': agg.val, 'min_ts': raw_ts, 'max_ts': raw_ts}
         else:
-            ret = self.aggregation_cache[agg.get_key()].get(agg.ts_to_jstime())
+            ret = self.aggregation_cache[key].get(ts)
 
         return ret
 
+    def _close_stat_bin(self, key):
+        """
+        Write the cached bin for key if it has changes that haven't been
+        written yet.
+        """
+        ts = self._stat_pending.pop(key, None)
+        if ts is None:
+            return
+        entry = self.aggregation_cache.get(key, {}).get(ts)
+        if entry:
+            self.stat_agg.insert(key, {ts: dict(entry)})
+
+    def checkpoint_stat_aggregations(self):
+        """
+        Write every stat aggregation bin with changes that haven't been
+        written yet.
+
+        Min/max updates are only made in the aggregation cache by 
+        stat_aggregation_changes() and each bin is written once when the
+        next bin for the row starts, or by this method which the persister
+        calls periodically and flush() calls.  If the persister dies the
+        changes since the last write are lost but the bin is seeded from
+        the last written values on restart, see get_agg_from_cache().
+        Returns the number of bins written.
+        """
+        t = time.time()
+        n = len(self._stat_pending)
+        for key in self._stat_pending.keys():
+            self._close_stat_bin(key)
+        if self.profiling and n: self.stats.stat_update((time.time() - t))
+        return n
+
     def update_agg_cache(self, agg, raw_data, minmax):
         """Helper function to update agg cache when a new min or max happens."""
         assert minmax in ['min', 'max']
 
-        self.aggregation_cache[agg.get_key()][agg.ts_to_jstime()]['{0}'.format(minmax)] = agg.val
-        self.aggregation_cache[agg.get_key()][agg.ts_to_jstime()]['{0}_ts'.format(minmax)] = raw_data.ts_to_jstime()
+        entry = self.aggregation_cache[agg.get_key()][agg.ts_to_jstime()]
+        entry[minmax] = agg.val
+        # Already marked dirty by get_agg_from_cache().
+        entry['{0}_ts'.format(minmax)] = raw_data.ts_to_jstime()
 
         
-    def update_stat_aggregation(self, raw_data, agg_ts, freq):
+    def stat_aggregation_changes(self, raw_data, agg_ts, freq):
         """
-        Called by the persister to update the stat aggregations (ie: min/max).
-        
-        Unlike the other update code, this has to read from the appropriate bin 
-        to see if the min or max needs to be updated.  The update is done if 
-        need be, and the updated boolean is set to true and returned to the
-        calling code to flush the batch if need be.  Done that way to flush 
-        more than one batch update rather than doing it each time.
-        
+        Check the incoming value against the cached min/max for the stat 
+        aggregation bin and update the cache.  Returns a tuple of the row
+        key, the bin timestamp and a dict of the columns that need to be
+        written - or None if the min/max are unchanged.
+
         The args are a RawData object, the "compressed" aggregation timestamp
         and the frequency of the rollups in seconds.
+
+        The changes don't need to be written by the caller, the bin is 
+        written by checkpoint_stat_aggregations() or when it closes.
         """
-        
-        updated = False
-        
         # Create the AggBin object.
         agg = AggregationBin(
             ts=agg_ts, freq=freq, val=raw_data.val, base_freq=raw_data.freq, count=1,
@@ -509,34 +779,52 @@ class CASSANDRA_DB(object):
         
         if self.profiling: self.stats.stat_fetch((time.time() - t))
         
-        t = time.time()
-        
         if not ret:
             # Bin does not exist, so initialize min and max with the same val.
-            # self.stat_agg.insert(agg.get_key(),
-            #     {agg.ts_to_jstime(): {'min': agg.val, 'max': agg.val}})
-            self.stat_agg.insert(agg.get_key(),
-                {agg.ts_to_jstime(): {'min': agg.val, 'max': agg.val, 'min_ts': raw_data.ts_to_jstime(), 'max_ts': raw_data.ts_to_jstime()}})
-            updated = True
+            cols = {'min': agg.val, 'max': agg.val, 'min_ts': raw_data.ts_to_jstime(), 'max_ts': raw_data.ts_to_jstime()}
         elif agg.val > ret['max']:
             # Update max.
             self.update_agg_cache(agg, raw_data, 'max')
-            self.stat_agg.insert(agg.get_key(),
-                {agg.ts_to_jstime(): {'max': agg.val, 'max_ts': raw_data.ts_to_jstime()}})
-            updated = True
+            cols = {'max': agg.val, 'max_ts': raw_data.ts_to_jstime()}
         elif agg.val < ret['min']:
-            self.update_agg_cache(agg, raw_data, 'min')
             # Update min.
-            self.stat_agg.insert(agg.get_key(),
-                {agg.ts_to_jstime(): {'min': agg.val, 'min_ts': raw_data.ts_to_jstime()}})
-            updated = True
+            self.update_agg_cache(agg, raw_data, 'min')
+            cols = {'min': agg.val, 'min_ts': raw_data.ts_to_jstime()}
         else:
-            pass
-        
+            return None
+
+        # Written when the bin closes or on the next checkpoint.
+        self._stat_pending[agg.get_key()] = agg.ts_to_jstime()
+
+        return agg.get_key(), agg.ts_to_jstime(), cols
+
+    def update_stat_aggregation(self, raw_data, agg_ts, freq):
+        """
+        Update the cached stat aggregation (ie: min/max) bin with a value.
+        Returns True if the min or max changed.
+
+        Nothing is written here, the bin is written by
+        checkpoint_stat_aggregations() or when it closes (see
+        stat_aggregation_changes()).
+
+        The args are a RawData object, the "compressed" aggregation timestamp
+        and the frequency of the rollups in seconds.
+        """
+        return self.stat_aggregation_changes(raw_data, agg_ts, freq) is not None
+
+    def update_stat_aggregations(self, rows):
+        """
+        Grouped version of update_stat_aggregation() - writes the merged
+        results of stat_aggregation_changes().  The rows arg maps a row 
+        key to a dict of {agg_ts: {'min': .., 'max': .., ...}}.
+        """
+        t = time.time()
+
+        for key, cols in rows.iteritems():
+            self.stat_agg.insert(key, cols)
+
         if self.profiling: self.stats.stat_update((time.time() - t))
         
-        return updated
-        
     def _get_row_keys(self, path, freq, ts_min, ts_max):
         """
         Utility function used by the query interface.
@@ -581,153 +869,291 @@ class CASSANDRA_DB(object):
 
         return found
         
-    def query_baserate_timerange(self, path=None, freq=None, 
-            ts_min=None, ts_max=None, cf='average', column_count=None):
+    def _xget_rows(self, batch, path, freq, ts_min, ts_max, column_count=None):
         """
-        Query interface method to retrieve the base rates (generally average 
-        but could be delta as well).
+        Generator over the (ts, value) columns between ts_min and ts_max
+        of the rows returned by _get_row_keys(), in time order.  Columns
+        are read QUERY_PAGE_SIZE at a time so a long range is neither
+        counted first nor held in memory as a whole.  column_count limits
+        the number of columns read from each row.
         """
-        cols = column_count
-        if cols is None:
-            ret_count = self.rates._column_family.multiget_count(
-                self._get_row_keys(path,freq,ts_min,ts_max), 
-                column_start=ts_min, column_finish=ts_max)
-            cols = 0
-            for i in ret_count.keys():
-                cols += ret_count[i]
-            cols += 5
-
-        ret = self.rates._column_family.multiget(
-                self._get_row_keys(path,freq,ts_min,ts_max), 
-                column_start=ts_min, column_finish=ts_max,
-                column_count=cols)
-        
+        for key in self._get_row_keys(path, freq, ts_min, ts_max):
+            for col in batch._column_family.xget(key,
+                    column_start=ts_min, column_finish=ts_max,
+                    column_count=column_count, buffer_size=QUERY_PAGE_SIZE):
+                yield col
+
+    def _chunked_rows(self, batch, path, freq, ts_min, ts_max,
+            column_count=None):
+        """
+        _xget_rows() through the chunk cache if there is one (and no
+        column_count, which applies to each row).
+        """
+        if self.chunk_cache is None or column_count is not None or not freq:
+            return self._xget_rows(batch, path, freq, ts_min, ts_max,
+                column_count)
+        def exists():
+            for key in self._get_row_keys(path, freq, ts_min, ts_max):
+                try:
+                    batch._column_family.get(key, column_count=1)
+                except NotFoundException:
+                    continue
+                return True
+            return False
+
+        return self.chunk_cache.rows(batch._column_family.column_family,
+            path, freq, ts_min, ts_max,
+            lambda lo, hi: self._xget_rows(batch, path, freq, lo, hi),
+            exists)
+
+    def _multiget_rows(self, batch, keys, ts_min, ts_max, column_count,
+            limited=False):
+        """
+        Return a dict of the (ts, value) columns between ts_min and ts_max
+        of the rows keys, read with multiget() MULTIGET_COLUMNS columns per
+        round trip.  At most column_count columns are read from each row 
+        at first - unless limited (column_count is the limit of the query)
+        the rest of a row that had that many is read with xget().
+        """
+        cf = batch._column_family
+        rows = {}
+        ret = cf.multiget(keys, column_start=ts_min, column_finish=ts_max,
+            column_count=column_count,
+            buffer_size=max(1, MULTIGET_COLUMNS // column_count))
+        for key, cols in ret.iteritems():
+            cols = list(cols.iteritems())
+            if len(cols) == column_count and not limited:
+                last = cols[-1][0]
+                cols.extend([c for c in cf.xget(key, column_start=last,
+                    column_finish=ts_max, buffer_size=QUERY_PAGE_SIZE)
+                    if c[0] != last])
+            rows[key] = cols
+        return rows
+
+    def _baserate_divisor(self, freq, cf):
+        """Return the divisor of the base rate values for cf."""
         if cf not in ['average', 'delta']:
             self.log.error('Not a valid option: %s - defaulting to average' % cf)
             cf = 'average'
-        
+
         # Divisors to return either the average or a delta.
-        if freq is None: freq = 1000
-        value_divisors = { 'average': int(freq/1000), 'delta': 1 }
-        
-        # Just return the results and format elsewhere.
-        results = []
-        
-        for k,v in ret.items():
-            for kk,vv in v.items():
-                results.append({'ts': kk, 'val': float(vv['val']) / value_divisors[cf], 
-                                        'is_valid': vv['is_valid']})
-            
-        return results
+        divisor_freq = freq if freq is not None else 1000
+        value_divisors = { 'average': int(divisor_freq/1000), 'delta': 1 }
+        return value_divisors[cf]
+
+    def _iter_baserates(self, cols, divisor):
+        for kk, vv in cols:
+            yield {'ts': kk, 'val': float(vv['val']) / divisor,
+                    'is_valid': vv['is_valid']}
+
+    def _baserate_columns(self, cols, divisor):
+        ts, val, is_valid = [], [], []
+        for kk, vv in cols:
+            ts.append(kk)
+            val.append(vv['val'])
+            is_valid.append(vv['is_valid'])
+
+        val = numpy.array(val, dtype=numpy.float64) / divisor
+        return ColumnarSeries(ts, OrderedDict([('val', val),
+            ('is_valid', numpy.array(is_valid, dtype=numpy.int64))]))
+
+    def _aggregation_cf(self, cf):
+        if cf not in AGG_TYPES:
+            self.log.error('Not a valid option: %s - defaulting to average' % cf)
+            cf = 'average'
+        return cf
 
-    def query_aggregation_timerange(self, path=None, freq=None, 
+    def _iter_aggregations(self, cols, cf):
+        if cf == 'average' or cf == 'raw':
+            for kk, vv in cols:
+                ts = kk
+                val = None
+                base_freq = None
+                count = None
+                for kkk in vv.keys():
+                    if kkk == 'val':
+                        val = vv[kkk]
+                    else:
+                        base_freq = kkk
+                        count = vv[kkk]
+                ab = AggregationBin(**{'ts': ts, 'val': val,'base_freq': int(base_freq), 'count': count, 'cf': cf})
+                if cf == 'average':
+                    yield {'ts': ts, 'val': ab.average, 'cf': ab.cf}
+                else:
+                    yield {'ts': ts, 'val': ab.val, 'cf': ab.cf}
+        elif cf == 'min' or cf == 'max':
+            for kk, vv in cols:
+                ts = kk
+                if cf == 'min':
+                    yield {'ts': ts, 'val': vv['min'], 'cf': cf, 'm_ts': vv.get('min_ts', None)}
+                else:
+                    yield {'ts': ts, 'val': vv['max'], 'cf': cf, 'm_ts': vv.get('max_ts', None)}
+
+    def _iter_raw(self, cols):
+        for kk, vv in cols:
+            yield {'ts': kk, 'val': json.loads(vv)}
+
+    def _raw_columns(self, cols):
+        ts, val = [], []
+        for kk, vv in cols:
+            ts.append(kk)
+            val.append(json.loads(vv))
+        return ColumnarSeries.from_lists(ts, val=val)
+
+    def _query_builder(self, name, freq=None, cf=None, columnar=False):
+        """
+        Return the batch that query_<name>() reads and a function that
+        builds its result from the columns read.
+        """
+        columnar = columnar and numpy is not None
+        if name == 'baserate_timerange':
+            divisor = self._baserate_divisor(freq, cf or 'average')
+            if columnar:
+                return self.rates, lambda cols: self._baserate_columns(cols, divisor)
+            return self.rates, lambda cols: list(self._iter_baserates(cols, divisor))
+        elif name == 'aggregation_timerange':
+            cf = self._aggregation_cf(cf)
+            batch = self.stat_agg if cf in ('min', 'max') else self.aggs
+            to_result = ColumnarSeries.from_rows if columnar else list
+            return batch, lambda cols: to_result(self._iter_aggregations(cols, cf))
+        elif name == 'raw_data':
+            if columnar:
+                return self.raw_data, self._raw_columns
+            return self.raw_data, lambda cols: list(self._iter_raw(cols))
+        raise ValueError('not a valid query: %s' % name)
+
+    def iter_baserate_timerange(self, path=None, freq=None,
+            ts_min=None, ts_max=None, cf='average', column_count=None):
+        """
+        Generator version of query_baserate_timerange().
+        """
+        return self._iter_baserates(self._chunked_rows(self.rates, path,
+            freq, ts_min, ts_max, column_count),
+            self._baserate_divisor(freq, cf))
+
+    def query_baserate_timerange(self, path=None, freq=None, 
+            ts_min=None, ts_max=None, cf='average', column_count=None,
+            columnar=False):
+        """
+        Query interface method to retrieve the base rates (generally average 
+        but could be delta as well).
+
+        If columnar is set and numpy is available the results are returned
+        as a ColumnarSeries rather than a list.
+        """
+        batch, build = self._query_builder('baserate_timerange', freq, cf,
+            columnar)
+        return build(self._chunked_rows(batch, path, freq, ts_min, ts_max,
+            column_count))
+
+    def iter_aggregation_timerange(self, path=None, freq=None,
                 ts_min=None, ts_max=None, cf=None, column_count=None):
         """
+        Generator version of query_aggregation_timerange().
+        """
+        cf = self._aggregation_cf(cf)
+        batch = self.stat_agg if cf in ('min', 'max') else self.aggs
+        return self._iter_aggregations(self._chunked_rows(batch, path, freq,
+            ts_min, ts_max, column_count), cf)
+
+    def query_aggregation_timerange(self, path=None, freq=None, 
+                ts_min=None, ts_max=None, cf=None, column_count=None,
+                columnar=False):
+        """
         Query interface method to retrieve the aggregation rollups - could
         be average/min/max.  Different column families will be queried 
         depending on what value "cf" is set to.
+
+        If columnar is set and numpy is available the results are returned
+        as a ColumnarSeries rather than a list.
         """
-                
-        if cf not in AGG_TYPES:
-            self.log.error('Not a valid option: %s - defaulting to average' % cf)
-            cf = 'average'
-        
-        if cf == 'average' or cf == 'raw':
-            cols = column_count
-            if cols is None:
-                ret_count = self.aggs._column_family.multiget_count(
-                        self._get_row_keys(path,freq,ts_min,ts_max),
-                        column_start=ts_min, column_finish=ts_max)
-                cols = 0
-                for i in ret_count.keys():
-                    cols += ret_count[i]
-                cols += 5
-
-            # print cols
-            ret = self.aggs._column_family.multiget(
-                    self._get_row_keys(path,freq,ts_min,ts_max), 
-                    column_start=ts_min, column_finish=ts_max,
-                    column_count=cols)
+        batch, build = self._query_builder('aggregation_timerange', freq, cf,
+            columnar)
+        return build(self._chunked_rows(batch, path, freq, ts_min, ts_max,
+            column_count))
 
-            # Just return the results and format elsewhere.
-            results = []
-            
-            for k,v in ret.items():
-                for kk,vv in v.items():
-                    ts = kk
-                    val = None
-                    base_freq = None
-                    count = None
-                    for kkk in vv.keys():
-                        if kkk == 'val':
-                            val = vv[kkk]
-                        else:
-                            base_freq = kkk
-                            count = vv[kkk]
-                    ab = AggregationBin(**{'ts': ts, 'val': val,'base_freq': int(base_freq), 'count': count, 'cf': cf})
-                    if cf == 'average':
-                        datum = {'ts': ts, 'val': ab.average, 'cf': ab.cf}
-                    else:
-                        datum = {'ts': ts, 'val': ab.val, 'cf': ab.cf}
-                    results.append(datum)
-        elif cf == 'min' or cf == 'max':
-            cols = column_count
-            if cols is None:
-                ret_count = self.stat_agg._column_family.multiget_count(
-                        self._get_row_keys(path,freq,ts_min,ts_max),
-                        column_start=ts_min, column_finish=ts_max)
-                cols = 0
-                for i in ret_count.keys():
-                    cols += ret_count[i]
-                cols += 5
-
-            ret = self.stat_agg._column_family.multiget(
-                    self._get_row_keys(path,freq,ts_min,ts_max), 
-                    column_start=ts_min, column_finish=ts_max,
-                    column_count=cols)
-            
-            results = []
-
-            for k,v in ret.items():
-                for kk,vv in v.items():
-                    ts = kk
-                    if cf == 'min':
-                        datum = {'ts': ts, 'val': vv['min'], 'cf': cf, 'm_ts': vv.get('min_ts', None)}
-                        results.append(datum)
-                    else:
-                        datum = {'ts': ts, 'val': vv['max'], 'cf': cf, 'm_ts': vv.get('max_ts', None)}
-                        results.append(datum)
-        
-        return results
-            
-    def query_raw_data(self, path=None, freq=None,
+    def iter_raw_data(self, path=None, freq=None,
                 ts_min=None, ts_max=None, column_count=None):
         """
+        Generator version of query_raw_data().
+        """
+        return self._iter_raw(self._xget_rows(self.raw_data, path, freq,
+            ts_min, ts_max, column_count))
+
+    def query_raw_data(self, path=None, freq=None,
+                ts_min=None, ts_max=None, column_count=None, columnar=False):
+        """
         Query interface to query the raw data.
+
+        If columnar is set and numpy is available the results are returned
+        as a ColumnarSeries rather than a list.
         """
-        cols = column_count
-        if cols is None:
-            ret_count = self.raw_data._column_family.multiget_count(
-                    self._get_row_keys(path,freq,ts_min,ts_max),
-                    column_start=ts_min, column_finish=ts_max)
-            cols = 0
-            for i in ret_count.keys():
-                cols += ret_count[i]
-            cols += 5
-
-        ret = self.raw_data._column_family.multiget(
-                self._get_row_keys(path,freq,ts_min,ts_max), 
-                column_start=ts_min, column_finish=ts_max,
-                column_count=cols)
+        batch, build = self._query_builder('raw_data', freq, None, columnar)
+        return build(self._xget_rows(batch, path, freq, ts_min, ts_max,
+            column_count))
 
-        # Just return the results and format elsewhere.
-        results = []
+    def query_many(self, queries, columnar=False):
+        """
+        Run several queries and return the list of their results.  Each
+        query is a (name, kwargs) tuple - name is one of 
+        baserate_timerange, aggregation_timerange or raw_data and kwargs
+        the args of that query_ method.
+
+        Rather than reading the rows of each query in turn, the row keys 
+        of all of the queries on the same column family and time range 
+        are read together with _multiget_rows() so a batch of queries 
+        costs a few round trips instead of one or more per query.  Base
+        rate and aggregation queries are read through the chunk cache
+        instead when there is one.
+        """
+        groups = OrderedDict()
+        plans = []
+
+        for name, kwargs in queries:
+            freq = kwargs.get('freq')
+            ts_min, ts_max = kwargs.get('ts_min'), kwargs.get('ts_max')
+            column_count = kwargs.get('column_count')
+
+            batch, build = self._query_builder(name, freq, kwargs.get('cf'),
+                columnar)
+            if self.chunk_cache is not None and name != 'raw_data' and \
+                    column_count is None and freq:
+                # The rows themselves rather than their keys.
+                plans.append((None, self._chunked_rows(batch,
+                    kwargs.get('path'), freq, ts_min, ts_max), build))
+                continue
+            keys = self._get_row_keys(kwargs.get('path'), freq, ts_min, ts_max)
+
+            group_key = (batch._column_family.column_family, ts_min, ts_max,
+                column_count)
+            if group_key not in groups:
+                groups[group_key] = dict(batch=batch, keys=OrderedDict(),
+                    count=1)
+            group = groups[group_key]
+            for key in keys:
+                group['keys'][key] = True
+            # Number of bins in the range, plus one so a row is only read
+            # again when it holds more columns than that.
+            if freq:
+                group['count'] = max(group['count'],
+                    (ts_max - ts_min) // freq + 2)
+            else:
+                group['count'] = MULTIGET_COLUMNS
 
-        for k,v in ret.items():
-            for kk,vv in v.items():
-                results.append({'ts': kk, 'val': json.loads(vv)})
-        
-        return results
+            plans.append((group_key, keys, build))
+
+        rows = {}
+        for group_key, group in groups.items():
+            column_count = group_key[3]
+            rows[group_key] = self._multiget_rows(group['batch'],
+                group['keys'].keys(), group_key[1], group_key[2],
+                column_count or min(group['count'], MULTIGET_COLUMNS),
+                limited=column_count is not None)
+
+        return [build(keys if group_key is None else
+                    itertools.chain.from_iterable(
+                        [rows[group_key].get(key, []) for key in keys]))
+                for group_key, keys, build in plans]
 
     def query_raw_first(self, path=None, freq=None, year=None):
         """
@@ -765,6 +1191,154 @@ class CASSANDRA_DB(object):
     def __del__(self):
         pass
 
+class CASSANDRA_DB(TimeSeriesStore):
+    """
+    TimeSeriesStore implementation backed by a Cassandra cluster via pycassa.
+    This includes:
+
+    * schema creation,
+    * connection information/pooling.
+    """
+    
+    def __init__(self, config, qname=None, timeout=30):
+        self.timeout = timeout
+        TimeSeriesStore.__init__(self, config, qname=qname)
+
+    def _setup_column_families(self, config):
+        # Add pycassa driver logging to existing logger.
+        plog = PycassaLogger()
+        plog.set_logger_name('%s.pycassa' % self.log.name)
+        # Debug level is far too noisy, so just hardcode the pycassa 
+        # logger to info level.
+        plog.set_logger_level('info')
+
+        # Connect to cassandra with SystemManager, do a schema check 
+        # and set up schema components if need be.
+        try:
+            sysman = SystemManager(config.cassandra_servers[0])                              
+        except TTransportException, e:
+            raise ConnectionException("System Manager can't connect to Cassandra "
+                "at %s - %s" % (config.cassandra_servers[0], e))
+        
+        # Blow everything away if we're testing - be aware of this and use
+        # with care.  Currently just being explictly set in test harness
+        # code but no longer set as a config file option since there could
+        # be unfortunate side effects.
+        if config.db_clear_on_testing:
+            self.log.info('Dropping keyspace %s' % self.keyspace)
+            if self.keyspace in sysman.list_keyspaces():
+                sysman.drop_keyspace(self.keyspace)
+                time.sleep(3)
+        # Create keyspace
+        
+        _schema_modified = False # Track if schema components are created.
+        
+        if not self.keyspace in sysman.list_keyspaces():
+            _schema_modified = True
+            self.log.info('Creating keyspace %s' % self.keyspace)
+            sysman.create_keyspace(self.keyspace, SIMPLE_STRATEGY, 
+                {'replication_factor': str(config.cassandra_replicas)})
+            time.sleep(3)
+        # Create column families if they don't already exist.
+        # If a new column family is added, make sure to set 
+        # _schema_modified = True so it will be propigated.
+        self.log.info('Checking/creating column families')
+        # Raw Data CF
+        if not sysman.get_keyspace_column_families(self.keyspace).has_key(self.raw_cf):
+            _schema_modified = True
+            sysman.create_column_family(self.keyspace, self.raw_cf, super=False, 
+                    comparator_type=LONG_TYPE, 
+                    default_validation_class=UTF8_TYPE,
+                    key_validation_class=UTF8_TYPE,
+                    compaction_strategy='LeveledCompactionStrategy')
+            self.log.info('Created CF: %s' % self.raw_cf)
+        # Base Rate CF
+        if not sysman.get_keyspace_column_families(self.keyspace).has_key(self.rate_cf):
+            _schema_modified = True
+            sysman.create_column_family(self.keyspace, self.rate_cf, super=True, 
+                    comparator_type=LONG_TYPE, 
+                    default_validation_class=COUNTER_COLUMN_TYPE,
+                    key_validation_class=UTF8_TYPE,
+                    compaction_strategy='LeveledCompactionStrategy')
+            self.log.info('Created CF: %s' % self.rate_cf)
+        # Rate aggregation CF
+        if not sysman.get_keyspace_column_families(self.keyspace).has_key(self.agg_cf):
+            _schema_modified = True
+            sysman.create_column_family(self.keyspace, self.agg_cf, super=True, 
+                    comparator_type=LONG_TYPE, 
+                    default_validation_class=COUNTER_COLUMN_TYPE,
+                    key_validation_class=UTF8_TYPE,
+                    compaction_strategy='LeveledCompactionStrategy')
+            self.log.info('Created CF: %s' % self.agg_cf)
+        # Stat aggregation CF
+        if not sysman.get_keyspace_column_families(self.keyspace).has_key(self.stat_cf):
+            _schema_modified = True
+            sysman.create_column_family(self.keyspace, self.stat_cf, super=True, 
+                    comparator_type=LONG_TYPE, 
+                    default_validation_class=LONG_TYPE,
+                    key_validation_class=UTF8_TYPE,
+                    compaction_strategy='LeveledCompactionStrategy')
+            self.log.info('Created CF: %s' % self.stat_cf)
+                    
+        sysman.close()
+        
+        self.log.info('Schema check done')
+        
+        # If we just cleared the keyspace/data and there is more than
+        # one server, pause to let schema propigate to the cluster machines.
+        if _schema_modified == True:
+            self.log.info("Waiting for schema to propagate...")
+            time.sleep(10)
+            self.log.info("Done")
+                
+        # Now, set up the ConnectionPool
+        
+        # Read auth information from config file and set up if need be.
+        _creds = {}
+        if config.cassandra_user and config.cassandra_pass:
+            _creds['username'] = config.cassandra_user
+            _creds['password'] = config.cassandra_pass
+            self.log.debug('Connecting with username: %s' % (config.cassandra_user,))
+        
+        try:
+            self.log.debug('Opening ConnectionPool')
+            self.pool = ConnectionPool(self.keyspace, 
+                server_list=config.cassandra_servers, 
+                pool_size=10,
+                max_overflow=5,
+                max_retries=10,
+                timeout=self.timeout,
+                credentials=_creds)
+        except AllServersUnavailable, e:
+            raise ConnectionException("Couldn't connect to any Cassandra "
+                    "at %s - %s" % (config.cassandra_servers, e))
+                    
+        self.log.info('Connected to %s' % config.cassandra_servers)
+        
+        # Define column family connections for the code to use.
+        self.raw_data = ColumnFamily(self.pool, self.raw_cf).batch(self._queue_size)
+        self.rates    = ColumnFamily(self.pool, self.rate_cf).batch(self._queue_size)
+        self.aggs     = ColumnFamily(self.pool, self.agg_cf).batch(self._queue_size)
+        self.stat_agg = ColumnFamily(self.pool, self.stat_cf).batch(self._queue_size)
+
+    def close(self):
+        """
+        Explicitly close the connection pool.
+        """
+        TimeSeriesStore.close(self)
+        self.log.debug('Close/dispose called')
+        self.pool.dispose()
+
+def get_timeseries_db(config, qname=None, timeout=30):
+    """
+    Return the TimeSeriesStore implementation selected by the
+    timeseries_backend config option.
+    """
+    if config.timeseries_backend == 'memory':
+        from esmond.memdb import MEMORY_DB
+        return MEMORY_DB(config, qname=qname)
+    return CASSANDRA_DB(config, qname=qname, timeout=timeout)
+
 # Stats/timing code for connection class
 
 class DatabaseMetrics(object):
@@ -884,12 +1458,43 @@ class DataContainerBase(object):
     """
     Base class for the other encapsulation objects.  Mostly provides 
     utility methods for subclasses.
+
+    The containers are created for every sample and rollup the persister
+    handles so they use __slots__ rather than an instance dict, and cache
+    their row keys - the path (and the freq/ts of subclasses) must be
+    assigned as a whole rather than modified in place.
     """
+
+    __slots__ = ('_path', '_keys')
     
+    _doc_attrs = ['path']
     _doc_properties = []
     
     def __init__(self, path):
+        self._keys = None
         self.path = path
+
+    @property
+    def path(self):
+        return self._path
+
+    @path.setter
+    def path(self, value):
+        self._path = value
+        self._keys = None
+
+    def _cached_key(self, name, *args, **kw):
+        """
+        Return get_rowkey(*args, **kw), computing it only the first time
+        a key with the given name is requested.
+        """
+        if self._keys is None:
+            self._keys = {}
+        try:
+            return self._keys[name]
+        except KeyError:
+            key = self._keys[name] = get_rowkey(*args, **kw)
+            return key
         
     def _handle_date(self,d):
         """
@@ -906,10 +1511,8 @@ class DataContainerBase(object):
         Return a dictionary of the attrs/props in the object.
         """
         doc = {}
-        for k,v in self.__dict__.items():
-            if k.startswith('_'):
-                continue
-            doc[k] = v
+        for k in self._doc_attrs:
+            doc[k] = getattr(self, k)
             
         for p in self._doc_properties:
             doc[p] = getattr(self, '%s' % p)
@@ -920,7 +1523,7 @@ class DataContainerBase(object):
         """
         Return a cassandra row key based on the contents of the object.
         """
-        return get_rowkey(self.path)
+        return self._cached_key('key', self.path)
         
     def ts_to_jstime(self, t='ts'):
         """
@@ -938,8 +1541,7 @@ class DataContainerBase(object):
         Defaults to returning 'ts' property, but can be given an arg to grab a
         different property/attribute like Metadata.last_update.
         """
-        ts = getattr(self, t)
-        return calendar.timegm(ts.utctimetuple())
+        return self.ts_to_jstime(t) / 1000
 
 class RawData(DataContainerBase):
     """
@@ -947,12 +1549,19 @@ class RawData(DataContainerBase):
 
     Can be instantiated from args when reading from persist queue, or via **kw
     when reading data back out of Cassandra.
+
+    The timestamp is kept in the form it was given in - integer 
+    milliseconds in the persister - and only converted to a datetime 
+    when the ts property is read.  The millisecond value returned by 
+    ts_to_jstime() is computed once.
     """
+    __slots__ = ('_ts', '_ts_in', '_ts_js', 'val')
+
+    _doc_attrs = ['path', 'val']
     _doc_properties = ['ts']
 
     def __init__(self, path=None, ts=None, val=None):
         DataContainerBase.__init__(self, path)
-        self._ts = None
         self.ts = ts
         self.val = val
 
@@ -964,21 +1573,41 @@ class RawData(DataContainerBase):
         one year's worth of data.  This is an implementation detail for using
         Cassandra effectively.
         """
-        return get_rowkey(self.path, year=self.ts.year)
+        return self._cached_key('key', self.path, year=self.ts.year)
 
     @property
     def ts(self):
+        if self._ts is None:
+            self._ts = self._handle_date(self._ts_in)
         return self._ts
         
     @ts.setter
     def ts(self, value):
-        self._ts = self._handle_date(value)
+        self._ts = value if type(value) == datetime.datetime else None
+        self._ts_in = value
+        self._ts_js = None
+        self._keys = None
+
+    def ts_to_jstime(self, t='ts'):
+        if t != 'ts':
+            return DataContainerBase.ts_to_jstime(self, t)
+        if self._ts_js is None:
+            if type(self._ts_in) in (int, long):
+                # Same as the datetime round trip - drop the fractional 
+                # seconds.
+                self._ts_js = self._ts_in - self._ts_in % 1000
+            else:
+                self._ts_js = DataContainerBase.ts_to_jstime(self)
+        return self._ts_js
 
 
 class RawRateData(RawData):
     """
     Container for raw data for rate based rows.
     """
+    __slots__ = ('_freq',)
+
+    _doc_attrs = ['path', 'val', 'freq']
     _doc_properties = ['ts']
 
     def __init__(self, path=None, ts=None, val=None, freq=None):
@@ -993,6 +1622,15 @@ class RawRateData(RawData):
         return "<RawRateData/%d: ts=%s, val=%s, path=%s>" % \
             (id(self), self.ts, self.val, self.path)
 
+    @property
+    def freq(self):
+        return self._freq
+
+    @freq.setter
+    def freq(self, value):
+        self._freq = value
+        self._keys = None
+
     def get_key(self):
         """
         Return a cassandra row key based on the contents of the object.
@@ -1000,14 +1638,15 @@ class RawRateData(RawData):
         For rate data we add the frequency to the row key before the year, see
         the RawData.get_key() documentation for details about the year.
         """
-        return get_rowkey(self.path, freq=self.freq, year=self.ts.year)
+        return self._cached_key('key', self.path, freq=self.freq,
+            year=self.ts.year)
 
     def get_meta_key(self):
         """
         Get a "metadata row key" - metadata don't have timestamps/years.
         Other objects use this to look up entires in the metadata_cache.
         """
-        return get_rowkey(self.path, freq=self.freq)
+        return self._cached_key('meta', self.path, freq=self.freq)
         
     @property
     def min_last_update(self):
@@ -1022,7 +1661,9 @@ class Metadata(DataContainerBase):
     """
     Container for metadata information.
     """
-    
+    __slots__ = ('_min_ts', '_last_update', 'last_val', 'freq')
+
+    _doc_attrs = ['path', 'last_val', 'freq']
     _doc_properties = ['min_ts', 'last_update']
     
     def __init__(self, path=None, last_update=None, last_val=None, min_ts=None, freq=None):
@@ -1074,7 +1715,9 @@ class BaseRateBin(RawRateData):
     """
     Container for base rates.  Has 'average' property to return the averages.
     """
-    
+    __slots__ = ('is_valid',)
+
+    _doc_attrs = ['path', 'val', 'freq', 'is_valid']
     _doc_properties = ['ts']
     
     def __init__(self, path=None, ts=None, val=None, freq=None, is_valid=1):
@@ -1090,6 +1733,10 @@ class AggregationBin(BaseRateBin):
     """
     Container for aggregation rollups.  Also has 'average' property to generage averages.
     """
+    __slots__ = ('count', 'min', 'max', 'base_freq', 'cf')
+
+    _doc_attrs = ['path', 'val', 'freq', 'is_valid', 'count', 'min', 'max',
+        'base_freq', 'cf']
     
     def __init__(self, path=None, ts=None, val=None, freq=None, base_freq=None, count=None, 
             min=None, max=None, cf=None):
@@ -1113,15 +1760,58 @@ def escape_path(path):
 
     return escaped
 
-def get_rowkey(path, freq=None, year=None):
+class RowKeyCache(object):
     """
-    Given a path and some additional data build the Cassandra row key.
-
-    The freq and year arguments are used for internal book keeping inside
-    Cassandra.
+    Bounded cache of row keys keyed on (path tuple, freq, year).
+
+    The same handful of keys are built for every sample (raw data, base
+    rate and each rollup frequency) and for every query, so the keys are
+    built once and the same string object is handed out after that.
+
+    Eviction is generational: new keys go in the current generation and
+    once it holds half of maxsize entries it replaces the previous 
+    generation, dropping everything that wasn't used since the last 
+    switch.  Keys found in the previous generation are moved back to the
+    current one.  This bounds the memory used without the bookkeeping of
+    a strict LRU on every lookup.
     """
+    def __init__(self, maxsize=ROWKEY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._current = {}
+        self._previous = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def get(self, path, freq=None, year=None):
+        k = (tuple(path), freq, year)
+        try:
+            key = self._current[k]
+            self.hits += 1
+            return key
+        except KeyError:
+            pass
+
+        key = self._previous.pop(k, None)
+        if key is None:
+            self.misses += 1
+            key = _build_rowkey(path, freq, year)
+        else:
+            self.hits += 1
+
+        if len(self._current) >= self.maxsize / 2:
+            self._previous = self._current
+            self._current = {}
+        self._current[k] = key
+        return key
 
+    def clear(self):
+        self._current = {}
+        self._previous = {}
 
+def _build_rowkey(path, freq=None, year=None):
     appends = []
     if freq:
         appends.append(str(freq))
@@ -1130,6 +1820,24 @@ def get_rowkey(path, freq=None, year=None):
 
     return KEY_DELIMITER.join(escape_path(path) + appends)
 
+# Shared by the persister, the query code and the utilities.
+rowkey_cache = RowKeyCache()
+
+def get_rowkey(path, freq=None, year=None):
+    """
+    Given a path and some additional data build the Cassandra row key.
+
+    The freq and year arguments are used for internal book keeping inside
+    Cassandra.  Keys are served from rowkey_cache.
+    """
+    try:
+        return rowkey_cache.get(path, freq, year)
+    except TypeError:
+        # Unhashable path element, just build it.
+        return _build_rowkey(path, freq, year)
+
+_split_rowkey_res = {}
+
 def _split_rowkey(s, escape='\\'):
     """
     Return the elements of the rowkey taking escaping into account.
@@ -1138,20 +1846,20 @@ def _split_rowkey(s, escape='\\'):
     instances and needs to be used with specific knowledge of what kind of row
     key is used.
     """
-    indices = []
-
-    for i in range(len(s)):
-        if s[i] == KEY_DELIMITER:
-            if i > 0 and s[i-1] != escape:
-                indices.append(i)
-            elif i == 0:
-                indices.append(i)
-
-    out = []
-    last = 0
-    for i in indices:
-        out.append(s[last:i].replace(escape, ""))
-        last = i+1
-    out.append(s[last:])
+    if escape not in s:
+        # Nothing is escaped, which is the usual case.
+        return s.split(KEY_DELIMITER)
+
+    # Split on the delimiters that aren't preceded by the escape char and
+    # strip the escapes from all but the last element.
+    try:
+        split_re = _split_rowkey_res[escape]
+    except KeyError:
+        split_re = _split_rowkey_res[escape] = re.compile('(?<!%s)%s' %
+            (re.escape(escape), re.escape(KEY_DELIMITER)))
+
+    out = split_re.split(s)
+    for i in range(len(out) - 1):
+        out[i] = out[i].replace(escape, "")
 
     return out
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+On-disk cache of the closed time chunks of base rate and aggregation reads.
+
+Base rate and aggregation bins don't change any more once they are older
+than the largest aggregation window.  A ChunkCache splits the time range of
+a read into chunks aligned on multiples of their span (see chunk_span()):
+
+* a chunk is closed once it ended settle seconds ago.  The columns of a
+  closed chunk are read from the db once, written to a file of their own
+  and read from there by later queries.  Chunks without any columns are
+  written too (gaps are common), but only if the series exists, so
+  queries for paths that don't exist leave no files,
+* a chunk file is read from the db again once it is max_age seconds old,
+  which bounds how long rewrites of old bins by the persister go unseen,
+* the chunks that are not cached yet are read whole, the still open
+  chunks at the end of the range are read in one go and never cached,
+* a chunk file is a pickle written to a temporary file and renamed into
+  place, so the processes sharing the directory (the api processes of a
+  server) never see a partial chunk.  A chunk file that can't be read is
+  read from the db again,
+* the chunks hold the (ts, value) columns as read from the db so they
+  serve both list and columnar results.
+
+The files are kept until they are removed from the directory, which can
+be done at any time.  invalidate() removes the chunks of a path after
+data was written to it, remove them as well after rewriting old data.
+"""
+# Standard
+import cPickle as pickle
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+CHUNK_VERSION = 2
+
+# (finest frequency, chunk span) in ms - a day of bins finer than five
+# minutes, 30 days of bins up to a day and a year of coarser ones.
+CHUNK_SPANS = (
+    (300000, 86400000),
+    (86400000, 30 * 86400000),
+)
+LONGEST_CHUNK_SPAN = 365 * 86400000
+
+def chunk_span(freq):
+    """Return the span in ms of the chunks of bins of freq ms."""
+    for limit, span in CHUNK_SPANS:
+        if freq < limit:
+            return span
+    return LONGEST_CHUNK_SPAN
+
+class ChunkCache(object):
+    """
+    Cache of the closed chunks of reads in directory.  See the module
+    docstring.
+    """
+    def __init__(self, directory, settle=86400, max_age=604800, log=None):
+        self.directory = directory
+        self.settle = settle
+        self.max_age = max_age
+        self.log = log
+
+        self.hits = 0
+        self.misses = 0
+
+    def _path_dir(self, cf_name, path):
+        key = hashlib.sha1(':'.join([str(p) for p in path])).hexdigest()
+        return os.path.join(self.directory, cf_name, key[:2], key)
+
+    def _path(self, cf_name, path, freq, start):
+        return os.path.join(self._path_dir(cf_name, path), str(freq),
+            '%d.chunk' % start)
+
+    def _load(self, filename, now):
+        try:
+            with open(filename, 'rb') as fp:
+                chunk = pickle.load(fp)
+        except IOError:
+            return None
+        except Exception, e:
+            if self.log:
+                self.log.error('unable to read chunk %s: %s' % (filename, e))
+            return None
+        if not isinstance(chunk, dict) or chunk.get('version') != CHUNK_VERSION:
+            return None
+        if now > chunk['time'] + self.max_age:
+            return None
+        return chunk['columns']
+
+    def _save(self, filename, columns, now):
+        dirname = os.path.dirname(filename)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fp:
+                pickle.dump(dict(version=CHUNK_VERSION, time=now,
+                    columns=columns), fp, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, filename)
+        except (IOError, OSError), e:
+            if self.log:
+                self.log.error('unable to write chunk %s: %s' % (filename, e))
+
+    def rows(self, cf_name, path, freq, ts_min, ts_max, read, exists=None,
+            now=None):
+        """
+        Generator over the (ts, value) columns of the column family
+        cf_name between ts_min and ts_max (in ms) for path and freq, in
+        time order.  read(ts_min, ts_max) reads the columns of another
+        range from the db.  exists() returns whether the series has any
+        data, empty chunks are only saved if it does (or there is no
+        exists).
+        """
+        if now is None:
+            now = time.time()
+        closed = int((now - self.settle) * 1000)
+        span = chunk_span(freq)
+        found = None
+
+        start = (ts_min // span) * span
+        while start <= ts_max:
+            end = start + span
+            if end > closed:
+                # This chunk and the ones after it are still open.
+                for col in read(max(ts_min, start), ts_max):
+                    yield col
+                return
+
+            filename = self._path(cf_name, path, freq, start)
+            columns = self._load(filename, now)
+            if columns is None:
+                self.misses += 1
+                columns = list(read(start, end - 1))
+                if not columns and exists is not None and found is None:
+                    found = exists()
+                if columns or found is not False:
+                    self._save(filename, columns, now)
+            else:
+                self.hits += 1
+
+            if ts_min <= start and end - 1 <= ts_max:
+                for col in columns:
+                    yield col
+            else:
+                for col in columns:
+                    if ts_min <= col[0] <= ts_max:
+                        yield col
+            start = end
+
+    def invalidate(self, path):
+        """Remove the chunks of path in every column family."""
+        try:
+            cf_names = os.listdir(self.directory)
+        except OSError:
+            return
+        for cf_name in cf_names:
+            shutil.rmtree(self._path_dir(cf_name, path), ignore_errors=True)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses)
@@ -50,6 +50,9 @@ class EsmondConfig(object):
         self.agg_tsdb_root = None
         self.allowed_hosts = []
         self.api_anon_limit = None
+        self.api_query_cache_max_age = 600
+        self.api_query_cache_settle = 300
+        self.api_query_cache_size = 0
         self.api_throttle_at = None
         self.api_throttle_timeframe = None
         self.api_throttle_expiration = None
@@ -58,6 +61,11 @@ class EsmondConfig(object):
         self.cassandra_servers = []
         self.cassandra_user = None
         self.cassandra_replicas = 1
+        self.cassandra_write_threads = 0
+        self.cassandra_write_window = 16
+        self.chunk_cache_dir = None
+        self.chunk_cache_max_age = 604800
+        self.chunk_cache_settle = 86400
         # Leave this here so testing code can explicitly set but remove
         # from config file parsing.
         self.db_clear_on_testing = False
@@ -72,6 +80,7 @@ class EsmondConfig(object):
         self.htpasswd_file = None
         self.mib_dirs = []
         self.mibs = []
+        self.persist_cache_dir = None
         self.pid_dir = None
         self.poll_retries = 5
         self.poll_timeout = 2
@@ -88,6 +97,7 @@ class EsmondConfig(object):
         self.streaming_log_dir = None
         self.syslog_facility = None
         self.syslog_priority = None
+        self.timeseries_backend = 'cassandra'
         self.traceback_dir = None
         self.tsdb_chunk_prefixes = None
         self.tsdb_root = None
@@ -111,12 +121,20 @@ class EsmondConfig(object):
                 'agg_tsdb_root',
                 'allowed_hosts',
                 'api_anon_limit',
+                'api_query_cache_max_age',
+                'api_query_cache_settle',
+                'api_query_cache_size',
                 'api_throttle_at',
                 'api_throttle_timeframe',
                 'api_throttle_expiration',
                 'cassandra_pass',
                 'cassandra_servers',
                 'cassandra_user',
+                'cassandra_write_threads',
+                'cassandra_write_window',
+                'chunk_cache_dir',
+                'chunk_cache_max_age',
+                'chunk_cache_settle',
                 'db_profile_on_testing',
                 'db_uri',
                 'debug',
@@ -129,6 +147,7 @@ class EsmondConfig(object):
                 'htpasswd_file',
                 'mib_dirs',
                 'mibs',
+                'persist_cache_dir',
                 'pid_dir',
                 'poll_retries',
                 'poll_timeout',
@@ -144,6 +163,7 @@ class EsmondConfig(object):
                 'streaming_log_dir',
                 'syslog_facility',
                 'syslog_priority',
+                'timeseries_backend',
                 'traceback_dir',
                 'tsdb_chunk_prefixes',
                 'tsdb_root',
@@ -172,6 +192,23 @@ class EsmondConfig(object):
             self.persist_queues[key] = val.split(':', 1)
             self.persist_queues[key][1] = int(self.persist_queues[key][1])
 
+        self.persist_formats = {}
+        if cfg.has_section("persist_formats"):
+            for key, val in cfg.items("persist_formats"):
+                if key == 'esmond_root': continue
+                self.persist_formats[key] = val.strip()
+
+        self.persist_autoscale = {}
+        if cfg.has_section("persist_autoscale"):
+            for key, val in cfg.items("persist_autoscale"):
+                if key == 'esmond_root': continue
+                try:
+                    lo, hi = [int(x) for x in val.split(':', 1)]
+                except ValueError:
+                    raise ConfigError("invalid config: persist_autoscale "
+                            "%s must be min:max" % key)
+                self.persist_autoscale[key] = (lo, hi)
+
         if self.espoll_persist_uri:
             self.espoll_persist_uri = \
                 self.espoll_persist_uri.replace(' ', '').split(',')
@@ -189,6 +226,13 @@ class EsmondConfig(object):
             self.mibs = map(str.strip, self.mibs.split(','))
         if self.cassandra_servers:
             self.cassandra_servers = map(str.strip, self.cassandra_servers.split(','))
+        self.api_query_cache_max_age = int(self.api_query_cache_max_age)
+        self.api_query_cache_settle = int(self.api_query_cache_settle)
+        self.api_query_cache_size = int(self.api_query_cache_size)
+        self.cassandra_write_threads = int(self.cassandra_write_threads)
+        self.cassandra_write_window = int(self.cassandra_write_window)
+        self.chunk_cache_max_age = int(self.chunk_cache_max_age)
+        self.chunk_cache_settle = int(self.chunk_cache_settle)
         if self.poll_timeout:
             self.poll_timeout = int(self.poll_timeout)
         if self.poll_retries:
@@ -203,6 +247,9 @@ class EsmondConfig(object):
             self.api_throttle_timeframe = int(self.api_throttle_timeframe)
         if self.api_throttle_expiration:
             self.api_throttle_expiration = int(self.api_throttle_expiration)
+        if self.timeseries_backend not in ('cassandra', 'memory'):
+            raise ConfigError("invalid config: unknown timeseries_backend %s" %
+                    self.timeseries_backend)
 
 
 
@@ -274,4 +321,12 @@ class EsmondConfig(object):
             raise ConfigError("unknown persist queue(s): %s" \
                     % ", ".join(errors))
 
+        for queue, (lo, hi) in self.persist_autoscale.iteritems():
+            if not self.persist_queues.has_key(queue):
+                raise ConfigError("invalid config: persist_autoscale for "
+                        "unknown queue %s" % queue)
+            if lo < 1 or hi < lo:
+                raise ConfigError("invalid config: persist_autoscale %s "
+                        "needs 1 <= min <= max" % queue)
+
 
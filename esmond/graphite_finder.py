@@ -9,6 +9,10 @@ from esmond.api.client.snmp import ApiConnect, ApiFilters
 from esmond.api.client.timeseries import GetRawData, GetBaseRate
 from esmond.api.client.util import atencode, atdecode
 
+# Datapoints requested for each SNMP series whatever the time range, about
+# the width in pixels of a graph.
+MAX_POINTS = 1000
+
 class EsmondFinder:
     """Finder to integrate Graphite with esmond.
 
@@ -28,12 +32,17 @@ class EsmondFinder:
 
         http://localhost:8000/render/?target=timeseries.raw.foo.bar.baz.30000
 
+    SNMP data is requested with at most max_points datapoints, esmond picks
+    the aggregation and downsamples the data to that.  Set max_points to 
+    None to get every base rate or aggregation of the time range.
     """
-    def __init__(self, uri, username=None, apikey=None, debug=True):
+    def __init__(self, uri, username=None, apikey=None, debug=True,
+            max_points=MAX_POINTS):
         self.uri = uri
         self.username = username
         self.apikey = apikey
         self.debug = debug
+        self.max_points = max_points
 
         filters = ApiFilters()
 
@@ -80,7 +89,8 @@ class EsmondFinder:
                 if self.debug:
                     print "[LEAF SIBLING {0}]".format(leaf_path)
 
-                reader = EsmondReader(obj, query.startTime, query.endTime, debug=self.debug)
+                reader = EsmondReader(obj, query.startTime, query.endTime,
+                    debug=self.debug, points=self.max_points)
                 yield EsmondLeaf(leaf_path, reader, name=obj.name, label=obj.name)
             else:
                 for child in obj.children:
@@ -92,7 +102,8 @@ class EsmondFinder:
                         if self.debug:
                             print "[LEAF CHILD {0}]".format(child)
                         endpoint = obj.get_endpoint(child.get("name"))
-                        reader = EsmondReader(endpoint, query.startTime, query.endTime, debug=self.debug)
+                        reader = EsmondReader(endpoint, query.startTime, query.endTime,
+                            debug=self.debug, points=self.max_points)
                         yield EsmondLeaf(child_path, reader, name=child['name'], label=child['label'])
                     else:
                         yield EsmondBranch(child_path, name=child['name'], label=child['label'])
@@ -145,25 +156,22 @@ class EsmondReader(object):
     """Reader for esmond data.
 
     If the data is from the raw timeseries section of esmond, then `timeseries`
-    should be set to True. Raw timeseries data will not be multiplied by 8."""
+    should be set to True. Raw timeseries data will not be multiplied by 8.
+
+    If `points` is set SNMP data is fetched with at most that many datapoints.
+    esmond picks the aggregation for the time range and merges consecutive
+    bins so the step of the series is derived from the data."""
 
-    def __init__(self, endpoint, start_time, end_time, debug=False, timeseries=False):
+    def __init__(self, endpoint, start_time, end_time, debug=False, timeseries=False,
+            points=None):
         self.endpoint = endpoint
         self.start_time = start_time
         self.end_time = end_time
         self.timeseries = timeseries
         self.debug = debug
+        self.points = points
 
         if start_time and end_time:
-            if end_time - start_time > 6*30*24*3600:
-                self.step = 86400
-            elif end_time - start_time > 30*24*3600:
-                self.step = 3600
-            elif end_time - start_time > 24*3600:
-                self.step = 300
-            else:
-                self.step = None
-
             self.intervals = IntervalSet([Interval(start_time, end_time)])
         else:
             self.intervals = IntervalSet([Interval(0, 2**32 -1)])
@@ -174,6 +182,9 @@ class EsmondReader(object):
     def fetch(self, start_time, end_time):
         if self.timeseries:
             payload = self.endpoint.get_data()
+        elif self.points:
+            payload = self.endpoint.get_data(begin=start_time, end=end_time,
+                points=self.points)
         else:
             payload = self.endpoint.get_data(begin=start_time, end=end_time)
 
@@ -186,6 +197,9 @@ class EsmondReader(object):
                 data.append(d.val)
 
         agg = int(payload.agg)
+        if self.points and not self.timeseries and len(payload.data) > 1:
+            # Downsampled datapoints are spaced by a number of bins.
+            agg = payload.data[1].ts_epoch - payload.data[0].ts_epoch
         expected_len = int(((end_time - start_time) / agg)-1)
         if expected_len > len(data):
             nones = [None] * (expected_len - len(data))
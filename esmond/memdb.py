@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+In-process reference implementation of the esmond time series store.
+
+MEMORY_DB keeps the raw_data, base_rates, rate_aggregations and
+stat_aggregations column families in sorted in-memory rows that mimic the
+subset of the pycassa ColumnFamily and batch (CfMutator) interfaces used by
+TimeSeriesStore:
+
+* columns within a row are kept in comparator (sorted) order and sliced
+  with bisect so range and reversed range queries behave like Cassandra,
+* counter column families add on insert rather than overwrite,
+* super column families store a sorted set of subcolumns per column,
+* reads that find nothing raise pycassa's NotFoundException.
+
+Column families are shared by every MEMORY_DB in the process that uses
+the same keyspace name, so data written by a persister can be read back
+by a separate query instance as it would be with a real cluster.  TTLs are
+accepted but ignored and nothing is persisted across restarts.
+"""
+# Standard
+import bisect
+import threading
+from collections import OrderedDict
+
+# Third party
+from pycassa.columnfamily import NotFoundException
+
+from esmond.cassandra import TimeSeriesStore
+
+_keyspaces = {}
+_keyspace_lock = threading.Lock()
+
+def _bounded(v):
+    return v is not None and v != ''
+
+class _SortedRow(object):
+    """
+    A single row (or super column) - a dict of column values plus a
+    list of the column names in sorted order.
+    """
+    __slots__ = ('cols', 'names')
+
+    def __init__(self):
+        self.cols = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def set(self, name, val):
+        if name not in self.cols:
+            # Data almost always arrives in time order so the common
+            # case is an append.
+            if not self.names or name > self.names[-1]:
+                self.names.append(name)
+            else:
+                bisect.insort(self.names, name)
+        self.cols[name] = val
+
+    def delete(self, name):
+        if name in self.cols:
+            del self.cols[name]
+            del self.names[bisect.bisect_left(self.names, name)]
+
+    def slice(self, columns=None, column_start='', column_finish='',
+            column_reversed=False, column_count=None):
+        """Return the column names matching the slice in result order."""
+        if columns is not None:
+            names = sorted([c for c in columns if c in self.cols],
+                reverse=column_reversed)
+        elif not column_reversed:
+            lo = bisect.bisect_left(self.names, column_start) \
+                if _bounded(column_start) else 0
+            hi = bisect.bisect_right(self.names, column_finish) \
+                if _bounded(column_finish) else len(self.names)
+            names = self.names[lo:hi]
+        else:
+            # Reversed slices start at the high end - column_start is
+            # the upper bound and column_finish the lower bound.
+            lo = bisect.bisect_left(self.names, column_finish) \
+                if _bounded(column_finish) else 0
+            hi = bisect.bisect_right(self.names, column_start) \
+                if _bounded(column_start) else len(self.names)
+            names = self.names[lo:hi][::-1]
+
+        if column_count is not None:
+            names = names[:column_count]
+        return names
+
+class MemoryColumnFamily(object):
+    """
+    Sorted in-memory column family with the read/write calls of a
+    pycassa ColumnFamily.
+    """
+    def __init__(self, name, super=False, counter=False):
+        self.column_family = name
+        self.super = super
+        self.counter = counter
+        self._rows = {}
+        self._lock = threading.RLock()
+
+    def _columns(self, target, names, nested):
+        if nested:
+            ret = OrderedDict()
+            for n in names:
+                sub = target.cols[n]
+                ret[n] = OrderedDict([(s, sub.cols[s]) for s in sub.names])
+            return ret
+        return OrderedDict([(n, target.cols[n]) for n in names])
+
+    def _slice(self, key, columns, column_start, column_finish,
+            column_reversed, column_count, super_column):
+        row = self._rows.get(key)
+        if row is None:
+            return None
+        nested = self.super and super_column is None
+        if super_column is not None:
+            row = row.cols.get(super_column)
+            if row is None:
+                return None
+        names = row.slice(columns, column_start, column_finish,
+            column_reversed, column_count)
+        if not names:
+            return None
+        return self._columns(row, names, nested)
+
+    def get(self, key, columns=None, column_start='', column_finish='',
+            column_reversed=False, column_count=100, super_column=None,
+            read_consistency_level=None):
+        with self._lock:
+            ret = self._slice(key, columns, column_start, column_finish,
+                column_reversed, column_count, super_column)
+        if ret is None:
+            raise NotFoundException()
+        return ret
+
+    def multiget(self, keys, columns=None, column_start='', column_finish='',
+            column_reversed=False, column_count=100, super_column=None,
+            read_consistency_level=None, buffer_size=None):
+        ret = OrderedDict()
+        with self._lock:
+            for key in keys:
+                cols = self._slice(key, columns, column_start, column_finish,
+                    column_reversed, column_count, super_column)
+                if cols is not None:
+                    ret[key] = cols
+        return ret
+
+    def xget(self, key, column_start='', column_finish='', column_reversed=False,
+            column_count=None, include_timestamp=False,
+            read_consistency_level=None, buffer_size=1024, include_ttl=False):
+        """
+        Generator over the (name, value) pairs of a row, read buffer_size
+        columns at a time like pycassa does.  A missing row yields nothing.
+        """
+        nested = self.super
+        returned = 0
+        while column_count is None or returned < column_count:
+            page = buffer_size
+            if column_count is not None:
+                page = min(page, column_count - returned)
+            with self._lock:
+                row = self._rows.get(key)
+                if row is None:
+                    return
+                names = row.slice(None, column_start, column_finish,
+                    column_reversed, page + 1 if returned else page)
+                if returned and names and names[0] == column_start:
+                    # The last column of the previous page.
+                    names = names[1:]
+                names = names[:page]
+                cols = self._columns(row, names, nested)
+            if not names:
+                return
+            for item in cols.iteritems():
+                yield item
+            returned += len(names)
+            column_start = names[-1]
+
+    def multiget_count(self, keys, super_column=None,
+            read_consistency_level=None, columns=None, column_start='',
+            column_finish='', buffer_size=None):
+        ret = OrderedDict()
+        with self._lock:
+            for key in keys:
+                cols = self._slice(key, columns, column_start, column_finish,
+                    False, None, super_column)
+                ret[key] = len(cols) if cols else 0
+        return ret
+
+    def get_range(self, start='', finish='', columns=None, column_start='',
+            column_finish='', column_reversed=False, column_count=100,
+            row_count=None, super_column=None, read_consistency_level=None,
+            buffer_size=None, filter_empty=True):
+        """
+        Generator over (key, columns) for all rows between the start and
+        finish keys.  Unlike a RandomPartitioner ring, rows are returned in
+        key order.
+        """
+        with self._lock:
+            keys = sorted(self._rows.keys())
+        returned = 0
+        for key in keys:
+            if _bounded(start) and key < start:
+                continue
+            if _bounded(finish) and key > finish:
+                break
+            if row_count is not None and returned >= row_count:
+                break
+            with self._lock:
+                cols = self._slice(key, columns, column_start, column_finish,
+                    column_reversed, column_count, super_column)
+            if cols is None:
+                if filter_empty:
+                    continue
+                cols = OrderedDict()
+            returned += 1
+            yield key, cols
+
+    def _set(self, row, name, val):
+        if self.counter:
+            val = row.cols.get(name, 0) + val
+        row.set(name, val)
+
+    def insert(self, key, columns, ttl=None):
+        if not columns:
+            return
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                row = self._rows[key] = _SortedRow()
+            for name, val in columns.items():
+                if self.super:
+                    sub = row.cols.get(name)
+                    if sub is None:
+                        sub = _SortedRow()
+                        row.set(name, sub)
+                    for sub_name, sub_val in val.items():
+                        self._set(sub, sub_name, sub_val)
+                else:
+                    self._set(row, name, val)
+
+    def remove(self, key, columns=None, super_column=None):
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                return
+            if super_column is not None:
+                sub = row.cols.get(super_column)
+                if sub is not None:
+                    for name in list(sub.names if columns is None else columns):
+                        sub.delete(name)
+                    if not sub:
+                        row.delete(super_column)
+            elif columns is not None:
+                for name in columns:
+                    row.delete(name)
+            else:
+                row = _SortedRow()
+            if not row:
+                del self._rows[key]
+
+    def truncate(self):
+        with self._lock:
+            self._rows = {}
+
+    def batch(self, queue_size=100):
+        return MemoryMutator(self, queue_size)
+
+class MemoryMutator(object):
+    """
+    Batch interface for a MemoryColumnFamily.  Mutations are queued and
+    applied in order on send(), which happens automatically once
+    queue_size mutations are pending.
+    """
+    def __init__(self, column_family, queue_size=100):
+        self._column_family = column_family
+        self._queue_size = queue_size
+        self._buffer = []
+        self._lock = threading.Lock()
+
+    def _enqueue(self, mutation):
+        with self._lock:
+            self._buffer.append(mutation)
+            full = self._queue_size and len(self._buffer) >= self._queue_size
+        if full:
+            self.send()
+
+    def insert(self, key, columns, ttl=None):
+        if columns:
+            # Copy so later changes to the caller's dicts don't leak into
+            # the pending mutation.
+            columns = dict([(k, dict(v) if isinstance(v, dict) else v)
+                for k, v in columns.items()])
+            self._enqueue((self._column_family.insert, (key, columns, ttl)))
+
+    def remove(self, key, columns=None, super_column=None):
+        self._enqueue((self._column_family.remove, (key, columns, super_column)))
+
+    def send(self):
+        with self._lock:
+            buf, self._buffer = self._buffer, []
+        for fn, args in buf:
+            fn(*args)
+
+class MEMORY_DB(TimeSeriesStore):
+    """
+    TimeSeriesStore implementation backed by MemoryColumnFamily objects.
+    Selected with timeseries_backend = memory.
+    """
+    def _setup_column_families(self, config):
+        with _keyspace_lock:
+            if config.db_clear_on_testing and self.keyspace in _keyspaces:
+                # Truncate in place so other instances sharing the
+                # keyspace see the cleared data like they would with
+                # a real cluster.
+                self.log.info('Dropping keyspace %s' % self.keyspace)
+                for cf in _keyspaces[self.keyspace].values():
+                    cf.truncate()
+            if self.keyspace not in _keyspaces:
+                self.log.info('Creating keyspace %s' % self.keyspace)
+                _keyspaces[self.keyspace] = {
+                    self.raw_cf: MemoryColumnFamily(self.raw_cf),
+                    self.rate_cf: MemoryColumnFamily(self.rate_cf,
+                        super=True, counter=True),
+                    self.agg_cf: MemoryColumnFamily(self.agg_cf,
+                        super=True, counter=True),
+                    self.stat_cf: MemoryColumnFamily(self.stat_cf,
+                        super=True),
+                }
+            cfs = _keyspaces[self.keyspace]
+
+        self.raw_data = cfs[self.raw_cf].batch(self._queue_size)
+        self.rates    = cfs[self.rate_cf].batch(self._queue_size)
+        self.aggs     = cfs[self.agg_cf].batch(self._queue_size)
+        self.stat_agg = cfs[self.stat_cf].batch(self._queue_size)
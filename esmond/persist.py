@@ -7,6 +7,12 @@ import sys
 import time
 import signal
 import errno
+import fcntl
+import select
+import struct
+import bisect
+import hashlib
+import calendar
 import datetime
 import cProfile
 import pstats
@@ -18,6 +24,7 @@ from subprocess import Popen, PIPE, STDOUT
 import cPickle as pickle
 
 import json
+import marshal
 
 import django
 from django.utils.timezone import now, utc, make_aware
@@ -30,17 +37,28 @@ try:
 except ImportError:
     tsdb = None
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 from esmond.util import setproctitle, init_logging, get_logger, \
         remove_metachars,  build_alu_sap_name
 from esmond.util import daemonize, setup_exc_handler, max_datetime
 from esmond.config import get_opt_parser, get_config, get_config_path
 from esmond.error import ConfigError
-from esmond.api.dataseries import fit_to_bins
+from esmond.api.dataseries import fit_to_bins_batch
 
 from esmond.api.models import Device, OIDSet, IfRef, ALUSAPRef, LSPOpStatus, \
-                              OutletRef
+                              OutletRef, DeviceOIDSetMap
 
-from esmond.cassandra import CASSANDRA_DB, RawRateData, BaseRateBin, AggregationBin, MaximumRetryException
+from esmond.cassandra import get_timeseries_db, get_rowkey, KEY_DELIMITER, \
+     RawData, RawRateData, BaseRateBin, AggregationBin, MaximumRetryException
 
 
 try:
@@ -52,7 +70,26 @@ except ImportError:
         raise Exception('no memcache library found')
 
 PERSIST_SLEEP_TIME = 1
+# How long results for keys handed over from another worker are held back
+# waiting for that worker to catch up, see PollPersister.check_handoffs().
+HANDOFF_TIMEOUT = 300
 HEARTBEAT_FREQ_MULTIPLIER = 3
+WARMUP_THREADS = 4
+CACHE_JOURNAL_MAX_SIZE = 64 * 1024 * 1024
+# How often the open stat aggregation bins are written.
+STAT_CHECKPOINT_INTERVAL = 60
+# How often the summed rate aggregation increments of the open bins are
+# written.  Sums not written when a persister dies are lost.
+RATE_FLUSH_INTERVAL = 300
+
+# Correlators whose variable names can be rebuilt from the IfRef table,
+# used to find the measurements a persister will see at start up.
+WARMUP_CORRELATORS = {
+    'IfNameCorrelator': lambda ifref: ifref.ifName if ifref.ifAlias else None,
+    'InfIfNameCorrelator':
+        lambda ifref: ifref.ifName.split('=')[1] if '=' in ifref.ifName \
+            else ifref.ifName,
+}
 
 class PollResult(object):
     """PollResult contains the results of a polling run.
@@ -105,12 +142,116 @@ class PollResult(object):
             data=self.data,
             metadata=self.metadata))
 
+class PollResultFormat(object):
+    """Encoding of PollResults in the persist queues.
+
+    Every format except the original JSON encoding starts with a header of
+    FORMAT_MAGIC, a format id byte and a version byte so readers can 
+    decode any format - queues can be switched to a new format once all 
+    of their readers understand it and old and new writers can share a 
+    queue while that happens."""
+    name = None
+    format_id = None
+
+    def dumps(self, result):
+        raise NotImplementedError
+
+    def loads(self, data):
+        """Return the keyword arguments for a PollResult."""
+        raise NotImplementedError
+
+    def header(self):
+        return FORMAT_MAGIC + chr(self.format_id) + chr(FORMAT_VERSION)
+
+POLL_RESULT_FIELDS = ('oidset_name', 'device_name', 'oid_name', 'timestamp',
+        'data', 'metadata')
+FORMAT_MAGIC = '\xffE'
+FORMAT_VERSION = 1
+FORMAT_HEADER_SIZE = len(FORMAT_MAGIC) + 2
+
+class JsonResultFormat(PollResultFormat):
+    """The original format: PollResult.json() without a header."""
+    name = 'json'
+
+    def dumps(self, result):
+        return result.json() # .dumps() is being called in the PollResult method
+
+    def loads(self, data):
+        return json.loads(data)
+
+class MarshalResultFormat(PollResultFormat):
+    """The PollResult fields as a marshalled tuple.  Several times faster
+    than JSON but only readable by the same major Python version."""
+    name = 'marshal'
+    format_id = 1
+
+    def dumps(self, result):
+        return self.header() + marshal.dumps(tuple([getattr(result, f)
+            for f in POLL_RESULT_FIELDS]))
+
+    def loads(self, data):
+        return dict(zip(POLL_RESULT_FIELDS,
+            marshal.loads(data[FORMAT_HEADER_SIZE:])))
+
+class MsgpackResultFormat(PollResultFormat):
+    """The PollResult fields as a msgpack array.  Requires msgpack."""
+    name = 'msgpack'
+    format_id = 2
+
+    def dumps(self, result):
+        return self.header() + msgpack.packb([getattr(result, f)
+            for f in POLL_RESULT_FIELDS])
+
+    def loads(self, data):
+        return dict(zip(POLL_RESULT_FIELDS,
+            msgpack.unpackb(data[FORMAT_HEADER_SIZE:])))
+
+RESULT_FORMATS = dict([(f.name, f) for f in (JsonResultFormat,
+    MarshalResultFormat, MsgpackResultFormat)])
+RESULT_FORMAT_IDS = dict([(f.format_id, f()) for f in (MarshalResultFormat,
+    MsgpackResultFormat)])
+
+def get_result_format(name=None):
+    """Return a PollResultFormat by name, JSON if name is None."""
+    if name is None:
+        name = JsonResultFormat.name
+    try:
+        klass = RESULT_FORMATS[name]
+    except KeyError:
+        raise ConfigError("unknown persist queue format: %s" % name)
+    if klass is MsgpackResultFormat and msgpack is None:
+        raise ConfigError("persist queue format msgpack requires msgpack")
+    return klass()
+
+def loads_result(data):
+    """Decode a PollResult encoded in any format, returns the keyword
+    arguments for a PollResult."""
+    if not data.startswith(FORMAT_MAGIC):
+        return json.loads(data)
+
+    format_id = ord(data[len(FORMAT_MAGIC)])
+    version = ord(data[len(FORMAT_MAGIC) + 1])
+    try:
+        fmt = RESULT_FORMAT_IDS[format_id]
+    except KeyError:
+        raise ValueError("unknown persist queue format id %d" % format_id)
+    if version > FORMAT_VERSION:
+        raise ValueError("unsupported %s format version %d" % (fmt.name,
+            version))
+    return fmt.loads(data)
+
+
 class PersistQueueEmpty:
     pass
 
 class PollPersister(object):
     """A PollPersister implements a storage method for PollResults."""
     STATS_INTERVAL = 60
+    # Maximum number of results read from the queue at once.
+    BATCH_SIZE = 100
+    HANDOFF_CHECK_INTERVAL = 1
+    # Maximum number of results held back during handoffs.
+    HANDOFF_MAX_HELD = 100000
 
     def __init__(self, config, qname, persistq):
         self.log = get_logger("espersistd.%s" % qname)
@@ -122,19 +263,127 @@ class PollPersister(object):
         if persistq:
             self.persistq = persistq
         else:
-            self.persistq = MemcachedPersistQueue(qname, config.espersistd_uri)
+            self.persistq = get_persist_queue(qname, config.espersistd_uri)
 
         self.data_count = 0
+        self.store_time = 0.0
         self.last_stats = time.time()
 
+        # handoff state, see check_handoffs()
+        self.handoff_sources = {}
+        self.handoffs_done = set()
+        self.fenced = set()
+        self.held = []
+        self.last_handoff_check = 0
+        self.drained = False
+
     def store(self, result):
         pass
 
+    def store_batch(self, results):
+        """Store a list of results, can be overridden in subclasses that
+        can handle several results more efficiently than one at a time."""
+        for result in results:
+            self.store(result)
+
     def flush(self):
         """Can be overridden in subclasses if one wishes to perform
         some maintenance during a sleep state."""
         pass
 
+    def warm_up(self):
+        """Can be overridden in subclasses to prepare any state before
+        the first result is read from the queue."""
+        pass
+
+    def _handoff_source(self, qname):
+        try:
+            return self.handoff_sources[qname]
+        except KeyError:
+            q = self.handoff_sources[qname] = get_persist_queue(qname,
+                self.config.espersistd_uri)
+            return q
+
+    def _caught_up(self, q, position):
+        if position is None:
+            return True
+        pos = q.read_position()
+        return pos is not None and pos >= position
+
+    def check_handoffs(self, tasks):
+        """
+        Return the tasks that can be stored now.
+
+        When a MultiWorkerQueue moves keys between workers the new worker
+        is sent a handoff listing the keys and the end of the old worker's
+        queue at the time.  Results for those keys are held back until the
+        old worker has read that far, so the results of a measurement are
+        always stored in order by one worker at a time.  Handoffs are given
+        up after HANDOFF_TIMEOUT seconds, e.g. if the old worker is gone.
+
+        This also notices when espolld has retired this worker and stops
+        it once its queue is empty.
+        """
+        now = time.time()
+        if now > self.last_handoff_check + self.HANDOFF_CHECK_INTERVAL and \
+                hasattr(self.persistq, 'get_state'):
+            self.last_handoff_check = now
+
+            fenced = set()
+            for h in self.persistq.get_state('handoff') or []:
+                if h['id'] in self.handoffs_done:
+                    continue
+                if now > h['time'] + HANDOFF_TIMEOUT:
+                    self.log.warning("handoff from %s timed out" % h['queue'])
+                elif not self._caught_up(self._handoff_source(h['queue']),
+                        h['position']):
+                    fenced.update(h['keys'])
+                    continue
+                self.handoffs_done.add(h['id'])
+            self.fenced = fenced
+
+            # A None position is a queue that was empty when the worker
+            # was retired.
+            retired = self.persistq.get_state('retired')
+            if retired is not None and not tasks and not self.held and \
+                    self._caught_up(self.persistq, retired['position']):
+                self.log.info("worker retired and queue drained, exiting")
+                self.drained = True
+                self.running = False
+
+        if len(self.held) > self.HANDOFF_MAX_HELD:
+            self.log.error("%d results held for handoffs, storing them" %
+                len(self.held))
+            self.fenced = set()
+
+        if not self.fenced and not self.held:
+            return tasks
+
+        ready = []
+        held = []
+        for task in self.held + tasks:
+            if ':'.join((task.oidset_name, task.device_name)) in self.fenced:
+                held.append(task)
+            else:
+                ready.append(task)
+        self.held = held
+        return ready
+
+    def report_stats(self, now):
+        """Log the write rate and publish the store latency per record
+        on the queue, which MultiWorkerQueue uses to balance the load
+        between workers."""
+        elapsed = now - self.last_stats
+        self.log.info("%d records written, %f records/sec" % \
+                (self.data_count, float(self.data_count) / elapsed))
+        if self.data_count and hasattr(self.persistq, 'set_state'):
+            self.persistq.set_state('load', dict(time=now,
+                latency=self.store_time / self.data_count,
+                busy=self.store_time / elapsed))
+        self.data_count = 0
+        self.store_time = 0.0
+        self.last_stats = now
+
     def stop(self, x, y):
         self.log.debug("stop")
         self.running = False
@@ -149,29 +398,26 @@ class PollPersister(object):
             pr = cProfile.Profile()
             pr.enable()
 
+        # Blocking queues wake us up when data arrives so there is no
+        # need to sleep between polls.
+        blocking = getattr(self.persistq, 'blocking', False)
+
         while self.running:
             try:
-                task = self.persistq.get()
+                tasks = self.check_handoffs(self._get_tasks(blocking))
             except PersistQueueEmpty:
                 break
 
-            # XXX(jdugan): task can be None for two reasons here:
-            # 1. there was no result
-            # 2. the result was None
-            # this means that Nones are consumed very slowly, this should be
-            # revisited.
-
-            if task:
-                self.store(task)
-                self.data_count += len(task.data)
+            if tasks:
+                t0 = time.time()
+                self.store_batch(tasks)
                 now = time.time()
+                self.store_time += now - t0
+                for task in tasks:
+                    self.data_count += len(task.data)
                 if now > self.last_stats + self.STATS_INTERVAL:
-                    self.log.info("%d records written, %f records/sec" % \
-                            (self.data_count,
-                                float(self.data_count) / self.STATS_INTERVAL))
-                    self.data_count = 0
-                    self.last_stats = now
-                del task
+                    self.report_stats(now)
+                del tasks
                 self.sleeping = False
             else:
                 if not self.sleeping:
@@ -179,7 +425,8 @@ class PollPersister(object):
                     self.sleeping = True
                     if self.config.debug:
                         django.db.reset_queries()
-                time.sleep(PERSIST_SLEEP_TIME)
+                if not blocking:
+                    time.sleep(PERSIST_SLEEP_TIME)
 
         if self.config.profile_persister:
             pr.disable()
@@ -190,6 +437,19 @@ class PollPersister(object):
             pstats.Stats(pr, stream=fh).strip_dirs().sort_stats(sortby).print_stats()
             fh.close()
 
+    def _get_tasks(self, blocking):
+        """Return the next batch of results from the queue or an empty
+        list if there are none."""
+        if hasattr(self.persistq, 'get_many'):
+            return self.persistq.get_many(self.BATCH_SIZE,
+                    timeout=PERSIST_SLEEP_TIME if blocking else 0)
+
+        # Queues that only implement get().
+        task = self.persistq.get()
+        if task:
+            return [task]
+        return []
+
 
 class StreamingPollPersister(PollPersister):
     """A StreamingPollPersister stores PollResults to a log file.
@@ -403,10 +663,23 @@ class CassandraPollPersister(PollPersister):
         # testing env var is set will result in the target keyspace
         # and all of its data being deleted and rebuilt.
         self.log.debug("connecting to cassandra")
-        self.db = CASSANDRA_DB(config, qname=qname)
+        self.db = get_timeseries_db(config, qname=qname)
         self.log.debug("connected to cassandra")
 
+        if config.cassandra_write_threads:
+            self.db.start_write_pipeline(config.cassandra_write_threads,
+                config.cassandra_write_window)
+
+        if config.persist_cache_dir:
+            self.db.open_cache_snapshot(os.path.join(config.persist_cache_dir,
+                '%s.cache' % qname))
+
         self.ns = "snmp"
+        # oidset:device keys published for this worker, see
+        # drop_unassigned().
+        self.assignments = None
+        self.last_stat_checkpoint = time.time()
+        self.last_rate_flush = time.time()
 
         self.oidsets = {}
         self.poller_args = {}
@@ -433,58 +706,243 @@ class CassandraPollPersister(PollPersister):
         except MaximumRetryException:
             self.log.warn("flush failed. MaximumRetryException")
 
+    def warm_up(self, ts=None):
+        """
+        Seed the metadata cache for every measurement this persister is
+        expected to see before the first result arrives.  ts is the time
+        in seconds to seek back from and defaults to now.
+
+        The measurements are built from the device, oidset and interface
+        inventory in the SQL db and their last stored values are fetched
+        with parallel bulk multigets, so after a restart the persister
+        doesn't need a raw_data lookup for each variable the first time 
+        it is polled.  Only oidsets using one of the WARMUP_CORRELATORS 
+        can be predicted, anything else is looked up as it arrives.
+        """
+        t0 = time.time()
+
+        pairs = self._assigned_pairs()
+        if pairs is None:
+            self.log.info("no worker assignments published, skipping warm up")
+            return
+
+        oidsets = {}
+        for oidset_name, device_name in pairs:
+            if oidset_name in self.oidsets:
+                oidsets.setdefault(oidset_name, []).append(device_name)
+
+        ifrefs = {}
+        for ifref in IfRef.objects.active().filter(
+                device__name__in=set([d for l in oidsets.values() for d in l])
+                ).select_related('device'):
+            ifrefs.setdefault(ifref.device.name, []).append(ifref)
+
+        if ts is None:
+            ts = int(t0)
+        raw_datas = []
+
+        for oidset_name, device_names in oidsets.iteritems():
+            oidset = self.oidsets[oidset_name]
+            poller_args = self.poller_args.get(oidset.name, {})
+            ifname = WARMUP_CORRELATORS.get(poller_args.get('correlator'))
+            oids = [oid for oid in oidset.oids.all() if oid.aggregate]
+            if ifname is None or not oids:
+                continue
+
+            set_name = poller_args.get('set_name', oidset.name)
+
+            for device_name in device_names:
+                for ifref in ifrefs.get(device_name, []):
+                    name = ifname(ifref)
+                    if not name:
+                        continue
+                    for oid in oids:
+                        raw_datas.append(RawRateData(
+                            path=[self.ns, device_name, set_name, oid.name, name],
+                            ts=ts * 1000, val=None, freq=oidset.frequency_ms))
+
+        self.db.prefetch_metadata(raw_datas, seed_missing=False,
+                threads=WARMUP_THREADS)
+
+        self.log.info("warmed metadata cache: %d vars in %f seconds" % (
+            len(raw_datas), time.time() - t0))
+
+    def _assigned_pairs(self):
+        """
+        Return the (oidset name, device name) pairs routed to this
+        persister's queue or None if they can't be determined.
+
+        A queue with a single worker gets every active device polled for
+        the oidsets mapped to it.  The workers of a multi worker queue 
+        rely on the assignments published by espolld.
+        """
+        assignments = self.persistq.get_assignments() \
+            if hasattr(self.persistq, 'get_assignments') else None
+
+        if assignments is not None:
+            self.assignments = set(assignments)
+            return [k.split(':', 1) for k in assignments]
+
+        if self.qname not in self.config.persist_queues:
+            return None
+
+        names = [oidset.name for oidset in self.oidsets.values() if self.qname
+            in self.config.persist_map.get(oidset.name.lower(), [])]
+
+        return [(m.oid_set.name, m.device.name) for m in
+            DeviceOIDSetMap.objects.filter(oid_set__name__in=names,
+                device__in=Device.objects.active()).select_related(
+                'oid_set', 'device')]
+
+    def report_stats(self, now):
+        PollPersister.report_stats(self, now)
+        stats = self.db.write_stats()
+        if stats is not None:
+            self.log.info("%(sent)d batches sent (%(errors)d failed), "
+                "latency p50 %(p50).3f "
+                "p90 %(p90).3f p99 %(p99).3f max %(max).3f, blocked "
+                "%(stalls)d times for %(stall_time).3f seconds" % stats)
+        self.drop_unassigned()
+
+    def drop_unassigned(self):
+        """
+        Drop the cached state of the devices espolld has moved to another
+        worker.  If they come back later the metadata and rollups are 
+        read from the database again, rather than continuing from values
+        that are stale by then.
+        """
+        assignments = self.persistq.get_assignments() \
+            if hasattr(self.persistq, 'get_assignments') else None
+        if assignments is None:
+            return
+
+        assignments = set(assignments)
+        if self.assignments is not None:
+            paths = set()
+            for k in self.assignments - assignments:
+                oidset_name, device_name = k.split(':', 1)
+                if oidset_name not in self.oidsets:
+                    continue
+                set_name = self.poller_args.get(oidset_name, {}).get(
+                    'set_name', oidset_name)
+                paths.add((self.ns, device_name, set_name))
+
+            if paths:
+                n = self.db.evict_caches(paths)
+                self.log.info("%d devices moved to another worker, dropped "
+                    "%d cache entries" % (len(paths), n))
+
+        self.assignments = assignments
+
     def store(self, result):
-        oidset = self.oidsets[result.oidset_name]
-        set_name = self.poller_args[oidset.name].get('set_name', oidset.name)
-        basepath = [self.ns, result.device_name, set_name]
-        oid = self.oids[result.oid_name]
-        
+        self.store_batch([result])
+
+    def store_batch(self, results):
+        """
+        Store a list of PollResults.
+
+        The results are handled as a batch rather than one variable at a 
+        time: metadata cache misses are looked up in bulk, the base rate
+        bins for every measurement are computed with a single 
+        fit_to_bins_batch() call per frequency and the raw data, base rate
+        and rollup updates are merged so that each row key is written with
+        one grouped insert.  The end result is the same as storing each 
+        variable of each result in order.
+        """
         t0 = time.time()
         nvar = 0
 
-        for var, val in result.data:
-            if set_name == "SparkySet": # This is pure hack. A new row type should be created for floats
-                val = float(val) * 100
-            nvar += 1
-            
-            var_path = basepath + var
+        raw_rows = {}   # ttl -> row key -> {ts: json value}
+        pending = []    # (RawRateData, oidset) for aggregated oids
 
-            # This shouldn't happen.
-            if val is None:
-                self.log.error('Got a None value for %s' % (":".join(var_path)))
-                continue
-                
-            # Create data encapsulation object (defined in cassandra.py 
-            # module) and store the raw input.
+        for result in results:
+            oidset = self.oidsets[result.oidset_name]
+            set_name = self.poller_args[oidset.name].get('set_name', oidset.name)
+            basepath = [self.ns, result.device_name, set_name]
+            oid = self.oids[result.oid_name]
 
-            raw_data = RawRateData(path=var_path, ts=result.timestamp * 1000,
-                    val=val, freq=oidset.frequency_ms)
+            # Every var in a result shares the timestamp so only convert
+            # it once.
+            ts = RawData(ts=result.timestamp * 1000).ts
+            ts_js = calendar.timegm(ts.utctimetuple()) * 1000
+            rows = raw_rows.setdefault(oidset.ttl, {})
 
-            self.db.set_raw_data(raw_data, ttl=oidset.ttl)
+            for var, val in result.data:
+                if set_name == "SparkySet": # This is pure hack. A new row type should be created for floats
+                    val = float(val) * 100
+                nvar += 1
 
-            # Generate aggregations if apropos.
-            if oid.aggregate:
-                delta_v = self.aggregate_base_rate(raw_data)
-                # XXX: not implemented
-                #uptime_name = os.path.join(basename, 'sysUpTime')
-                
-                if delta_v != None: # a value of zero is ok
-                    # We got a good delta back - generate rollups.
-                    # Just swap the delta into the raw data object.
-                    raw_data.val = delta_v
-                    self.generate_aggregations(raw_data, oidset.aggregates)
-            else:
-                pass
+                var_path = basepath + var
+
+                # This shouldn't happen.
+                if val is None:
+                    self.log.error('Got a None value for %s' % (":".join(var_path)))
+                    continue
+
+                # Create data encapsulation object (defined in cassandra.py 
+                # module) and store the raw input.
+                raw_data = RawRateData(path=var_path, ts=ts, val=val,
+                        freq=oidset.frequency_ms)
+
+                rows.setdefault(raw_data.get_key(), {})[ts_js] = json.dumps(val)
+
+                if oid.aggregate:
+                    pending.append((raw_data, oidset))
+
+        for ttl, rows in raw_rows.iteritems():
+            self.db.set_raw_data_rows(rows, ttl=ttl)
+
+        if pending:
+            self.db.prefetch_metadata([raw_data for raw_data, oidset in pending])
+
+            rate_rows = {}
+            fits = {}   # freq -> list of (raw_data, last_ts, last_val, delta_v)
+            deltas = [] # (raw_data, oidset) with a valid delta
+
+            for raw_data, oidset in pending:
+                fit = self.aggregate_base_rate(raw_data, rate_rows)
+                if fit is not None:
+                    fits.setdefault(raw_data.freq, []).append((raw_data,) + fit)
+                    deltas.append((raw_data, oidset))
+
+            for freq, l in fits.iteritems():
+                self._fit_rate_bins(freq, l, rate_rows)
+                # We got a good delta back - generate rollups.
+                # Just swap the delta into the raw data object.
+                for f in l:
+                    f[0].val = f[3]
+
+            self.db.update_rate_bins(rate_rows)
+
+            self.generate_aggregations(deltas)
+
+        now = time.time()
+        if now > self.last_stat_checkpoint + STAT_CHECKPOINT_INTERVAL:
+            self.db.checkpoint_stat_aggregations()
+            self.last_stat_checkpoint = now
+        if now > self.last_rate_flush + RATE_FLUSH_INTERVAL:
+            self.db.flush_rate_aggregations()
+            self.last_rate_flush = now
+
+        self.db.journal_caches()
+        if self.db.cache_snapshot is not None and \
+                self.db.cache_snapshot.journal_size() > CACHE_JOURNAL_MAX_SIZE:
+            self.db.snapshot_caches()
 
         self.log.debug("stored %d vars in %f seconds: %s" % (nvar,
-            time.time() - t0, result))
+            time.time() - t0, results[0] if len(results) == 1 else
+            '%d results' % len(results)))
 
-    def aggregate_base_rate(self, data):
+    def aggregate_base_rate(self, data, rate_rows):
         """
-        Given incoming data that is meant for aggregation, generate and 
-        store the base rate deltas, update the metadata cache, and if a valid 
-        delta (delta_v) is generated, return to calling code to generate
-        higher-level rollup aggregations.
+        Given incoming data that is meant for aggregation, calculate the
+        base rate delta and update the metadata cache.  If a valid delta 
+        (delta_v) is generated, the tuple (last_data_ts, last_val, delta_v)
+        is returned so the calling code can fit it into the base rate bins
+        and generate higher-level rollup aggregations.
+
+        Bins written by the heartbeat logic are added to rate_rows, a dict
+        of row key -> {bin_ts: {'val': .., 'is_valid': ..}}.
         
         The data arg passed in is a RawData encapsulation object as
         defined in the cassandra.py module.  
@@ -565,30 +1023,60 @@ class CassandraPollPersister(PollPersister):
             # Update only the "current" bin and return.
             curr_bin = BaseRateBin(ts=curr_slot, freq=data.freq, val=curr_frac,
                 path=data.path)
-            self.db.update_rate_bin(curr_bin)
+            self._add_rate_bin(rate_rows, curr_bin.get_key(),
+                curr_bin.ts_to_jstime(), curr_bin.val, curr_bin.is_valid)
             
             metadata.refresh_from_raw(data)
             self.db.update_metadata(data.get_meta_key(), metadata)
 
             return
 
-
-        updates = fit_to_bins(data.freq, last_data_ts, metadata.last_val,
-                curr_data_ts, data.val)
-        # Now, write the new valid data between the appropriate bins.
-
-        for bin_name, val in updates.iteritems():
-            update_bin = BaseRateBin(ts=bin_name, freq=data.freq, val=val,
-                path=data.path)
-            self.db.update_rate_bin(update_bin)
-
         # Gotten to the final success condition, so update the metadata
         # cache with values from the current data input and return the 
         # valid delta to the calling code.
+        last_val = metadata.last_val
         metadata.refresh_from_raw(data)
         self.db.update_metadata(data.get_meta_key(), metadata)
         
-        return delta_v
+        return last_data_ts, last_val, delta_v
+
+    @staticmethod
+    def _add_rate_bin(rate_rows, key, ts, val, is_valid):
+        # Both val and is_valid are counters so merge by adding.
+        cols = rate_rows.setdefault(key, {})
+        if cols.has_key(ts):
+            cols[ts]['val'] += val
+            cols[ts]['is_valid'] += is_valid
+        else:
+            cols[ts] = {'val': val, 'is_valid': is_valid}
+
+    def _fit_rate_bins(self, freq, fits, rate_rows):
+        """
+        Fit the valid deltas for a base rate frequency into bins with
+        fit_to_bins_batch() and add the bin updates to rate_rows.
+
+        The fits arg is a list of (raw_data, last_data_ts, last_val, delta_v)
+        tuples.
+        """
+        index, bins, vals = fit_to_bins_batch(freq,
+            [f[1] for f in fits], [f[2] for f in fits],
+            [f[0].ts_to_jstime() for f in fits], [f[0].val for f in fits])
+
+        if numpy is not None and isinstance(bins, numpy.ndarray):
+            years = (bins.astype('datetime64[ms]').astype('datetime64[Y]')
+                .astype(numpy.int64) + 1970).tolist()
+            index, bins, vals = index.tolist(), bins.tolist(), vals.tolist()
+        else:
+            years = [datetime.datetime.utcfromtimestamp(b/1000.0).year
+                for b in bins]
+
+        meta_keys = [f[0].get_meta_key() for f in fits]
+
+        for i, b, v, year in zip(index, bins, vals, years):
+            # Same as BaseRateBin.get_key() - the year is appended to the
+            # metadata row key.
+            key = '%s%s%d' % (meta_keys[i], KEY_DELIMITER, year)
+            self._add_rate_bin(rate_rows, key, b, v, 1)
 
     def _agg_timestamp(self, data, freq):
         """
@@ -602,35 +1090,67 @@ class CassandraPollPersister(PollPersister):
         """
         return datetime.datetime.utcfromtimestamp((data.ts_to_unixtime() / freq) * freq)
 
-    def generate_aggregations(self, data, aggregate_freqs):
+    def generate_aggregations(self, deltas):
         """
-        Given a data encapsulation object that has been updated with the 
-        current delta, iterate through the frequencies in oidset.aggregates
-        and generate the appropriate higher level aggregations.
+        Given a list of (data, oidset) tuples where the data encapsulation
+        objects have been given a valid delta_v, iterate through the 
+        frequencies in oidset.aggregates and generate the appropriate higher
+        level aggregations.
         
         The 'rate aggregations' are the summed deltas and the associated 
-        counts.  The 'stat aggregations' are the min/max values.  These 
+        counts.  They are summed in memory and written as one counter
+        increment per bin when the bin closes or every RATE_FLUSH_INTERVAL
+        seconds (see TimeSeriesStore.accumulate_rate_aggregations()).  The 'stat aggregations' are the min/max values.  These 
         are being writtent to two different column families due to schema
-        constraints.
+        constraints.  Updates are merged so each row key is written once.
         
-        Since the stat aggregations are read from/not just written to, 
-        track if a new value has been generated (min/max will only be updated
-        periodically), and if so, explicitly flush the stat_agg batch.
+        The min/max values are only updated in the aggregation cache, each
+        bin is written once it closes or at the next checkpoint (see
+        TimeSeriesStore.checkpoint_stat_aggregations()) rather than every
+        time a new min or max arrives.
         """
-        stat_updated = False
+        agg_rows = {}
+        agg_ts_cache = {}
+
+        for data, oidset in deltas:
+            base_freq = str(data.freq)
+            for freq in oidset.aggregates:
+                k = (data.ts, freq)
+                if not agg_ts_cache.has_key(k):
+                    agg_ts = self._agg_timestamp(data, freq)
+                    agg_ts_cache[k] = (agg_ts,
+                        calendar.timegm(agg_ts.utctimetuple()) * 1000)
+                agg_ts, agg_js = agg_ts_cache[k]
+
+                # Rate aggregation - both values are counter types.
+                cols = agg_rows.setdefault(
+                    get_rowkey(data.path, freq=freq*1000, year=agg_ts.year), {})
+                if cols.has_key(agg_js):
+                    cols[agg_js]['val'] += data.val
+                    cols[agg_js][base_freq] += 1
+                else:
+                    cols[agg_js] = {'val': data.val, base_freq: 1}
 
-        for freq in aggregate_freqs:
-            self.db.update_rate_aggregation(data, self._agg_timestamp(data, freq), freq*1000)
-            updated = self.db.update_stat_aggregation(data, 
-                                        self._agg_timestamp(data, freq), freq*1000)
-            if updated: stat_updated = True
-                                
-        if stat_updated:
-            self.db.stat_agg.send()
+                # Stat aggregation - kept in the cache until the bin is
+                # written.
+                self.db.stat_aggregation_changes(data, agg_js, freq*1000)
+
+        self.db.accumulate_rate_aggregations(agg_rows)
+
+    def run(self):
+        PollPersister.run(self)
+        self.flush()
+        if self.drained:
+            # Our devices have been handed to other workers, anything
+            # cached would be stale if this worker is started again.
+            self.db.evict_caches([(self.ns,)])
+        # Save the caches for the next start up.
+        self.db.snapshot_caches()
 
     def stop(self, x, y):
-        self.log.debug("flushing and stopping cassandra poll persister")
-        self.db.flush()
+        # Runs in a signal handler, possibly in the middle of a write, so
+        # run() does the final flush once the loop has stopped.
+        self.log.debug("stopping cassandra poll persister")
         self.running = False
             
         
@@ -929,8 +1449,13 @@ class SentryOutletRefPollPersister(HistoryTablePersister):
 
 class PersistQueue(object):
     """Abstract base class for a persistence queue."""
-    def __init__(self, qname):
+
+    # If True get(block=True, timeout=...) waits for data to arrive.
+    blocking = False
+
+    def __init__(self, qname, result_format=None):
         self.qname = qname
+        self.result_format = get_result_format(result_format)
 
     def get(self, block=False):
         pass
@@ -938,10 +1463,55 @@ class PersistQueue(object):
     def put(self, val):
         pass
 
+    def get_many(self, n, timeout=None):
+        """Return a list of up to n results.  Queues that can block
+        wait up to timeout seconds for results to arrive."""
+        results = []
+        while len(results) < n:
+            val = self.get()
+            if val is None:
+                break
+            results.append(val)
+        return results
+
+    def put_many(self, vals):
+        for val in vals:
+            self.put(val)
+
+    def set_state(self, name, value):
+        """Store a small JSON serializable value under name alongside
+        the queue, used to share state between espolld and the workers
+        reading the queue."""
+        pass
+
+    def get_state(self, name):
+        """Return the value stored by set_state() or None."""
+        return None
+
+    def write_position(self):
+        """Return a JSON serializable marker for the end of the queue or
+        None if it isn't known.  Markers are compared with read_position()
+        to tell if the reader has caught up with a point in time."""
+        return None
+
+    def read_position(self):
+        """Return a marker for the reader's position in the queue,
+        comparable with the markers from write_position()."""
+        return None
+
+    def set_assignments(self, keys):
+        """Record the oidset:device keys that are routed to this queue
+        by a MultiWorkerQueue."""
+        self.set_state('assignments', keys)
+
+    def get_assignments(self):
+        """Return the keys recorded by set_assignments() or None if
+        they aren't known."""
+        return self.get_state('assignments')
+
     def serialize(self, val):
-        # return pickle.dumps(val)
         try:
-            return val.json() # .dumps() is being called in the PollResult method
+            return self.result_format.dumps(val)
         except Exception as e:
             m = 'Poll Result {0} could not be serialized: {1}'.format(val, e)
             if hasattr(self, 'log'):
@@ -952,8 +1522,7 @@ class PersistQueue(object):
             return None
 
     def deserialize(self, val):
-        # return pickle.loads(val)
-        return json.loads(val)
+        return loads_result(val)
 
 class JsonSerializer(object):
     """This is passed to memcache.Client() to replace default use of 
@@ -982,9 +1551,12 @@ class MemcachedPersistQueue(PersistQueue):
     """
 
     PREFIX = '_mcpq_'
+    # How long get_many() waits for items that have been allocated a qid
+    # but not yet written before treating them as lost.
+    MISSING_TIMEOUT = 5
 
-    def __init__(self, qname, memcached_uri):
-        super(MemcachedPersistQueue, self).__init__(qname)
+    def __init__(self, qname, memcached_uri, result_format=None):
+        super(MemcachedPersistQueue, self).__init__(qname, result_format)
 
         self.log = get_logger("MemcachedPersistQueue_%s" % self.qname)
 
@@ -1002,6 +1574,8 @@ class MemcachedPersistQueue(PersistQueue):
         if not lr:
             self.mc.set(self.last_read, 0)
 
+        self._missing = None
+
     def __str__(self):
         la = self.mc.get(self.last_added)
         lr = self.mc.get(self.last_read)
@@ -1018,6 +1592,82 @@ class MemcachedPersistQueue(PersistQueue):
         else:
             self.log.error("failed to serialize: %s" % str(val))
 
+    def _key(self, qid):
+        return '%s_%s_%d' % (self.PREFIX, self.qname, qid)
+
+    def put_many(self, vals):
+        """Add a list of results with one incr and one set_multi."""
+        sers = []
+        for val in vals:
+            ser = self.serialize(val)
+            if ser:
+                sers.append(ser)
+            else:
+                self.log.error("failed to serialize: %s" % str(val))
+
+        if not sers:
+            return
+
+        last = self.mc.incr(self.last_added, len(sers))
+        first = last - len(sers) + 1
+        failed = self.mc.set_multi(dict([(self._key(first + i), ser)
+            for i, ser in enumerate(sers)]))
+        if failed:
+            self.log.error("memcache 'set_multi' failed for %d items! "
+                "Polling data lost!" % len(failed))
+
+    def get_many(self, n, timeout=None):
+        """Return up to n results with one get_multi and delete_multi.
+
+        Missing items have most likely been allocated by put_many() but
+        not written yet, so reading stops at the first one and it is
+        retried on the next call.  Items that were allocated more than
+        MISSING_TIMEOUT seconds ago and are still missing are skipped."""
+        last_read = self.mc.get(self.last_read) or 0
+        last_added = self.mc.get(self.last_added) or 0
+        if last_added <= last_read:
+            return []
+
+        qids = range(last_read + 1, min(last_added, last_read + n) + 1)
+        vals = self.mc.get_multi([self._key(qid) for qid in qids])
+
+        # self._missing is (first missing qid, last qid allocated when it
+        # was noticed, time it was noticed).
+        now = time.time()
+        done = last_read
+        found = []
+        missing = 0
+        for qid in qids:
+            if self._key(qid) in vals:
+                found.append(qid)
+            elif not self._missing or \
+                    not self._missing[0] <= qid <= self._missing[1]:
+                self._missing = (qid, last_added, now)
+                break
+            elif now > self._missing[2] + self.MISSING_TIMEOUT:
+                missing += 1
+            else:
+                break
+            done = qid
+
+        if done == last_read:
+            return []
+        if missing:
+            self.log.error("missing data: %d items missing (qids %d-%d)" %
+                    (missing, last_read + 1, done))
+
+        results = []
+        for qid in found:
+            try:
+                results.append(
+                    PollResult(**self.deserialize(vals[self._key(qid)])))
+            except Exception, e:
+                self.log.error("unable to deserialize item %d: %s" % (qid, e))
+
+        self.mc.set(self.last_read, done)
+        self.mc.delete_multi([self._key(qid) for qid in found])
+        return results
+
     def get(self, block=False):
         if len(self) <= 0:
             return None
@@ -1050,6 +1700,370 @@ class MemcachedPersistQueue(PersistQueue):
         self.mc.set(self.last_added, 0)
         self.mc.set(self.last_read, 0)
 
+    def write_position(self):
+        return self.mc.get(self.last_added)
+
+    def read_position(self):
+        return self.mc.get(self.last_read)
+
+    def set_state(self, name, value):
+        # Stored as a string so it doesn't go through JsonSerializer.
+        if not self.mc.set('%s_%s_%s' % (self.PREFIX, self.qname, name),
+                json.dumps(value)):
+            self.log.error("memcache 'set' failed for worker %s" % name)
+
+    def get_state(self, name):
+        val = self.mc.get('%s_%s_%s' % (self.PREFIX, self.qname, name))
+        if val is None:
+            return None
+        return json.loads(val)
+
+
+class FilePersistQueue(PersistQueue):
+    """A durable queue stored as append-only segment files.
+
+    The queue lives in the directory ``<queue_dir>/<qname>`` and holds:
+
+    * ``<seq>.seg`` segment files of length prefixed records,
+    * ``position`` - the segment and offset of the next unread record,
+    * ``lock`` - flock()ed by writers while appending,
+    * ``notify`` - a FIFO a byte is written to after each append,
+    * ``<name>.state`` - values stored with set_state().
+
+    Writers append to the newest segment and start a new one once it is
+    larger than SEGMENT_SIZE.  The reader consumes segments in order and
+    removes them once they are read and a newer segment exists.  Each 
+    put_many()/get_many() call handles a whole batch of results with a 
+    single write or read, and readers block on the FIFO rather than 
+    polling so new results are picked up immediately.
+
+    Only one reader per queue is supported, the same as with the
+    memcached queue.  Data is not fsync()ed so it survives restarts of
+    espolld and espersistd but not necessarily of the host.
+    """
+
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    READ_SIZE = 256 * 1024
+    blocking = True
+
+    _LENGTH = struct.Struct('!I')
+    _POSITION = struct.Struct('!QQ')
+
+    def __init__(self, qname, queue_dir, result_format=None):
+        super(FilePersistQueue, self).__init__(qname, result_format)
+
+        self.log = get_logger("FilePersistQueue_%s" % self.qname)
+
+        self.dir = os.path.join(queue_dir, qname)
+        try:
+            os.makedirs(self.dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self.notify_path = os.path.join(self.dir, 'notify')
+        try:
+            os.mkfifo(self.notify_path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # writer state
+        self._lock_fd = None
+        self._wfd = None
+        self._wseq = None
+        self._notify_wfd = None
+
+        # reader state
+        self._rfd = None
+        self._rseq = None
+        self._roffset = 0
+        self._rbuf = ''
+        self._rpos = 0
+        self._pos_fd = None
+        self._notify_rfd = None
+        self._notify_keepalive = None
+
+    def __str__(self):
+        return '<FilePersistQueue: %s segments: %s>' % (self.qname,
+            self._segments())
+
+    def _segment_path(self, seq):
+        return os.path.join(self.dir, '%020d.seg' % seq)
+
+    def _segments(self):
+        return sorted([int(f[:-4]) for f in os.listdir(self.dir)
+            if f.endswith('.seg')])
+
+    # writer side
+
+    def _open_segment(self):
+        if self._wseq is None:
+            # Always start a new segment so nothing is appended after a
+            # partial record left by a writer that died.
+            segs = self._segments()
+            self._wseq = segs[-1] + 1 if segs else 0
+        elif os.path.exists(self._segment_path(self._wseq + 1)):
+            # Another writer has started a new segment.
+            while os.path.exists(self._segment_path(self._wseq + 1)):
+                self._wseq += 1
+        else:
+            if os.fstat(self._wfd).st_size < self.SEGMENT_SIZE:
+                return
+            self._wseq += 1
+
+        if self._wfd is not None:
+            os.close(self._wfd)
+        self._wfd = os.open(self._segment_path(self._wseq),
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+
+    def _notify(self):
+        try:
+            if self._notify_wfd is None:
+                self._notify_wfd = os.open(self.notify_path,
+                    os.O_WRONLY | os.O_NONBLOCK)
+            os.write(self._notify_wfd, '.')
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                # The reader already has pending notifications.
+                return
+            # No reader (ENXIO) or it went away (EPIPE).
+            if self._notify_wfd is not None:
+                os.close(self._notify_wfd)
+                self._notify_wfd = None
+
+    def _write(self, data):
+        """Append data to the segment, called with the lock held.  If it
+        can't all be written the segment is truncated back so no partial
+        record is left for the next write to be appended to."""
+        start = os.fstat(self._wfd).st_size
+        written = 0
+        try:
+            while written < len(data):
+                written += os.write(self._wfd, data[written:])
+        except OSError:
+            try:
+                os.ftruncate(self._wfd, start)
+            except OSError:
+                # Leave the segment as is and start a new one.
+                os.close(self._wfd)
+                self._wfd = None
+                self._wseq = None
+            raise
+
+    def put(self, val):
+        self.put_many([val])
+
+    def put_many(self, vals):
+        """Append a list of PollResults with a single write."""
+        records = []
+        for val in vals:
+            ser = self.serialize(val)
+            if ser:
+                records.append(self._LENGTH.pack(len(ser)))
+                records.append(ser)
+            else:
+                self.log.error("failed to serialize: %s" % str(val))
+
+        if not records:
+            return
+
+        if self._lock_fd is None:
+            self._lock_fd = os.open(os.path.join(self.dir, 'lock'),
+                os.O_RDWR | os.O_CREAT, 0644)
+
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            self._open_segment()
+            self._write(''.join(records))
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+        self._notify()
+
+    # reader side
+
+    def _open_reader(self):
+        if self._pos_fd is None:
+            self._pos_fd = os.open(os.path.join(self.dir, 'position'),
+                os.O_RDWR | os.O_CREAT, 0644)
+            pos = os.read(self._pos_fd, self._POSITION.size)
+            if len(pos) == self._POSITION.size:
+                self._rseq, self._roffset = self._POSITION.unpack(pos)
+
+            # The reader holds the FIFO open for writing as well so
+            # select() doesn't see EOF when there are no writers.
+            self._notify_rfd = os.open(self.notify_path,
+                os.O_RDONLY | os.O_NONBLOCK)
+            self._notify_keepalive = os.open(self.notify_path,
+                os.O_WRONLY | os.O_NONBLOCK)
+
+        if self._rfd is not None:
+            return True
+
+        segs = self._segments()
+        if self._rseq is not None and self._rseq in segs:
+            offset = self._roffset
+        else:
+            segs = [s for s in segs if self._rseq is None or s > self._rseq]
+            if not segs:
+                return False
+            if self._rseq is not None:
+                self.log.error("segment %d missing, skipping to %d" %
+                    (self._rseq, segs[0]))
+            self._rseq = segs[0]
+            offset = 0
+
+        self._rfd = os.open(self._segment_path(self._rseq), os.O_RDONLY)
+        os.lseek(self._rfd, offset, os.SEEK_SET)
+        self._roffset = offset
+        self._rbuf = ''
+        self._rpos = 0
+        return True
+
+    def _next_segment(self):
+        """Move to the next segment if the current one is finished."""
+        if not os.path.exists(self._segment_path(self._rseq + 1)):
+            return False
+
+        # Writers never append to a segment once a newer one exists but
+        # pick up anything written before it was created.
+        if self._fill():
+            return True
+
+        if self._rpos < len(self._rbuf):
+            self.log.error("discarding %d bytes of a partial record at "
+                "the end of segment %d" % (len(self._rbuf) - self._rpos,
+                    self._rseq))
+
+        os.close(self._rfd)
+        os.unlink(self._segment_path(self._rseq))
+        self._rfd = None
+        self._rseq += 1
+        self._roffset = 0
+        self._save_position()
+        return self._open_reader()
+
+    def _fill(self):
+        data = os.read(self._rfd, self.READ_SIZE)
+        if not data:
+            return False
+        self._rbuf = self._rbuf[self._rpos:] + data
+        self._rpos = 0
+        return True
+
+    def _read_record(self):
+        while True:
+            end = self._rpos + self._LENGTH.size
+            if end <= len(self._rbuf):
+                (n,) = self._LENGTH.unpack(self._rbuf[self._rpos:end])
+                if end + n <= len(self._rbuf):
+                    rec = self._rbuf[end:end + n]
+                    self._rpos = end + n
+                    self._roffset += self._LENGTH.size + n
+                    return rec
+            if not self._fill() and not self._next_segment():
+                return None
+
+    def _save_position(self):
+        os.lseek(self._pos_fd, 0, os.SEEK_SET)
+        os.write(self._pos_fd, self._POSITION.pack(self._rseq, self._roffset))
+
+    def _wait(self, timeout):
+        try:
+            r, w, x = select.select([self._notify_rfd], [], [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        if r:
+            try:
+                while os.read(self._notify_rfd, 4096):
+                    pass
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def get_many(self, n, timeout=None):
+        """
+        Return a list of up to n PollResults.  If the queue is empty wait
+        up to timeout seconds (forever if None) for results to arrive.  
+        An empty list is returned if the timeout expires.
+        """
+        results = []
+        deadline = time.time() + timeout if timeout is not None else None
+
+        while True:
+            if self._open_reader():
+                while len(results) < n:
+                    rec = self._read_record()
+                    if rec is None:
+                        break
+                    try:
+                        results.append(PollResult(**self.deserialize(rec)))
+                    except Exception, e:
+                        self.log.error("unable to deserialize record: %s" % e)
+
+            if results:
+                self._save_position()
+                return results
+
+            if deadline is None:
+                self._wait(None)
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return results
+                self._wait(remaining)
+
+    def get(self, block=False, timeout=None):
+        results = self.get_many(1, timeout=timeout if block else 0)
+        if results:
+            return results[0]
+        return None
+
+    def write_position(self):
+        segs = self._segments()
+        if not segs:
+            return None
+        try:
+            return [segs[-1], os.path.getsize(self._segment_path(segs[-1]))]
+        except OSError:
+            # consumed by the reader in the mean time
+            return [segs[-1] + 1, 0]
+
+    def read_position(self):
+        try:
+            with open(os.path.join(self.dir, 'position'), 'rb') as fp:
+                pos = fp.read(self._POSITION.size)
+        except IOError:
+            return None
+        if len(pos) < self._POSITION.size:
+            return None
+        return list(self._POSITION.unpack(pos))
+
+    # shared state
+
+    def _state_path(self, name):
+        return os.path.join(self.dir, '%s.state' % name)
+
+    def set_state(self, name, value):
+        path = self._state_path(name)
+        tmp = '%s.%d' % (path, os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump(value, fp)
+        os.rename(tmp, path)
+
+    def get_state(self, name):
+        try:
+            with open(self._state_path(name)) as fp:
+                return json.load(fp)
+        except IOError:
+            return None
+        except ValueError, e:
+            self.log.error("unable to read %s state: %s" % (name, e))
+            return None
+
 
 class PersistClient(object):
     def __init__(self, name, config):
@@ -1071,47 +2085,299 @@ class PersistClient(object):
         for sink in self.sinks:
             sink.put(result)
 
+    def put_many(self, results):
+        for sink in self.sinks:
+            sink.put_many(results)
+
+
+class HashRing(object):
+    """A weighted consistent hash ring.
+
+    Each node is placed on the ring at VNODES * weight points derived from
+    the node name, and a key belongs to the node owning the first point at
+    or after the hash of the key.  The mapping only depends on the nodes
+    and their weights so it is the same in every process and across 
+    restarts.  Adding a node, removing one or changing a weight only moves
+    the keys next to the points that were added or removed, the rest stay
+    where they are.
+    """
+    VNODES = 100
+
+    def __init__(self, weights=None, vnodes=None):
+        self.vnodes = vnodes or self.VNODES
+        self.weights = dict(weights or {})
+        self._build()
+
+    @staticmethod
+    def _hash(s):
+        return int(hashlib.md5(s).hexdigest()[:16], 16)
+
+    def _build(self):
+        points = []
+        for node, weight in self.weights.iteritems():
+            for i in range(max(1, int(round(self.vnodes * weight)))):
+                points.append((self._hash('%s#%d' % (node, i)), node))
+        points.sort()
+        self._hashes = [p[0] for p in points]
+        self._nodes = [p[1] for p in points]
+
+    def set_weight(self, node, weight):
+        self.set_weights({node: weight})
+
+    def set_weights(self, weights):
+        self.weights.update(weights)
+        self._build()
+
+    def remove(self, node):
+        del self.weights[node]
+        self._build()
+
+    def get(self, key):
+        if not self._nodes:
+            return None
+        i = bisect.bisect(self._hashes, self._hash(key))
+        return self._nodes[i % len(self._nodes)]
+
 
 class MultiWorkerQueue(object):
-    def __init__(self, qprefix, qtype, uri, num_workers):
+    """Spread results over num_workers queues named <qprefix>_<n>.
+
+    Each oidset:device key is mapped to a worker with a HashRing so the
+    same worker always handles the same devices, even after espolld is
+    restarted, and the workers' metadata caches stay valid.  The workers
+    report their store latency per record (see PollPersister) and every
+    REBALANCE_INTERVAL seconds the ring weights are moved towards the
+    inverse of the latency, so slower workers are given fewer keys.  The
+    weights are saved with the worker queues so they survive restarts.
+
+    If max_workers is given the set of workers is managed by the
+    espersistd autoscaler, which publishes the active workers on the
+    <qprefix> queue.  Keys that move to another worker, because of a
+    rebalance or the set of workers changing, are handed off so the new
+    worker waits for the old one to store what it already has queued
+    (see PollPersister.check_handoffs()).  Removed workers are told to
+    exit once their queue is drained.
+    """
+    ASSIGNMENT_INTERVAL = 10
+    MEMBERSHIP_INTERVAL = 10
+    REBALANCE_INTERVAL = 300
+    # Weights move this fraction of the way to the target each time and
+    # aren't changed at all if the difference is below REBALANCE_MIN.
+    REBALANCE_DAMPING = 0.5
+    REBALANCE_MIN = 0.1
+    MIN_WEIGHT = 0.25
+    MAX_WEIGHT = 4.0
+
+    def __init__(self, qprefix, qtype, uri, num_workers, result_format=None,
+            max_workers=None):
         self.qprefix = qprefix
         self.qtype = qtype
         self.num_workers = num_workers
         self.queues = {}
         self.worker_map = {}
         self.log = get_logger('MultiWorkerQueue')
-        self.worker_load = []
+        # worker number -> keys assigned to it, published to the worker
+        # queues so workers can warm their caches on start up.
+        self.assignments = {}
+        self.assignments_changed = set()
+        self.last_published = 0
+        self.last_rebalance = time.time()
+        # worker number -> handoffs published to it
+        self.handoffs = {}
+        self.last_membership = time.time()
+
+        kw = {}
+        if result_format:
+            kw['result_format'] = result_format
+
+        self.weights = {}
+        for i in range(1, max(num_workers, max_workers or 0) + 1):
+            q = self.queues[self._qname(i)] = qtype(self._qname(i), uri, **kw)
+            self.weights[i] = q.get_state('weight') or 1.0
+
+        self.control = None
+        workers = None
+        if max_workers:
+            self.control = qtype(qprefix, uri, **kw)
+            workers = self._published_workers()
+        if not workers:
+            workers = range(1, num_workers + 1)
+
+        self.ring = HashRing(dict([(w, self.weights[w]) for w in workers]))
+
+    def _qname(self, w):
+        return '%s_%d' % (self.qprefix, w)
+
+    def _published_workers(self):
+        workers = self.control.get_state('workers')
+        if workers is None:
+            return None
+        return [w for w in workers if self._qname(w) in self.queues]
 
-        for i in range(1, num_workers + 1):
-            name = "%s_%d" % (qprefix, i)
-            self.queues[name] = qtype(name, uri)
-            self.worker_load.append([i, 0])
+    def _assign(self, k, w):
+        old = self.worker_map.get(k)
+        if old is not None:
+            self.assignments[old].discard(k)
+            self.assignments_changed.add(old)
+        self.worker_map[k] = w
+        self.assignments.setdefault(w, set()).add(k)
+        self.assignments_changed.add(w)
 
     def get_worker(self, result):
         k = ":".join((result.oidset_name, result.device_name))
         try:
             w = self.worker_map[k]
         except KeyError:
-            work_size = len(result.data)
-            w = self.worker_load[0][0]
-            self.worker_map[k] = w
+            w = self.ring.get(k)
+            self._assign(k, w)
+            self.log.debug("worker assigned: %s %d" % (k, w))
+
+        return self._qname(w)
+
+    def _remap(self):
+        """Move the known keys to their worker on the current ring and
+        hand them off to their new workers."""
+        now = time.time()
+        moves = {}
+        for k, w in self.worker_map.items():
+            nw = self.ring.get(k)
+            if nw != w:
+                moves.setdefault((w, nw), []).append(k)
+                self._assign(k, nw)
+
+        positions = {}
+        for (w, nw), keys in moves.iteritems():
+            if w not in positions:
+                positions[w] = self.queues[self._qname(w)].write_position()
+            self.handoffs.setdefault(nw, []).append(dict(
+                id='%s@%f' % (self._qname(w), now), queue=self._qname(w),
+                position=positions[w], keys=keys, time=now))
+
+        for nw in set([nw for w, nw in moves]):
+            self.handoffs[nw] = [h for h in self.handoffs[nw]
+                if now < h['time'] + HANDOFF_TIMEOUT]
+            self.queues[self._qname(nw)].set_state('handoff',
+                self.handoffs[nw])
+
+        self.log.info("%d of %d keys moved" % (sum(map(len, moves.values())),
+            len(self.worker_map)))
+        self.publish_assignments()
+
+    def load_assignments(self):
+        """Restore which worker has which keys from the assignments
+        published on the worker queues, so the keys a restarted process
+        moves are handed off too."""
+        for w in self.ring.weights:
+            for k in self.queues[self._qname(w)].get_assignments() or []:
+                self._assign(k, w)
+        self.assignments_changed = set()
+
+    def set_workers(self, workers):
+        """Change the set of active workers."""
+        old = set(self.ring.weights)
+        workers = set(workers)
+        if not workers or workers == old:
+            return
 
-            self.worker_load[0][1] += work_size
+        self.log.info("workers changed from %s to %s" % (sorted(old),
+            sorted(workers)))
+
+        for w in workers - old:
+            self.queues[self._qname(w)].set_state('retired', None)
+        self.ring = HashRing(dict([(w, self.weights[w]) for w in workers]))
+        self._remap()
+
+        # Tell the removed workers to exit once they have caught up.
+        for w in old - workers:
+            q = self.queues[self._qname(w)]
+            q.set_state('retired', dict(position=q.write_position()))
+
+    def check_membership(self):
+        self.last_membership = time.time()
+        workers = self._published_workers()
+        if workers:
+            self.set_workers(workers)
+
+    def rebalance(self):
+        """Adjust the worker weights from the store latency reported by
+        the workers and move the keys that changed worker."""
+        self.last_rebalance = now = time.time()
+
+        latency = {}
+        for w in self.ring.weights:
+            load = self.queues[self._qname(w)].get_state('load')
+            # Ignore stale reports from workers that aren't running.
+            if load and load.get('latency') and \
+                    now - load.get('time', 0) < 2 * self.REBALANCE_INTERVAL:
+                latency[w] = load['latency']
+
+        if len(latency) < 2:
+            return
 
-            self.log.debug("worker assigned: %s %d load=%d" % (k, w,
-                self.worker_load[0][1]))
+        mean = sum(latency.values()) / len(latency)
+        weights = {}
+        for w, l in latency.iteritems():
+            old = self.ring.weights[w]
+            target = min(self.MAX_WEIGHT, max(self.MIN_WEIGHT, mean / l))
+            new = old + (target - old) * self.REBALANCE_DAMPING
+            if abs(new - old) / old < self.REBALANCE_MIN:
+                continue
+            self.log.info("worker %d: latency %f weight %.2f -> %.2f" % (w,
+                l, old, new))
+            weights[w] = self.weights[w] = new
+            self.queues[self._qname(w)].set_state('weight', new)
+
+        if weights:
+            self.ring.set_weights(weights)
+            self._remap()
+
+    def publish_assignments(self):
+        for w in self.assignments_changed:
+            self.queues[self._qname(w)].set_assignments(
+                sorted(self.assignments[w]))
+        self.assignments_changed = set()
+        self.last_published = time.time()
 
-            self.worker_load.sort(key=lambda x: x[1])
+    def put(self, result):
+        self.put_many([result])
 
-        return '%s_%d' % (self.qprefix, w)
+    def put_many(self, results):
+        now = time.time()
+        if self.control and now > self.last_membership + self.MEMBERSHIP_INTERVAL:
+            self.check_membership()
+        if now > self.last_rebalance + self.REBALANCE_INTERVAL:
+            self.rebalance()
+
+        batches = {}
+        for result in results:
+            batches.setdefault(self.get_worker(result), []).append(result)
+
+        for workerqname, batch in batches.iteritems():
+            self.queues[workerqname].put_many(batch)
+
+        if self.assignments_changed and \
+                time.time() > self.last_published + self.ASSIGNMENT_INTERVAL:
+            self.publish_assignments()
+
+
+def multi_worker(config, qname):
+    """True if the queue qname is read by numbered workers <qname>_<n>."""
+    return config.persist_queues[qname][1] > 1 or \
+        qname in config.persist_autoscale
 
-    def put(self, result):
-        workerqname = self.get_worker(result)
-        workerq = self.queues[workerqname]
-        workerq.put(result)
+
+def get_persist_queue(qname, uri):
+    """Return the queue espersistd reads from given espersistd_uri.
+
+    The uri is either host:port of memcached or FilePersistQueue:<dir>."""
+    if uri and uri.startswith('FilePersistQueue:'):
+        return FilePersistQueue(qname, uri.split(':', 1)[1])
+    return MemcachedPersistQueue(qname, uri)
 
 
 class MemcachedPersistHandler(object):
+    queue_class = MemcachedPersistQueue
+
     def __init__(self, name, config, uri):
         self.queues = {}
         self.config = config
@@ -1120,26 +2386,45 @@ class MemcachedPersistHandler(object):
 
         for qname in config.persist_queues:
             num_workers = self.config.persist_queues[qname][1]
-            if num_workers > 1:
+            result_format = self.config.persist_formats.get(qname)
+            autoscale = self.config.persist_autoscale.get(qname)
+            if multi_worker(config, qname):
                 self.queues[qname] = MultiWorkerQueue(qname,
-                        MemcachedPersistQueue, uri, num_workers)
+                        self.queue_class, uri, num_workers,
+                        result_format=result_format,
+                        max_workers=autoscale[1] if autoscale else None)
             else:
-                self.queues[qname] = MemcachedPersistQueue(qname, uri)
+                self.queues[qname] = self.queue_class(qname, uri,
+                        result_format=result_format)
 
     def put(self, result):
-        try:
-            qnames = self.config.persist_map[result.oidset_name.lower()]
-        except KeyError:
-            self.log.error("unknown oidset: %s" % result.oidset_name)
-            return
+        self.put_many([result])
 
-        for qname in qnames:
+    def put_many(self, results):
+        batches = {}
+        for result in results:
+            try:
+                qnames = self.config.persist_map[result.oidset_name.lower()]
+            except KeyError:
+                self.log.error("unknown oidset: %s" % result.oidset_name)
+                continue
+
+            for qname in qnames:
+                batches.setdefault(qname, []).append(result)
+
+        for qname, batch in batches.iteritems():
             try:
                 q = self.queues[qname]
             except KeyError:
                 self.log.error("unknown queue: %s" % (qname,))
+                continue
 
-            q.put(result)
+            q.put_many(batch)
+
+
+class FilePersistHandler(MemcachedPersistHandler):
+    """Puts results in FilePersistQueues, the uri is the queue directory."""
+    queue_class = FilePersistQueue
 
 
 def do_profile(func_name, myglobals, mylocals):
@@ -1233,6 +2518,128 @@ def stats(name, config, opts):
         time.sleep(5)
 
 
+class PersistAutoscaler(object):
+    """Pick the number of workers for an autoscaled queue.
+
+    Every INTERVAL seconds the backlog of each worker queue (memcached
+    queues only, see QueueStats) and the fraction of time the workers
+    spend storing results (published by PollPersister.report_stats()) are
+    sampled.  A worker is added when the workers are busy or a backlog is
+    building up and the last one is removed when the others could take
+    over its work, within [min_workers, max_workers] and at most once
+    every COOLDOWN seconds.  The active workers are published on the
+    <qname> queue for MultiWorkerQueue, which moves the keys between the
+    workers and retires removed workers once they are drained.
+
+    The autoscaler changes the workers through a MultiWorkerQueue of its
+    own as well, so keys moved when espersistd is restarted with another
+    number of workers are handed off like they are when scaling.  The
+    workers published before the restart that are no longer wanted are
+    in retiring, they are started to drain their queues.
+    """
+    INTERVAL = 30
+    COOLDOWN = 300
+    SCALE_UP_BUSY = 0.8
+    SCALE_DOWN_BUSY = 0.5
+    SCALE_UP_BACKLOG = 10000
+
+    def __init__(self, config, qname, min_workers, max_workers):
+        self.config = config
+        self.qname = qname
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.log = get_logger('espersistd.autoscale.%s' % qname)
+        self.last_check = 0
+        self.last_change = time.time()
+
+        uri = config.espersistd_uri
+        self.queues = {}
+        self.stats = {}
+        self.mc = None
+        if not (uri and uri.startswith('FilePersistQueue:')):
+            self.mc = memcache.Client([uri])
+
+        self.control = get_persist_queue(qname, uri)
+        previous = self.control.get_state('workers') or []
+        n = min(max_workers, max(min_workers, config.persist_queues[qname][1]))
+        self.workers = set(range(1, n + 1))
+        self.retiring = set(previous) - self.workers
+
+        self.members = MultiWorkerQueue(qname, get_persist_queue, uri,
+            config.persist_queues[qname][1],
+            max_workers=max([max_workers] + previous))
+        self.members.load_assignments()
+        self.publish()
+
+    def publish(self):
+        """Hand off the keys of the workers and publish them."""
+        self.members.set_workers(self.workers)
+        self.control.set_state('workers', sorted(self.workers))
+
+    def _queue(self, w):
+        try:
+            return self.queues[w]
+        except KeyError:
+            q = self.queues[w] = get_persist_queue('%s_%d' % (self.qname, w),
+                self.config.espersistd_uri)
+            return q
+
+    def sample(self):
+        """Return dicts of the backlog and busy fraction of each worker."""
+        now = time.time()
+        backlog = {}
+        busy = {}
+        for w in self.workers:
+            if self.mc:
+                if w not in self.stats:
+                    self.stats[w] = QueueStats(self.mc,
+                        '%s_%d' % (self.qname, w))
+                self.stats[w].update_stats()
+                backlog[w] = max(0, self.stats[w].get_stats()[1])
+            load = self._queue(w).get_state('load')
+            if load and now - load.get('time', 0) < \
+                    3 * PollPersister.STATS_INTERVAL:
+                busy[w] = load.get('busy', 0)
+        return backlog, busy
+
+    def decide(self, backlog, busy):
+        """Return the number of workers wanted given a sample."""
+        n = len(self.workers)
+        max_backlog = max(backlog.values()) if backlog else 0
+        mean_busy = sum(busy.values()) / len(busy) if busy else None
+
+        if n < self.max_workers and (max_backlog > self.SCALE_UP_BACKLOG or
+                (mean_busy is not None and mean_busy > self.SCALE_UP_BUSY)):
+            return n + 1
+        if n > self.min_workers and max_backlog < self.SCALE_UP_BACKLOG / 10 \
+                and mean_busy is not None and \
+                mean_busy * n / (n - 1) < self.SCALE_DOWN_BUSY:
+            return n - 1
+        return n
+
+    def check(self):
+        """Return the new set of workers if it should change, else None."""
+        now = time.time()
+        if now < self.last_check + self.INTERVAL:
+            return None
+        self.last_check = now
+
+        backlog, busy = self.sample()
+        if now < self.last_change + self.COOLDOWN:
+            return None
+
+        n = self.decide(backlog, busy)
+        if n == len(self.workers):
+            return None
+
+        self.log.info("scaling from %d to %d workers: backlog %s busy %s" % (
+            len(self.workers), n, backlog, busy))
+        self.workers = set(range(1, n + 1))
+        self.last_change = now
+        self.publish()
+        return self.workers
+
+
 def worker(name, config, opts):
     if not opts.debug:
         exc_handler = setup_exc_handler(name, config)
@@ -1240,8 +2647,8 @@ def worker(name, config, opts):
 
     os.umask(0022)
 
-    (qclass, nworkers) = config.persist_queues[opts.qname]
-    if nworkers > 1:
+    qclass = config.persist_queues[opts.qname][0]
+    if multi_worker(config, opts.qname):
         name += '_%s' % opts.number
         opts.qname += '_%s' % opts.number
 
@@ -1252,6 +2659,7 @@ def worker(name, config, opts):
     klass = eval(qclass)
     worker = klass(config, opts.qname, persistq=None)
 
+    worker.warm_up()
     worker.run()
     # do_profile("worker.run()", globals(), locals())
 
@@ -1264,6 +2672,7 @@ class PersistManager(object):
         self.runing = False
 
         self.processes = {}
+        self.autoscalers = {}
 
         if tsdb:
             if config.tsdb_root and not os.path.isdir(config.tsdb_root):
@@ -1296,7 +2705,15 @@ class PersistManager(object):
     def start_all_children(self):
         for qname, qinfo in self.config.persist_queues.iteritems():
             (qclass, nworkers) = qinfo
-            for i in range(1, nworkers + 1):
+            if qname in self.config.persist_autoscale:
+                lo, hi = self.config.persist_autoscale[qname]
+                self.autoscalers[qname] = PersistAutoscaler(self.config,
+                        qname, lo, hi)
+                workers = sorted(self.autoscalers[qname].workers |
+                    self.autoscalers[qname].retiring)
+            else:
+                workers = range(1, nworkers + 1)
+            for i in workers:
                 self.start_child(qname, qclass, i)
 
     def start_child(self, qname, qclass, index):
@@ -1305,13 +2722,38 @@ class PersistManager(object):
                 '-q', qname,
                 '-f', self.opts.config_file]
 
-        if self.config.persist_queues[qname][1] > 1:
+        if multi_worker(self.config, qname):
             args.extend(['-n', str(index)])
 
         p = Popen(args, stdout=PIPE, stderr=STDOUT)
 
         self.processes[p.pid] = (p, qname, qclass, index)
 
+    def autoscale(self):
+        """Start the workers added by the autoscalers.  Removed workers
+        exit by themselves once their queue is drained."""
+        for qname, autoscaler in self.autoscalers.iteritems():
+            workers = autoscaler.check()
+            if workers is None:
+                continue
+            running = set([index for p, q, qclass, index in
+                self.processes.values() if q == qname])
+            for i in sorted(workers - running):
+                self.start_child(qname, self.config.persist_queues[qname][0], i)
+
+    def _wait(self):
+        """Return (pid, status) of the next child to exit.  With 
+        autoscaling the children are polled so the autoscalers can run
+        in between, (0, 0) is returned if no child has exited."""
+        if not self.autoscalers:
+            return os.wait()
+
+        self.autoscale()
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            time.sleep(1)
+        return pid, status
+
     def run(self):
         self.log.info("starting")
         self.running = True
@@ -1320,15 +2762,24 @@ class PersistManager(object):
 
         while self.running:
             try:
-                pid, status = os.wait()
+                pid, status = self._wait()
             except OSError, e:
                 if e.errno == errno.EINTR:
                     continue
                 else:
                     raise
 
+            if pid == 0:
+                continue
+
             p, qname, qclass, index = self.processes[pid]
             del self.processes[pid]
+            if qname in self.autoscalers and \
+                    index not in self.autoscalers[qname].workers:
+                self.log.info("worker drained: pid %d, %s_%d" % (pid,
+                    qname, index))
+                continue
+
             self.log.error("child died: pid %d, %s_%d" % (pid, qname, index))
             for line in p.stdout.readlines():
                 self.log.error("pid %d: %s" % (pid, line))
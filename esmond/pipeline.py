@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Background sending of the time series store write batches.
+
+By default a batch (pycassa CfMutator) is sent in the calling thread once
+it holds queue_size mutations, so the persister waits for a round trip to
+the cluster every few hundred updates.  A WritePipeline runs the sends on
+background threads instead so the persister can keep computing the next
+updates while earlier ones are on the wire:
+
+* PipelinedMutator replaces a batch object, buffering mutations and
+  handing each full buffer to the pipeline,
+* sends for one column family are made in order on a single thread unless
+  the column family is marked unordered (counters, where the order of the
+  updates doesn't matter), which get a pool of threads,
+* at most window sends are queued or in flight.  Further sends block the
+  caller until one completes, so a slow cluster slows the persister down
+  rather than growing memory without bounds,
+* a send that raises is logged with the column family it was for and its
+  mutations are dropped, like the persister does with a batch that fails
+  to send in the calling thread.  The number of failed sends is counted,
+* the duration of recent sends is kept for latency percentiles.
+"""
+# Standard
+import collections
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+LATENCY_SAMPLES = 1000
+
+class WritePipeline(object):
+    """
+    Runs batch sends on background threads with a bounded number in
+    flight.
+    """
+    def __init__(self, threads=4, window=16, log=None):
+        self.threads = threads
+        self.window = window
+        self.log = log
+        self._slots = threading.BoundedSemaphore(window)
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._pools = {}
+
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.sent = 0
+        self.errors = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+
+    def _pool(self, lane, ordered):
+        pool = self._pools.get(lane)
+        if pool is None:
+            pool = self._pools[lane] = ThreadPool(1 if ordered else self.threads)
+        return pool
+
+    def submit(self, lane, fn, ordered=True):
+        """
+        Run fn on the pool for lane, blocking while window sends are
+        already pending.
+        """
+        if not self._slots.acquire(False):
+            t0 = time.time()
+            self._slots.acquire()
+            self.stalls += 1
+            self.stall_time += time.time() - t0
+
+        with self._cond:
+            self._in_flight += 1
+        self._pool(lane, ordered).apply_async(self._run, (lane, fn))
+
+    def _run(self, lane, fn):
+        t0 = time.time()
+        try:
+            fn()
+        except Exception, e:
+            with self._cond:
+                self.errors += 1
+            if self.log:
+                self.log.error("%s send failed, batch dropped: %s: %s" % (
+                    lane, e.__class__.__name__, e))
+        finally:
+            self.latencies.append(time.time() - t0)
+            with self._cond:
+                self._in_flight -= 1
+                self.sent += 1
+                self._cond.notify_all()
+            self._slots.release()
+
+    def flush(self):
+        """Wait for all pending sends to complete."""
+        with self._cond:
+            while self._in_flight:
+                self._cond.wait()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            for pool in self._pools.values():
+                pool.close()
+                pool.join()
+            self._pools = {}
+
+    def stats(self):
+        """
+        Return a dict of the number of sends and failed sends, how often
+        and how long the caller was blocked by a full window and
+        percentiles of the recent send durations in seconds.
+        """
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+        return dict(sent=self.sent, errors=self.errors,
+            in_flight=self._in_flight,
+            stalls=self.stalls, stall_time=self.stall_time,
+            p50=percentile(0.5), p90=percentile(0.9), p99=percentile(0.99),
+            max=latencies[-1] if latencies else 0.0)
+
+class PipelinedMutator(object):
+    """
+    Stands in for a batch object, sending the buffered mutations on a
+    WritePipeline.
+    """
+    def __init__(self, batch, pipeline, queue_size, ordered=True):
+        self._column_family = batch._column_family
+        self._pipeline = pipeline
+        self._queue_size = queue_size
+        self._ordered = ordered
+        self._buffer = []
+        self._lock = threading.Lock()
+
+    def _enqueue(self, mutation):
+        with self._lock:
+            self._buffer.append(mutation)
+            full = len(self._buffer) >= self._queue_size
+        if full:
+            self.send()
+
+    def insert(self, key, columns, ttl=None):
+        if columns:
+            # Copy so later changes to the caller's dicts don't leak into
+            # the pending mutation.
+            columns = dict([(k, dict(v) if isinstance(v, dict) else v)
+                for k, v in columns.items()])
+            self._enqueue(('insert', (key, columns), dict(ttl=ttl)))
+
+    def remove(self, key, columns=None, super_column=None):
+        self._enqueue(('remove', (key,),
+            dict(columns=columns, super_column=super_column)))
+
+    def send(self):
+        with self._lock:
+            buf, self._buffer = self._buffer, []
+        if buf:
+            self._pipeline.submit(self._column_family.column_family,
+                lambda: self._send(buf), self._ordered)
+
+    def _send(self, buf):
+        batch = self._column_family.batch(queue_size=len(buf) + 1)
+        for op, args, kw in buf:
+            getattr(batch, op)(*args, **kw)
+        batch.send()
@@ -353,15 +353,26 @@ class PersistThread(threading.Thread):
 
         self.persister = PersistClient(name, config)
 
+    # Maximum number of results handed to the persist queues at once.
+    BATCH_SIZE = 100
+
     def run(self):
         self.state = self.RUN
         while self.state == self.RUN:
             try:
-                task = self.persistq.get(block=True)
+                tasks = [self.persistq.get(block=True)]
             except Queue.Empty:
-                pass
-            else:
-                self.persister.put(task)
+                continue
+
+            # Pass along whatever else is already waiting as one batch.
+            while len(tasks) < self.BATCH_SIZE:
+                try:
+                    tasks.append(self.persistq.get_nowait())
+                except Queue.Empty:
+                    break
+
+            self.persister.put_many(tasks)
+            for task in tasks:
                 self.persistq.task_done()
 
     def stop(self):
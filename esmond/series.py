@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Columnar representation of time series query results.
+
+Query results are traditionally lists of {'ts': .., 'val': ..} dicts,
+which means a dict (and a handful of boxed numbers) per datapoint at every
+step between the store and the json encoder.  A ColumnarSeries holds the
+same datapoints as parallel numpy arrays instead:
+
+* ts is an int64 array of timestamps,
+* every other key (val, is_valid, m_ts, ...) is a column - a value array
+  (int64/float64 when the values are numbers, object otherwise) and a
+  boolean mask of the rows where the value is present (not None),
+* keys with the same value in every row (such as the consolidation
+  function of an aggregation) are kept once as constants.
+
+Bin alignment, unit conversion and gap filling can then be done with array
+operations.  For reading, a series behaves like the list of dicts it
+replaces: len(), iteration, indexing and comparison with a list all work,
+so code that doesn't know about columns keeps working.
+
+numpy is optional.  When it is not installed the query methods return
+lists as before.
+"""
+# Standard
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Rows converted to dicts at a time when iterating.
+ROW_CHUNK_SIZE = 1000
+# Keys from_rows() keeps as a constant when every row has the same value.
+CONSTANT_KEYS = ('cf',)
+
+def _column(values):
+    """
+    Return a (values, mask) column for a sequence of python values that
+    may contain None.
+    """
+    mask = numpy.fromiter((v is not None for v in values), dtype=bool,
+        count=len(values))
+    if not mask.all():
+        values = [v if v is not None else 0 for v in values]
+
+    arr = None
+    try:
+        arr = numpy.array(values)
+    except (ValueError, OverflowError):
+        pass
+    if arr is None or arr.ndim != 1 or arr.dtype.kind not in 'biuf':
+        arr = numpy.empty(len(values), dtype=object)
+        for i, v in enumerate(values):
+            arr[i] = v
+    return arr, mask
+
+class ColumnarSeries(object):
+    """
+    A series of datapoints held as a timestamp array plus named value
+    columns.  See the module docstring.
+    """
+    def __init__(self, ts, columns=None, constants=None):
+        self.ts = numpy.asarray(ts, dtype=numpy.int64)
+        self.columns = OrderedDict()
+        for name, col in (columns or {}).items():
+            if isinstance(col, tuple):
+                values, mask = col
+            else:
+                values, mask = col, None
+            values = numpy.asarray(values)
+            if mask is None:
+                mask = numpy.ones(len(values), dtype=bool)
+            self.columns[name] = (values, numpy.asarray(mask, dtype=bool))
+        self.constants = OrderedDict(constants or {})
+
+    @classmethod
+    def from_lists(cls, ts, constants=None, **columns):
+        """
+        Build a series from a list of timestamps and lists of values (which
+        may contain None) given as keyword args.
+        """
+        return cls(ts, OrderedDict([(k, _column(v)) for k, v in columns.items()]),
+            constants)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build a series from an iterable of dicts with a 'ts' key.  The
+        CONSTANT_KEYS with the same value in every row become constants.
+        """
+        rows = list(rows)
+        names = []
+        for r in rows[:1]:
+            names = [k for k in r if k != 'ts']
+        for r in rows[1:]:
+            for k in r:
+                if k != 'ts' and k not in names:
+                    names.append(k)
+
+        constants = OrderedDict()
+        columns = OrderedDict()
+        for name in names:
+            values = [r.get(name) for r in rows]
+            if name in CONSTANT_KEYS and len(set(values)) == 1:
+                constants[name] = values[0]
+            else:
+                columns[name] = _column(values)
+        return cls([r['ts'] for r in rows], columns, constants)
+
+    @classmethod
+    def concat(cls, parts):
+        """
+        Return a series of the rows of the series parts one after the 
+        other.  A column some of them don't have is None in their rows, 
+        the constants have to be the same in all of them.
+        """
+        parts = list(parts)
+        nonempty = [p for p in parts if len(p)]
+        if not nonempty:
+            return parts[0] if parts else cls([])
+        if len(nonempty) == 1:
+            return nonempty[0]
+
+        constants = nonempty[0].constants
+        if any([p.constants != constants for p in nonempty[1:]]):
+            raise ValueError('series with different constants can not be concatenated')
+
+        names = []
+        for p in nonempty:
+            names.extend([k for k in p.columns if k not in names])
+
+        columns = OrderedDict()
+        for name in names:
+            cols = [p.column(name) for p in nonempty]
+            columns[name] = (numpy.concatenate([v for v, m in cols]),
+                numpy.concatenate([m for v, m in cols]))
+        return cls(numpy.concatenate([p.ts for p in nonempty]), columns,
+            constants)
+
+    def __contains__(self, name):
+        return name == 'ts' or name in self.columns or name in self.constants
+
+    def column(self, name):
+        """
+        Return the (values, mask) of column name.  A column the series
+        doesn't have is None in every row.
+        """
+        if name not in self.columns:
+            return (numpy.zeros(len(self), dtype=numpy.float64),
+                numpy.zeros(len(self), dtype=bool))
+        return self.columns[name]
+
+    def with_columns(self, ts=None, columns=None, constants=None):
+        """
+        Return a new series with ts and the named columns and constants
+        replaced.  A column or constant set to None is dropped.
+        """
+        new_columns = OrderedDict(self.columns)
+        for name, col in (columns or {}).items():
+            if col is None:
+                new_columns.pop(name, None)
+            else:
+                new_columns[name] = col
+        new_constants = OrderedDict(self.constants)
+        for name, value in (constants or {}).items():
+            if value is None:
+                new_constants.pop(name, None)
+            else:
+                new_constants[name] = value
+        return ColumnarSeries(self.ts if ts is None else ts, new_columns,
+            new_constants)
+
+    def take(self, index):
+        """Return the rows selected by an index or boolean array."""
+        return ColumnarSeries(self.ts[index],
+            OrderedDict([(k, (v[index], m[index]))
+                for k, (v, m) in self.columns.items()]),
+            self.constants)
+
+    def to_rows(self, start=0, stop=None):
+        """Return rows start to stop as a list of dicts."""
+        names = ['ts']
+        lists = [self.ts[start:stop].tolist()]
+        for name, (values, mask) in self.columns.items():
+            values = values[start:stop].tolist()
+            mask = mask[start:stop]
+            if not mask.all():
+                for i in numpy.flatnonzero(~mask).tolist():
+                    values[i] = None
+            names.append(name)
+            lists.append(values)
+
+        rows = [dict(zip(names, r)) for r in zip(*lists)]
+        if self.constants:
+            for r in rows:
+                r.update(self.constants)
+        return rows
+
+    def tolist(self):
+        """
+        Return all the rows as a list of dicts - the name matches the
+        numpy method json encoders (such as the rest_framework one) use.
+        """
+        return self.to_rows()
+
+    def __len__(self):
+        return len(self.ts)
+
+    def __iter__(self):
+        for i in xrange(0, len(self), ROW_CHUNK_SIZE):
+            for row in self.to_rows(i, i + ROW_CHUNK_SIZE):
+                yield row
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.take(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('series index out of range')
+        return self.to_rows(i, i + 1)[0]
+
+    def __eq__(self, other):
+        if isinstance(other, (ColumnarSeries, list, tuple)):
+            return len(self) == len(other) and self.to_rows() == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __repr__(self):
+        return '<ColumnarSeries: %d rows, columns: %s>' % (len(self),
+            ', '.join(['ts'] + self.columns.keys() + self.constants.keys()))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+On-disk copy of the persister metadata and aggregation caches.
+
+A CacheSnapshot is made of two files:
+
+* ``<path>`` - a pickle of both caches written to a temporary file and
+  renamed into place so a crash never leaves a partial snapshot,
+* ``<path>.journal`` - an append-only log of the cache entries changed
+  since the snapshot was taken.
+
+Each journal record is a length and crc32 header followed by a pickle of
+the updated entries.  Records are only ever appended so a crash can at
+worst leave a torn record at the end of the journal, which is detected by
+the checksum and ignored on load.  The snapshot and the journal carry a
+generation number so a journal left over from before the most recent
+snapshot is never replayed on top of it.
+"""
+# Standard
+import cPickle as pickle
+import os
+import struct
+import zlib
+
+SNAPSHOT_VERSION = 1
+_HEADER = struct.Struct('!II')
+
+class CacheSnapshot(object):
+    """
+    Reads and writes a snapshot/journal pair at path.
+    """
+    def __init__(self, path, log=None):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.log = log
+        self.generation = 0
+        self._journal = None
+
+    def _write_record(self, fp, obj):
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        fp.write(_HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff))
+        fp.write(data)
+
+    def _read_records(self, fp):
+        while True:
+            header = fp.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            length, crc = _HEADER.unpack(header)
+            data = fp.read(length)
+            if len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+                if self.log:
+                    self.log.warn('ignoring torn record at end of %s' %
+                        self.journal_path)
+                return
+            yield pickle.loads(data)
+
+    def load(self):
+        """
+        Return (metadata_cache, aggregation_cache) rebuilt from the
+        snapshot and journal.  Both are empty if there is no snapshot.
+        """
+        metadata, aggregations = {}, {}
+
+        try:
+            with open(self.path, 'rb') as fp:
+                snap = pickle.load(fp)
+        except IOError:
+            snap = None
+        except Exception, e:
+            if self.log:
+                self.log.error('unable to read cache snapshot %s: %s' %
+                    (self.path, e))
+            snap = None
+
+        if snap and snap.get('version') == SNAPSHOT_VERSION:
+            self.generation = snap['generation']
+            metadata = snap['metadata']
+            aggregations = snap['aggregations']
+
+        try:
+            fp = open(self.journal_path, 'rb')
+        except IOError:
+            return metadata, aggregations
+
+        with fp:
+            records = self._read_records(fp)
+            # A journal from another generation is left over from before
+            # the snapshot was written and is already included in it.
+            if next(records, None) == ('generation', self.generation):
+                for meta, aggs in records:
+                    metadata.update(meta)
+                    aggregations.update(aggs)
+
+        return metadata, aggregations
+
+    def write(self, metadata, aggregations):
+        """
+        Write a new snapshot of the caches and start a new journal.
+        """
+        self.close()
+        self.generation += 1
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as fp:
+            pickle.dump(dict(version=SNAPSHOT_VERSION,
+                generation=self.generation, metadata=metadata,
+                aggregations=aggregations), fp, pickle.HIGHEST_PROTOCOL)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp, self.path)
+
+        self._journal = open(self.journal_path, 'wb')
+        self._write_record(self._journal, ('generation', self.generation))
+        self._journal.flush()
+
+    def append(self, metadata, aggregations):
+        """
+        Append the changed cache entries to the journal.  Changes are
+        pushed to the OS but not synced so they survive a crash of the
+        process, not of the host.
+        """
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'ab')
+        self._write_record(self._journal, (metadata, aggregations))
+        self._journal.flush()
+
+    def journal_size(self):
+        if self._journal is None:
+            return 0
+        return self._journal.tell()
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None